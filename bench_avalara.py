@@ -0,0 +1,303 @@
+"""Micro benchmarks for the client side costs of pyavatax, no AvaTax account needed.
+
+    $ python bench_avalara.py            # run them all
+    $ python bench_avalara.py parse_once # or just the ones named
+"""
+import json
+import sys
+import timeit
+import tracemalloc
+
+from pyavatax.api import PostTaxResponse, error_as_response
+from pyavatax.base import AddressPool, AvalaraBase, AvalaraServerDetailException, AvalaraLogging, Document, DocumentTemplate, JSONSerializer, Line, LineTable, response_json
+
+
+class FakeRequest(object):
+    method = 'POST'
+    url = 'https://development.avalara.net/1.0/tax/get'
+    body = b'{}'
+
+
+class FakeResponse(object):
+    """Stands in for requests.Response, counting how often the body is parsed"""
+    request = FakeRequest()
+
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+        self.parses = 0
+
+    def json(self):
+        self.parses += 1
+        return json.loads(self.text)
+
+
+def post_tax_body(lines):
+    """A PostTaxResponse body shaped like AvaTax's, with `lines` TaxLines"""
+    details = [
+        {'Country': 'US', 'Region': 'WA', 'JurisType': 'State', 'JurisCode': '53', 'Taxable': '10', 'Rate': '0.065', 'Tax': '0.65', 'JurisName': 'WASHINGTON', 'TaxName': 'WA STATE TAX'},
+        {'Country': 'US', 'Region': 'WA', 'JurisType': 'City', 'JurisCode': '03736', 'Taxable': '10', 'Rate': '0.022', 'Tax': '0.22', 'JurisName': 'BAINBRIDGE ISLAND', 'TaxName': 'WA CITY TAX'},
+    ]
+    return json.dumps({
+        'ResultCode': 'Success', 'DocCode': 'bench', 'DocDate': '2024-01-31', 'Timestamp': '2024-01-31T12:00:00', 'TotalAmount': str(10 * lines),
+        'TotalDiscount': '0', 'TotalExemption': '0', 'TotalTaxable': str(10 * lines), 'TotalTax': str(0.87 * lines), 'TotalTaxCalculated': str(0.87 * lines), 'TaxDate': '2024-01-31',
+        'TaxLines': [{'LineNo': str(i + 1), 'TaxCode': 'P0000000', 'Taxability': 'true', 'BoundaryLevel': 'Zip5', 'Taxable': '10', 'Rate': '0.087', 'Tax': '0.87', 'Discount': '0', 'TaxCalculated': '0.87', 'Exemption': '0', 'TaxDetails': details} for i in range(lines)],
+        'TaxAddresses': [{'Address': '435 Ericksen Avenue Northeast', 'AddressCode': '1', 'City': 'Bainbridge Island', 'Country': 'US', 'PostalCode': '98110', 'Region': 'WA', 'TaxRegionId': '2109700', 'JurisCode': '5303503736', 'Latitude': '47.62', 'Longitude': '-122.51'}],
+        'TaxDetails': details,
+    })
+
+
+def document_data(lines):
+    """A Document.from_data dict with `lines` Lines shipping from and to one address each"""
+    return {
+        'DocDate': '2024-01-31', 'DocType': 'SalesOrder', 'CompanyCode': 'BENCH', 'CustomerCode': 'email@email.com', 'Discount': '0',
+        'Addresses': [
+            {'AddressCode': '1', 'Line1': '435 Ericksen Avenue Northeast', 'Line2': '#250', 'PostalCode': '98110', 'Region': 'WA', 'City': 'Bainbridge Island', 'Country': 'US'},
+            {'AddressCode': '2', 'Line1': '100 Ravine Lane', 'Line2': 'Suite 220', 'PostalCode': '98110', 'Region': 'WA', 'City': 'Bainbridge Island', 'Country': 'US'},
+        ],
+        'Lines': [{'LineNo': i + 1, 'DestinationCode': '2', 'OriginCode': '1', 'Qty': '1', 'Amount': '10.00', 'ItemCode': 'SKU%d' % i, 'Description': 'Item %d' % i} for i in range(lines)],
+    }
+
+
+def error_body(messages):
+    return json.dumps({'ResultCode': 'Error', 'Messages': [{'Summary': 'Line %d is invalid' % i, 'RefersTo': 'Lines[%d]' % i, 'Source': 'Avalara.AvaTax.Services.Tax', 'Severity': 'Error', 'Details': 'x' * 200} for i in range(messages)]})
+
+
+class Silent(object):
+    logger = AvalaraLogging.get_logger()
+
+    class recorder(object):
+        @staticmethod
+        def failure(doc, response):
+            pass
+
+
+def bench_parse_once(number=20):
+    """How often one response body is parsed on the way through the client"""
+    body = post_tax_body(1000)
+    resp = FakeResponse(body)
+
+    def success():
+        resp.__dict__.pop('_pyavatax_json', None)
+        tax = PostTaxResponse(resp)
+        return tax.is_success, tax.error
+
+    success()
+    print('PostTaxResponse + is_success + error, 1,000 lines: %d parse(s), %.2f ms' % (resp.parses, min(timeit.repeat(success, number=number, repeat=3)) / number * 1000))
+    resp = FakeResponse(error_body(200), status_code=500)
+
+    def failure():
+        resp.__dict__.pop('_pyavatax_json', None)
+        e = AvalaraServerDetailException(resp)
+        return error_as_response(Silent, (), e).error
+
+    failure()
+    print('server error through except_500_and_return, 200 messages: %d parse(s), %.2f ms' % (resp.parses, min(timeit.repeat(failure, number=number, repeat=3)) / number * 1000))
+    print('parsing the 1,000 line body once costs %.2f ms' % (min(timeit.repeat(lambda: json.loads(body), number=number, repeat=3)) / number * 1000))
+
+
+def bench_lazy_response(number=20):
+    """What a PostTaxResponse costs when only the totals are read, versus walking every TaxLine"""
+    resp = FakeResponse(post_tax_body(1000))
+
+    def totals():
+        resp.__dict__.pop('_pyavatax_json', None)
+        return PostTaxResponse(resp).total_tax
+
+    def lines():
+        resp.__dict__.pop('_pyavatax_json', None)
+        tax = PostTaxResponse(resp)
+        return [d.Tax for line in tax.TaxLines for d in line.TaxDetails]
+
+    print('PostTaxResponse + total_tax, 1,000 lines: %.2f ms' % (min(timeit.repeat(totals, number=number, repeat=3)) / number * 1000))
+    print('PostTaxResponse + every TaxLine and TaxDetail, 1,000 lines: %.2f ms' % (min(timeit.repeat(lines, number=number, repeat=3)) / number * 1000))
+
+
+def bench_decode(seconds=0.5):
+    """Responses per second decoded from parsed JSON, for 1, 100 and 1,000 line responses:
+    just the totals, and every TaxLine, TaxDetail and TaxAddress"""
+    for lines in (1, 100, 1000):
+        resp = FakeResponse(post_tax_body(lines))
+        response_json(resp)  # parsing is the same for every decoder, leave it out
+
+        def totals():
+            return PostTaxResponse(resp).total_tax
+
+        def everything():
+            tax = PostTaxResponse(resp)
+            return [d.Tax for line in tax.TaxLines for d in line.TaxDetails], [a.TaxRegionId for a in tax.TaxAddresses]
+
+        rates = []
+        for fn in (totals, everything):
+            number = max(1, int(seconds / timeit.timeit(fn, number=1)))
+            rates.append(number / min(timeit.repeat(fn, number=number, repeat=3)))
+        print('%d line(s): %.0f responses/s totals only, %.0f responses/s every object' % (lines, rates[0], rates[1]))
+
+
+def bench_build_document(number=20):
+    """Building a Document from a dict and turning it back into one, and building a whole response"""
+    data = document_data(1000)
+    resp = FakeResponse(post_tax_body(1000))
+
+    def response():
+        resp.__dict__.pop('_pyavatax_json', None)
+        tax = PostTaxResponse(resp)
+        return [d.Tax for line in tax.TaxLines for d in line.TaxDetails]
+
+    print('Document.from_data, 1,000 lines: %.2f ms' % (min(timeit.repeat(lambda: Document.from_data(data), number=number, repeat=3)) / number * 1000))
+    doc = Document.from_data(data)
+    print('Document.todict, 1,000 lines: %.2f ms' % (min(timeit.repeat(doc.todict, number=number, repeat=3)) / number * 1000))
+    print('PostTaxResponse, every TaxLine and TaxDetail, 1,000 lines: %.2f ms' % (min(timeit.repeat(response, number=number, repeat=3)) / number * 1000))
+
+
+def bench_incremental_build(number=1):
+    """Building a Document one update(Lines=[...]) call at a time, which should grow linearly with the lines"""
+    for lines in (1000, 5000):
+        data = document_data(lines)
+        rows = data.pop('Lines')
+
+        def build():
+            doc = Document.from_data(data)
+            for row in rows:
+                doc.update(Lines=[row])
+            return doc
+
+        print('%d update calls: %.2f ms' % (lines, min(timeit.repeat(build, number=number, repeat=3)) / number * 1000))
+
+
+class DictLine(AvalaraBase):
+    """A Line as it was before _compact, with its fields in an instance __dict__"""
+    _fields = Line._fields
+    clean_Qty, clean_Amount, clean_ItemCode = Line.clean_Qty, Line.clean_Amount, Line.clean_ItemCode
+
+
+def bench_memory():
+    """Memory held per object, for the Lines of a Document and a fully read PostTaxResponse"""
+    def measure(build, count, label, against=None):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        held = build()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        size = float(after - before) / count
+        print('%s: %.0f bytes per object%s' % (label, size, ', %.2fx the dict-backed Line' % (size / against) if against else ''))
+        return size
+
+    rows = document_data(1000)['Lines']
+    before = measure(lambda: [DictLine(**row) for row in rows], len(rows), 'dict-backed Line')
+    measure(lambda: [Line(**row) for row in rows], len(rows), 'Line', before)
+    measure(lambda: LineTable(rows), len(rows), 'LineTable, per line', before)
+    resp = FakeResponse(post_tax_body(1000))
+    response_json(resp)  # the parsed body isn't counted
+
+    def response():
+        tax = PostTaxResponse(resp)
+        return tax, [d for line in tax.TaxLines for d in line.TaxDetails]
+
+    measure(response, 1000 * 3 + 2 + 1, 'PostTaxResponse TaxLines and TaxDetails')
+
+
+def bench_trusted(number=20):
+    """Document.from_data against Document.from_trusted_data, for the same already clean 1,000 lines"""
+    data = Document.from_data(document_data(1000)).todict()
+    for name in ('from_data', 'from_trusted_data'):
+        build = getattr(Document, name)
+        print('Document.%s, 1,000 lines: %.2f ms' % (name, min(timeit.repeat(lambda: build(data), number=number, repeat=3)) / number * 1000))
+    docs = [Document.from_trusted_data(data) for _ in range(10)]
+    print('Document.validate_many, 10 x 1,000 lines: %.2f ms' % (min(timeit.repeat(lambda: Document.validate_many(docs), number=1, repeat=3)) * 1000))
+
+
+def bench_template(number=2000):
+    """A 3 line quote built and serialized from scratch, and from a DocumentTemplate"""
+    data = dict(document_data(3), DetailLevel={'Line': True, 'Tax': True})
+    lines = data.pop('Lines')
+    template = DocumentTemplate(data)
+    for label, quote in (
+        ('Document.from_data', lambda: Document.from_data(dict(data, Lines=lines)).todict()),
+        ('DocumentTemplate.new', lambda: template.new(lines).todict()),
+    ):
+        print('%s + todict: %.1f us' % (label, min(timeit.repeat(quote, number=number, repeat=3)) / number * 1000000))
+
+
+def bench_address_pool(number=2000):
+    """A 1 line order from a warehouse to one of 50 customers, built and serialized, with and without an AddressPool"""
+    data = document_data(0)
+    warehouse, _ = data.pop('Addresses')
+    customers = [{'Line1': '%d Main Street' % i, 'Line2': 'Apt %d' % i, 'City': 'Bainbridge Island', 'Region': 'WA', 'PostalCode': '98110', 'Country': 'US'} for i in range(50)]
+    serializer = JSONSerializer()
+    pool = AddressPool()
+
+    def order(i, intern):
+        doc = Document.from_data(data)
+        if intern:
+            doc.add_from_address(pool.intern(warehouse))
+            doc.add_to_address(pool.intern(customers[i % 50]))
+        else:
+            doc.add_from_address(**warehouse)
+            doc.add_to_address(**customers[i % 50])
+        doc.add_line(Amount=10)
+        return serializer.dumps(doc.todict())
+
+    assert order(1, True) == order(1, False)
+    for intern in (False, True):
+        counter = iter(range(10 ** 9))
+        print('%s: %.1f us per order' % ('AddressPool' if intern else 'Address', min(timeit.repeat(lambda: order(next(counter), intern), number=number, repeat=3)) / number * 1000000))
+    print('pool: %r' % pool.stats())
+
+
+def bench_line_table(number=3):
+    """A 10,000 line Document kept as a list of Lines, and as a LineTable"""
+    data = document_data(0)
+    rows = [{'Qty': '1', 'Amount': '10.00', 'ItemCode': 'SKU%d' % i, 'Description': 'Item %d' % i} for i in range(10000)]
+
+    def build(lines):
+        doc = Document.from_data(dict(data, Lines=lines()))
+        doc.from_address_code, doc.to_address_code = '1', '2'
+        for row in rows:
+            doc.add_line(**row)
+        return doc
+
+    def best(fn, setup=None):
+        times = []
+        for _ in range(number):
+            arg = setup() if setup else None
+            start = timeit.default_timer()
+            fn(arg)
+            times.append(timeit.default_timer() - start)
+        return min(times) * 1000
+
+    for label, lines in (('list of Lines', list), ('LineTable', LineTable)):
+        doc = build(lines)
+        print('%s: add_line x 10,000 %.2f ms, total %.2f ms, validate_codes %.2f ms, todict %.2f ms' % (
+            label, best(lambda _: build(lines)), best(lambda _: doc.total), best(lambda d: d.validate_codes(), lambda: build(lines)), best(lambda _: doc.todict())))
+    columns = dict((f, [row[f] for row in rows]) for f in rows[0])
+    print('LineTable.from_columns, 10,000 lines: %.2f ms' % best(lambda _: LineTable.from_columns(**columns)))
+
+
+def bench_encoder(number=5):
+    """A 10,000 line Document turned into a request body: time and peak memory of
+    dumps(todict()), encode() and iterencode() (the chunks are dropped as a socket would)"""
+    doc = Document.from_data(document_data(10000))
+    serializer = JSONSerializer()
+
+    def drain(doc):
+        for chunk in serializer.iterencode(doc):
+            pass
+
+    for label, fn in (('dumps(todict())', lambda d: serializer.dumps(d.todict())), ('encode', serializer.encode), ('iterencode', drain)):
+        ms = min(timeit.repeat(lambda: fn(doc), number=1, repeat=number)) * 1000
+        tracemalloc.start()
+        fn(doc)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%s: %.1f ms, peak %.1f MB' % (label, ms, peak / 1e6))
+
+
+BENCHMARKS = dict((name[len('bench_'):], fn) for name, fn in list(globals().items()) if name.startswith('bench_'))
+
+
+if __name__ == '__main__':
+    AvalaraLogging.get_logger().disabled = True
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('== %s' % name)
+        BENCHMARKS[name]()
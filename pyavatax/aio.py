@@ -0,0 +1,253 @@
+"""asyncio flavour of the API, requires aiohttp (pip install aiohttp)"""
+import asyncio
+import contextvars
+import functools
+import json
+
+import aiohttp
+
+from pyavatax.api import API, error_as_response
+from pyavatax.django_integration import MockDjangoRecorder
+from pyavatax.base import PRIORITY_BULK, AvalaraException, AvalaraRateLimitException, Document, ErrorResponse, AvalaraServerException, AvalaraServerNotReachableException, SingleFlight, StreamedBody, monotonic
+
+
+_priority = contextvars.ContextVar('pyavatax_priority', default=None)  # per task, like the API's per thread priority
+
+
+def async_except_500_and_return(fn):
+    """Coroutine counterpart of except_500_and_return"""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        except AvalaraServerException as e:
+            self = args[0]
+            return await self._off_loop((self.recorder,), error_as_response, self, args, e)
+    return wrapper
+
+
+class AsyncRequest(object):
+    """The parts of a requests.PreparedRequest our exceptions report on"""
+
+    def __init__(self, method, url, body):
+        self.method = method
+        self.url = url
+        self.body = body
+
+
+class AsyncResponse(object):
+    """A fully read aiohttp response, exposing the parts of requests.Response
+    that the response objects and exceptions rely on"""
+
+    def __init__(self, status_code, text, request):
+        self.status_code = status_code
+        self.text = text
+        self.request = request
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncAPI(API):
+    """Same calls as the API object, as coroutines. Takes the same arguments, plus
+    the aiohttp connector settings limit (total connections) and limit_per_host.
+    Use it as an async context manager, or await close() when finished"""
+
+    default_limit = 100
+    default_limit_per_host = 0  # no per host limit
+
+    def __init__(self, account_number, license_key, company_code, live=False, logger=None, recorder=None, limit=None, limit_per_host=None, **kwargs):
+        super(AsyncAPI, self).__init__(account_number, license_key, company_code, live=live, logger=logger, recorder=recorder, **kwargs)
+        self.limit = AsyncAPI.default_limit if limit is None else limit
+        self.limit_per_host = AsyncAPI.default_limit_per_host if limit_per_host is None else limit_per_host
+        self._session = None
+
+    def __enter__(self):
+        raise AvalaraException('Use "async with" with an AsyncAPI')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def session(self):
+        """The aiohttp.ClientSession used for every call, created on first use inside the running loop.
+        Unlike the API object, an AsyncAPI belongs to the one event loop it is used from"""
+        if self._session is None:
+            self._session = self._new_session()
+        return self._session
+
+    def _new_session(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        """Closes any pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _may_block(hooks):
+        """Whether any of the recorder, caches or rate limiter in hooks may block. Those
+        that don't say are taken to: the Django recorder writes to the database, a
+        SQLiteTTLCache or SQLiteTokenBucket waits on its file"""
+        return any(getattr(hook, 'blocking', True) for hook in hooks if hook is not None and hook is not MockDjangoRecorder)
+
+    async def _off_loop(self, hooks, fn, *args):
+        """fn(*args), run on the loop's default executor when one of the hooks it uses may
+        block, so that it doesn't hold up the event loop"""
+        if not self._may_block(hooks):
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    async def _before_attempt(self, deadline):
+        probe = None
+        if self.circuit_breaker is not None:
+            probe = self.circuit_breaker.before_call()
+        if self.rate_limiter is not None:
+            priority = self.current_priority
+            blocking = self._may_block((self.rate_limiter,))
+            while True:
+                if blocking:
+                    wait = await asyncio.get_running_loop().run_in_executor(None, self.rate_limiter.try_acquire, priority)
+                else:
+                    wait = self.rate_limiter.try_acquire(priority)
+                if not wait:
+                    break
+                if deadline is not None and monotonic() + wait > deadline:
+                    raise AvalaraRateLimitException(wait)
+                await asyncio.sleep(wait)
+        return probe
+
+    @property
+    def current_priority(self):
+        """The rate limiter priority of calls made from this task"""
+        return _priority.get() or self.priority
+
+    def _encode_data(self, data):
+        body = super(AsyncAPI, self)._encode_data(data)
+        if isinstance(body, StreamedBody):
+            body = body.render()  # still without the dict tree, but aiohttp gets it whole
+        return body
+
+    async def _get(self, stem, data, retry=True):
+        return await self._request('GET', stem, params=data, retry=retry)
+
+    async def _post(self, stem, data, params={}, retry=True):
+        return await self._request('POST', stem, params=params, data=data, retry=retry)
+
+    async def _send(self, http_method, url, data, kwargs):
+        try:
+            async with self.session.request(http_method, url, **kwargs) as r:
+                text = await r.text()
+                request = AsyncRequest(http_method, str(r.url), data if http_method == 'POST' else None)
+                return AsyncResponse(r.status, text, request)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(e)
+            raise AvalaraServerNotReachableException(e)
+
+    async def _request(self, http_method, stem, data={}, params={}, retry=True):
+        url = '%s/%s' % (self.url, stem)
+        data = self._encode_data(data)
+        if self._coalesce(retry, data):
+            key = (id(asyncio.get_running_loop()),) + SingleFlight.key(self.username, http_method, url, params, data)
+            return await self.single_flight.do_async(key, lambda: self._request_attempts(http_method, stem, url, data, params, retry))
+        return await self._request_attempts(http_method, stem, url, data, params, retry)
+
+    async def _request_attempts(self, http_method, stem, url, data, params, retry):
+        kwargs = {
+            # requests drops None params and str()s the rest, aiohttp is stricter
+            'params': dict((k, v if isinstance(v, str) else str(v)) for k, v in params.items() if v is not None),
+            'headers': self.headers,
+            'auth': aiohttp.BasicAuth(str(self.username), str(self.password)),
+            'proxy': self.proxies.get(self.protocol),
+        }
+        if http_method == 'POST':
+            kwargs.update({'data': data})
+        deadline = self._deadline(retry)
+        attempt = 0
+        while True:
+            attempt += 1
+            probe = await self._before_attempt(deadline)
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=self._attempt_timeout(deadline))
+            try:
+                resp = await self._send(http_method, url, data, kwargs)
+            except AvalaraServerNotReachableException as e:
+                self._after_attempt(probe, exception=e.request_exception)
+                delay = self._retry_delay(stem, attempt, deadline, retry, exception=e.request_exception)
+                if delay is None:
+                    raise
+            else:
+                self._after_attempt(probe, status=resp.status_code)
+                if resp.status_code == 200:
+                    return self._check_response(resp)
+                delay = self._retry_delay(stem, attempt, deadline, retry, status=resp.status_code)
+                if delay is None:
+                    return self._check_response(resp)
+            await asyncio.sleep(delay)
+
+    @async_except_500_and_return
+    async def get_tax(self, lat, lng, doc, sale_amount=None):
+        """Performs a HTTP GET to tax/get/"""
+        doc, stem, data = self._prepare_get_tax(lat, lng, doc, sale_amount)
+        hooks = (self.rate_cache, self.recorder)
+        tax = await self._off_loop(hooks, self._cached_get_tax, lat, lng, doc, stem, data)
+        if tax is None:
+            resp = await self._get(stem, data)
+            tax = await self._off_loop(hooks, self._finish_get_tax, doc, stem, data, resp, lat, lng)
+        return tax
+
+    @async_except_500_and_return
+    async def post_tax(self, doc, commit=False):
+        """Performs a HTTP POST to tax/get/, see API.post_tax"""
+        doc, stem, data = self._prepare_post_tax(doc, commit)
+        hooks = (self.quote_cache, self.rate_index, self.recorder)
+        tax = await self._off_loop(hooks, self._cached_post_tax, doc, stem, data)
+        if tax is None:
+            resp = await self._post(stem, data, retry=self._can_retry_post_tax(doc))
+            tax = await self._off_loop(hooks, self._finish_post_tax, doc, stem, data, resp)
+        return tax
+
+    async def post_tax_many(self, docs, commit=False, max_workers=None, priority=PRIORITY_BULK):
+        """Coroutine counterpart of API.post_tax_many, running up to max_workers posts
+        at once (defaults to limit, or every document when limit is 0)"""
+        docs = list(docs)
+        semaphore = asyncio.Semaphore(max_workers or self.limit or max(len(docs), 1))
+        return list(await asyncio.gather(*[self._post_tax_one(doc, commit, priority, semaphore) for doc in docs]))
+
+    async def _post_tax_one(self, doc, commit, priority, semaphore):
+        async with semaphore:
+            _priority.set(priority)  # gather runs every call in a task of its own, with its own context
+            try:
+                if isinstance(doc, dict):
+                    doc = Document.from_data(doc)
+                return await self.post_tax(doc, commit=commit)
+            except asyncio.CancelledError:  # an Exception before Python 3.8
+                raise
+            except Exception as e:  # whatever it is, it only fails this document
+                self._log_post_tax_failure(doc, e)
+                resp = ErrorResponse.from_exception(e)
+                if isinstance(doc, Document):
+                    await self._off_loop((self.recorder,), self.recorder.failure, doc, resp)
+                return resp
+
+    @async_except_500_and_return
+    async def cancel_tax(self, doc, reason=None, doc_id=None):
+        """Performs a HTTP POST to tax/cancel/"""
+        doc, stem, data = self._prepare_cancel_tax(doc, reason, doc_id)
+        resp = await self._post(stem, data, retry=False)
+        return await self._off_loop((self.recorder,), self._finish_cancel_tax, doc, stem, data, resp)
+
+    @async_except_500_and_return
+    async def validate_address(self, address):
+        """Performs a HTTP GET to address/validate/"""
+        address, stem, data = self._prepare_validate_address(address)
+        hooks = (self.address_cache,)
+        validated = await self._off_loop(hooks, self._cached_validate_address, address, stem, data)
+        if validated is None:
+            resp = await self._get(stem, data)
+            validated = await self._off_loop(hooks, self._finish_validate_address, address, stem, data, resp)
+        return validated
@@ -1,41 +1,43 @@
 import decorator
+import functools
 import json
-from pyavatax.base import Document, Address, BaseResponse, BaseAPI, AvalaraException, AvalaraTypeException, AvalaraValidationException, AvalaraServerException, ErrorResponse, AvalaraServerNotReachableException
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pyavatax.base import Document, Address, BaseResponse, BaseAPI, PRIORITY_BULK, AvalaraBaseException, AvalaraException, AvalaraTypeException, AvalaraValidationException, AvalaraServerException, ErrorResponse, AvalaraServerNotReachableException
 
 
-@decorator.decorator
-def except_500_and_return(fn, *args, **kwargs):
+def error_as_response(self, args, e):
+    """Logs a server exception and returns it wrapped in an ErrorResponse,
+    recording the failure against the Document found in args (if any)"""
+    logged = False
+    try:
+        # don't log the doc status error as an exception
+        for err in e.errors_as_dict:
+            if 'DocStatus' in err.keys():
+                if 'DocStatus is invalid for this operation.' in err.values():
+                    self.logger.warning(e.full_request_as_string)  # this case is not an error, just log a warning
+                    logged = True
+
+        if not logged:
+            self.logger.exception(e.full_request_as_string)
+    except ValueError:  # json failed to parse
+        self.logger.exception(e.full_request_as_string)
+    # always return the error wrapped in a response object
+    resp = e.error_response
+    for arg in args:
+        if isinstance(arg, Document):
+            self.recorder.failure(arg, resp)
+            break
+    return resp
 
-    def error_as_resp(args, e):
-        """
-        Always return the error wrapped in a response object
-        """
-        resp = ErrorResponse(e.response)
-        for arg in args:
-            if isinstance(arg, Document):
-                self.recorder.failure(arg, resp)
-                break
-        return resp
 
+@decorator.decorator
+def except_500_and_return(fn, *args, **kwargs):
     try:
         return fn(*args, **kwargs)
     except AvalaraServerException as e:
-        self = args[0]  # the first arg is self
-        logged = False
-        try:
-            # don't log the doc status error as an exception
-            for err in e.errors_as_dict:
-                if 'DocStatus' in err.keys():
-                    if 'DocStatus is invalid for this operation.' in err.values():
-                        self.logger.warning(e.full_request_as_string)  # this case is not an error, just log a warning
-                        logged = True
-
-            if not logged:
-                self.logger.exception(e.full_request_as_string)
-            return error_as_resp(args, e)
-        except ValueError:  # json failed to parse
-            self.logger.exception(e.full_request_as_string)
-            return error_as_resp(args, e)
+        return error_as_response(args[0], args, e)  # the first arg is self
+
 
 class API(BaseAPI):
 
@@ -43,14 +45,34 @@ class API(BaseAPI):
     DEVELOPMENT_HOST = 'development.avalara.net'
     VERSION = '1.0'
 
-    def __init__(self, account_number, license_key, company_code, live=False, logger=None, recorder=None, **kwargs):
-        """Constructor for API object. Also takes two optional kwargs: timeout, and proxies"""
+    def __init__(self, account_number, license_key, company_code, live=False, logger=None, recorder=None, rate_cache=None, address_cache=None, quote_cache=None, rate_index=None, **kwargs):
+        """Constructor for API object. Also takes optional kwargs: timeout, proxies,
+        and the connection pool settings pool_connections, pool_maxsize and pool_block.
+        Connections are kept alive between calls, use the API as a context manager
+        or call close() to release them. With stream_body=True post_tax bodies are
+        encoded straight from the Document as they are sent, in chunks.
+        Pass a pyavatax.cache.RateCache as rate_cache to answer get_tax from cached rates,
+        an AddressCache as address_cache to answer validate_address, and a QuoteCache
+        as quote_cache to answer post_tax for quotes that were already made. A
+        RateIndex passed as rate_index learns rates from every post_tax"""
         self.company_code = company_code
+        self.rate_cache = rate_cache
+        self.address_cache = address_cache
+        self.quote_cache = quote_cache
+        self.rate_index = rate_index
         super(API, self).__init__(username=account_number, password=license_key, live=live, logger=logger, recorder=recorder, **kwargs)
 
     @except_500_and_return
     def get_tax(self, lat, lng, doc, sale_amount=None):
         """Performs a HTTP GET to tax/get/"""
+        doc, stem, data = self._prepare_get_tax(lat, lng, doc, sale_amount)
+        tax = self._cached_get_tax(lat, lng, doc, stem, data)
+        if tax is None:
+            resp = self._get(stem, data)
+            tax = self._finish_get_tax(doc, stem, data, resp, lat, lng)
+        return tax
+
+    def _prepare_get_tax(self, lat, lng, doc, sale_amount):
         if doc is not None:
             if isinstance(doc, dict):
                 doc = Document.from_data(doc)
@@ -63,10 +85,25 @@ class API(BaseAPI):
         except TypeError:
             raise AvalaraTypeException(AvalaraException.CODE_LATLNG, 'Please pass lat and lng as floats, or Decimal')
         data = {'saleamount': sale_amount} if sale_amount else {'saleamount': doc.total}
-        resp = self._get(stem, data)
+        return doc, stem, data
+
+    def _cached_get_tax(self, lat, lng, doc, stem, data):
+        """The GetTaxResponse from the rate cache, if there is one and it has the rates for lat, lng"""
+        if self.rate_cache is None:
+            return None
+        tax = self.rate_cache.response(lat, lng, data['saleamount'])
+        if tax is not None:
+            self.logger.info('"GET" %s%s with: %s answered from the rate cache' % (self.url, stem, data))
+            self.recorder.success(doc)
+        return tax
+
+    def _finish_get_tax(self, doc, stem, data, resp, lat=None, lng=None):
         self.logger.info('"GET" %s%s with: %s' % (self.url, stem, data))
         self.recorder.success(doc)
-        return GetTaxResponse(resp)
+        tax = GetTaxResponse(resp)
+        if self.rate_cache is not None and lat is not None:
+            self.rate_cache.remember(lat, lng, tax)
+        return tax
 
     @except_500_and_return
     def post_tax(self, doc, commit=False):
@@ -75,6 +112,21 @@ class API(BaseAPI):
         the document type to make sure it is capable of being Commited.
         XXXXXOrder is not capable of being commited. We will change it 
         to XXXXXXXInvoice, which is capable of being committed"""
+        doc, stem, data = self._prepare_post_tax(doc, commit)
+        tax = self._cached_post_tax(doc, stem, data)
+        if tax is None:
+            resp = self._post(stem, data, retry=self._can_retry_post_tax(doc))
+            tax = self._finish_post_tax(doc, stem, data, resp)
+        return tax
+
+    def _can_retry_post_tax(self, doc):
+        """Sending a post twice only risks a duplicate when AvaTax saves the document
+        (it is committed, or not an order type) and it has no DocCode to key it by"""
+        if getattr(doc, 'DocCode', None):
+            return True
+        return not getattr(doc, 'Commit', False) and getattr(doc, 'DocType', None) in Document.ORDER_DOC_TYPES
+
+    def _prepare_post_tax(self, doc, commit):
         if isinstance(doc, dict):
             doc = Document.from_data(doc)
         elif not isinstance(doc, Document):
@@ -83,7 +135,7 @@ class API(BaseAPI):
         doc.update(CompanyCode=self.company_code)
         if commit:
             doc.update(Commit=True)
-            self.logger.debug('%s setting Commit=True' % doc.DocCode)
+            self.logger.debug('%s setting Commit=True' % getattr(doc, 'DocCode', None))
             # need to change doctype if order, to invoice, otherwise commit does nothing
             new_doc_type = {
                 Document.DOC_TYPE_SALE_ORDER: Document.DOC_TYPE_SALE_INVOICE,
@@ -92,20 +144,80 @@ class API(BaseAPI):
                 Document.DOC_TYPE_INVENTORY_ORDER: Document.DOC_TYPE_INVENTORY_INVOICE
             }.get(doc.DocType, None)
             if new_doc_type:
-                self.logger.debug('%s updating DocType from %s to %s' % (doc.DocCode, doc.DocType, new_doc_type))
+                self.logger.debug('%s updating DocType from %s to %s' % (getattr(doc, 'DocCode', None), doc.DocType, new_doc_type))
                 doc.update(DocType=new_doc_type)
-        data = doc.todict()
-        resp = self._post(stem, data)
+        data = doc if self.stream_body else doc.todict()  # a Document is encoded while it is sent
+        return doc, stem, data
+
+    def _cached_post_tax(self, doc, stem, data):
+        """The PostTaxResponse from the quote cache, if there is one and it has quoted this document"""
+        if self.quote_cache is None:
+            return None
+        tax_resp = self.quote_cache.response(doc, data)
+        if tax_resp is not None:
+            self.logger.info('"POST", %s, %s%s with: %s answered from the quote cache', getattr(doc, 'DocCode', None), self.url, stem, self._logged(data))
+            self.recorder.success(doc)
+        return tax_resp
+
+    def _finish_post_tax(self, doc, stem, data, resp):
         tax_resp = PostTaxResponse(resp)
-        self.logger.info('"POST", %s, %s%s with: %s' % (getattr(doc, 'DocCode', None), self.url, stem, data))
+        self.logger.info('"POST", %s, %s%s with: %s', getattr(doc, 'DocCode', None), self.url, stem, self._logged(data))
+        if self.quote_cache is not None:
+            self.quote_cache.remember(doc, data, tax_resp)
+        if self.rate_index is not None:
+            self.rate_index.observe(doc, tax_resp)
         if not hasattr(doc, 'DocCode'):
             doc.update_doc_code_from_response(tax_resp)
         self.recorder.success(doc)
         return tax_resp
 
+    def post_tax_many(self, docs, commit=False, max_workers=None, priority=PRIORITY_BULK):
+        """Performs post_tax for every document (or dictionary) in docs, running up
+        to max_workers calls at once (defaults to the connection pool size).
+        Returns a list in the same order as docs, holding a PostTaxResponse or an
+        ErrorResponse for each document. A failing document never stops the batch,
+        exceptions are returned as ErrorResponse.from_exception responses.
+        docs is read as the pool makes its way through them, so it can be a
+        generator. The calls are made with bulk priority for the rate limiter by default"""
+        max_workers = max_workers or self.pool_maxsize
+        window = threading.BoundedSemaphore(2 * max_workers)  # documents handed to the pool and not posted yet
+        post = functools.partial(self._post_tax_one, commit=commit, priority=priority)
+        futures = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for doc in docs:
+                window.acquire()
+                future = executor.submit(post, doc)
+                future.add_done_callback(lambda future: window.release())
+                futures.append(future)
+        return [future.result() for future in futures]
+
+    def _post_tax_one(self, doc, commit, priority):
+        self._local.priority = priority  # the executor's threads only work for this batch
+        try:
+            if isinstance(doc, dict):
+                doc = Document.from_data(doc)
+            return self.post_tax(doc, commit=commit)
+        except Exception as e:  # whatever it is, it only fails this document
+            self._log_post_tax_failure(doc, e)
+            resp = ErrorResponse.from_exception(e)
+            if isinstance(doc, Document):
+                self.recorder.failure(doc, resp)
+            return resp
+
+    def _log_post_tax_failure(self, doc, e):
+        if isinstance(e, AvalaraBaseException):
+            self.logger.warning('%s post_tax failed: %r' % (getattr(doc, 'DocCode', None), e))
+        else:  # not one of ours, keep the traceback
+            self.logger.exception('%s post_tax failed: %r' % (getattr(doc, 'DocCode', None), e))
+
     @except_500_and_return
     def cancel_tax(self, doc, reason=None, doc_id=None):
         """Performs a HTTP POST to tax/cancel/"""
+        doc, stem, data = self._prepare_cancel_tax(doc, reason, doc_id)
+        resp = self._post(stem, data, retry=False)  # a repeated cancel fails with an invalid DocStatus
+        return self._finish_cancel_tax(doc, stem, data, resp)
+
+    def _prepare_cancel_tax(self, doc, reason, doc_id):
         if isinstance(doc, dict):
             doc = Document.from_data(doc)
         elif not isinstance(doc, Document):
@@ -128,7 +240,9 @@ class API(BaseAPI):
             _doc_id = doc_id
         if _doc_id:
             data.update({'DocId': _doc_id})
-        resp = self._post(stem, data)
+        return doc, stem, data
+
+    def _finish_cancel_tax(self, doc, stem, data, resp):
         self.logger.info('"POST", %s, %s%s with: %s' % (getattr(doc, 'DocCode', None), self.url, stem, data))
         self.recorder.success(doc)
         return CancelTaxResponse(resp)
@@ -136,14 +250,36 @@ class API(BaseAPI):
     @except_500_and_return
     def validate_address(self, address):
         """Performs a HTTP GET to address/validate/"""
+        address, stem, data = self._prepare_validate_address(address)
+        validated = self._cached_validate_address(address, stem, data)
+        if validated is None:
+            resp = self._get(stem, data)
+            validated = self._finish_validate_address(address, stem, data, resp)
+        return validated
+
+    def _prepare_validate_address(self, address):
         if isinstance(address, dict):
             address = Address.from_data(address)
         elif not isinstance(address, Address):
             raise AvalaraTypeException(AvalaraException.CODE_BAD_ADDRESS, 'Please pass an address or a dictionary to create an Address')
         stem = '/'.join([self.VERSION, 'address', 'validate'])
-        resp = self._get(stem, address.todict())
-        self.logger.info('"GET", %s%s with: %s' % (self.url, stem, address.todict()))
-        return ValidateAddressResponse(resp)
+        return address, stem, address.todict()
+
+    def _cached_validate_address(self, address, stem, data):
+        """The ValidateAddressResponse from the address cache, if there is one and it has this address"""
+        if self.address_cache is None:
+            return None
+        validated = self.address_cache.response(address)
+        if validated is not None:
+            self.logger.info('"GET", %s%s with: %s answered from the address cache' % (self.url, stem, data))
+        return validated
+
+    def _finish_validate_address(self, address, stem, data, resp):
+        self.logger.info('"GET", %s%s with: %s' % (self.url, stem, data))
+        validated = ValidateAddressResponse(resp)
+        if self.address_cache is not None:
+            self.address_cache.remember(address, validated)
+        return validated
 
 
 class GetTaxResponse(BaseResponse):
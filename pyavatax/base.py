@@ -1,9 +1,17 @@
+import array
+import collections
 import datetime
 import logging
 import json
+import random
+import re
+import threading
+import time
+import types
 import six
 
 import requests
+from requests.adapters import HTTPAdapter
 from pyavatax.django_integration import get_django_recorder
 
 
@@ -19,6 +27,16 @@ def str_to_class(klassname):
     raise TypeError("%s is not a class." % klassname)
 
 
+def response_json(response):
+    """Parses the JSON body of an HTTP response. The result is kept on the response,
+    so the response objects and exceptions built from it never parse it again"""
+    try:
+        return response._pyavatax_json
+    except AttributeError:
+        data = response._pyavatax_json = response.json()
+        return data
+
+
 def isiterable(foo):
     try:
         iter(foo)
@@ -30,55 +48,330 @@ def isiterable(foo):
 
 class AvalaraLogging(object):
     logger = None
+    _lock = threading.Lock()
 
     @staticmethod
     def get_logger():
         if not AvalaraLogging.logger:
-            AvalaraLogging.logger = logging.getLogger('pyavatax.api')
+            with AvalaraLogging._lock:
+                if not AvalaraLogging.logger:
+                    AvalaraLogging.logger = logging.getLogger('pyavatax.api')
         return AvalaraLogging.logger
 
     @staticmethod
     def set_logger(logger):
         if isinstance(logger, logging.Logger):
-            AvalaraLogging.logger = logger
+            with AvalaraLogging._lock:
+                AvalaraLogging.logger = logger
         else:
             raise AvalaraException('Please pass an object inheriting from logging.Logger')
 
 
+def _unique(names):
+    seen = []
+    for name in names:
+        if name not in seen:
+            seen.append(name)
+    return seen
+
+
+def _lazy_getattr(self, name):
+    """Only called when an attribute isn't found: builds a lazy _contains list on first read,
+    from the values _pending holds for it, if any"""
+    if name in self._contains_set:
+        pending = self._pending
+        values = pending.pop(name, ()) if pending else ()
+        if pending is not None and not pending:
+            self._pending = None  # no empty dict left on every object
+        objs = self._decode_contained(name, values) if self.allow_new_fields else self._build_contained(name, values)
+        setattr(self, name, objs)
+        return objs
+    raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+
+class _SparseField(object):
+    """A field of a _compact class that is rarely set, kept in the object's _sparse_values
+    dict rather than in a slot of its own. The dict is only made when one is set"""
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, klass=None):
+        if obj is None:
+            return self
+        try:
+            return obj._sparse_values[self.name]
+        except (AttributeError, KeyError):
+            raise AttributeError("'%s' object has no attribute '%s'" % (obj.__class__.__name__, self.name))
+
+    def __set__(self, obj, value):
+        try:
+            obj._sparse_values[self.name] = value
+        except AttributeError:
+            object.__setattr__(obj, '_sparse_values', {self.name: value})
+
+    def __delete__(self, obj):
+        try:
+            values = obj._sparse_values
+            del values[self.name]
+        except (AttributeError, KeyError):
+            raise AttributeError(self.name)
+        if not values:
+            object.__delattr__(obj, '_sparse_values')
+
+
+def _is_built(obj, name):
+    """hasattr, without building a lazy _contains list"""
+    try:
+        object.__getattribute__(obj, name)
+    except AttributeError:
+        return False
+    return True
+
+
+def _compile_decoder(cls):
+    """Returns a function building a cls from a decoded AvaTax response dict (or filling
+    in the cls it is given). Nothing is looked up per key but the key itself: nested
+    objects are built by their own class' decoder, unknown keys kept in extra_fields,
+    and only classes with cleaners are cleaned"""
+    fields, has, contains = cls._field_set, cls._has_set, cls._contains_set
+    lazy = cls._lazy_contains
+    cleaned = bool(cls._cleaners) or any('clean_me' in vars(klass) for klass in cls.__mro__ if klass is not AvalaraBase)
+    new = cls.__new__
+
+    def decode(data, obj=None):
+        if obj is None:
+            obj = new(cls)
+        obj._extra = ()  # allow_new_fields, without the property call
+        if lazy:
+            obj._pending = None
+        else:
+            for f in contains:
+                setattr(obj, f, [])
+        if fields.issuperset(data):  # only plain fields, like most nested response objects
+            for k, v in data.items():
+                setattr(obj, k, v)
+            items = ()
+        else:
+            items = data.items()
+        for k, v in items:
+            if k in fields:
+                setattr(obj, k, v)
+            elif k in contains:
+                if lazy:
+                    if v:  # built on first read, by _decode_contained
+                        if obj._pending is None:
+                            obj._pending = {}
+                        obj._pending[k] = v  # the parsed list, copied when it is built or extended
+                else:
+                    getattr(obj, k).extend(obj._decode_contained(k, v))
+            elif k in has:
+                if isinstance(v, dict):
+                    setattr(obj, k, obj._nested_class(k).decoder()(v))
+                elif isinstance(v, obj._nested_class(k)):
+                    setattr(obj, k, v)
+            else:
+                obj._invalid_field(k, v)
+        if cleaned:
+            obj.clean(None, ())
+        return obj
+    return decode
+
+
+class AvalaraSchema(type):
+    """Compiles a model's _fields, _has and _contains into lookup tables once, when
+    the class is defined, so update, clean and todict don't have to scan them.
+
+    A class setting _compact = True gets __slots__ for its schema, for the objects a
+    large response holds thousands of, instead of an instance __dict__. The fields it
+    lists in _sparse get no slot: the few objects that have them keep them in a dict.
+
+    Classes with _lazy_contains get a __getattr__ that builds their _contains
+    lists on first read. Other classes don't have one, as it would slow down
+    every getattr/hasattr of a field that isn't set"""
+
+    def __new__(mcs, name, bases, namespace):
+        if namespace.get('_compact') and '__slots__' not in namespace:
+            def declared(attr):
+                return namespace.get(attr, getattr(bases[0], attr, []))
+            sparse = declared('_sparse')
+            slots = ['_extra', '_logger'] + [f for f in _unique(declared('_fields')) if f not in sparse] + list(declared('_has')) + list(declared('_contains'))
+            if declared('_lazy_contains'):
+                slots.append('_pending')
+            if sparse:
+                slots.append('_sparse_values')
+                namespace.update((f, _SparseField(f)) for f in sparse)
+            namespace['__slots__'] = tuple(s for s in slots if not any(isinstance(getattr(base, s, None), types.MemberDescriptorType) for base in bases))  # not already a slot
+        return super(AvalaraSchema, mcs).__new__(mcs, name, bases, namespace)
+
+    def __init__(cls, name, bases, namespace):
+        super(AvalaraSchema, cls).__init__(name, bases, namespace)
+        fields = _unique(cls._fields)
+        cls._field_order = tuple(fields)  # serialization order, without repeats
+        cls._field_set = frozenset(fields)
+        cls._has_set = frozenset(cls._has)
+        cls._contains_set = frozenset(cls._contains)
+        cls._cleaner_fields = tuple(f for f in fields if hasattr(cls, 'clean_%s' % f))
+        cls._cleaners = tuple(getattr(cls, 'clean_%s' % f) for f in cls._cleaner_fields)
+        cls._nested = {}  # field -> class, filled in on first use as the classes may be defined further down
+        cls._defaults = None  # the fields cleaning fills in on an empty object, see from_trusted_data
+        cls._decoder = None  # see decoder()
+        if cls._lazy_contains and '__getattr__' not in namespace:
+            cls.__getattr__ = _lazy_getattr
+
+
+@six.add_metaclass(AvalaraSchema)
 class AvalaraBase(object):
     """Base object for parsing and outputting json"""
     _fields = []  # a list of simple attributes on this object
     _contains = []  # a list of other objects contained by this object
     _has = []  # a list of single objects contained by this object
+    _lazy_contains = False  # build the _contains objects when they are first read, rather than in update
+    _compact = False  # use __slots__, see AvalaraSchema
+    _sparse = []  # the _fields a _compact class keeps out of its slots
+    _testing_ignore_validate = False
+    __slots__ = ()  # so that _compact subclasses really have no __dict__
 
     def __init__(self, allow_new_fields=False, *args, **kwargs):
         self._setup()
         self.allow_new_fields = allow_new_fields
-        self.logger = AvalaraLogging.get_logger()
-        self.update(**kwargs)
+        self._update(kwargs, initial=True)
+
+    @property
+    def logger(self):
+        return getattr(self, '_logger', None) or AvalaraLogging.get_logger()
+
+    @logger.setter
+    def logger(self, logger):
+        self._logger = logger
+
+    @property
+    def allow_new_fields(self):
+        """Whether fields outside the schema are kept in extra_fields, rather than refused.
+        Kept in _extra, which is None when they are refused, () until one is kept, and
+        the dict of the kept fields after that"""
+        return getattr(self, '_extra', None) is not None
+
+    @allow_new_fields.setter
+    def allow_new_fields(self, allow):
+        extra = getattr(self, '_extra', None)
+        if allow:
+            if extra is None:
+                self._extra = ()
+        elif extra:
+            raise AvalaraException(AvalaraException.CODE_INVALID_FIELD, 'allow_new_fields can not be turned off once a new field was kept')
+        else:
+            self._extra = None
 
     def _setup(self):
         """Initiate lists for objects contained within this object"""
+        if self._lazy_contains:
+            self._pending = None  # the values of the _contains lists not built yet, see _lazy_getattr
+            return
         for field in self._contains:
             setattr(self, field, [])
 
+    @classmethod
+    def from_trusted_data(cls, data):
+        """Builds the object, and any it contains, from data that has already been
+        validated (e.g. it comes from your own order database) without cleaning or
+        checking any field. The values should be what the cleaners would have made
+        of them: numbers rather than strings of digits, for instance. Fields the
+        cleaners give defaults to (Qty, Discount...) get the same defaults, so todict()
+        returns what it would have for the same data through from_data.
+        Call validate() (or Document.validate_many) when you do want the checks"""
+        defaults = cls._defaults
+        if defaults is None:
+            blank = cls()
+            defaults = cls._defaults = dict((f, getattr(blank, f)) for f in cls._field_order if hasattr(blank, f))
+        obj = cls.__new__(cls)
+        obj._setup()
+        obj.allow_new_fields = False
+        values = dict(defaults)
+        values.update(data)
+        fields, has, contains = cls._field_set, cls._has_set, cls._contains_set
+        for k, v in six.iteritems(values):
+            if k in fields:
+                setattr(obj, k, v)
+            elif k in has:
+                klass = obj._nested_class(k)
+                setattr(obj, k, v if isinstance(v, klass) else klass.from_trusted_data(v))
+            elif k in contains:
+                if isinstance(v, LineTable):
+                    setattr(obj, k, v)
+                    continue
+                klass = obj._nested_class(k)
+                getattr(obj, k).extend(_v if isinstance(_v, klass) else klass.from_trusted_data(_v) for _v in v)
+            else:
+                obj._invalid_field(k, v)
+        return obj
+
+    def _nested_class(self, k):
+        """The class of the _has or _contains field k"""
+        try:
+            return self._nested[k]
+        except KeyError:
+            klass = self._nested[k] = str_to_class(self._handle_pluralize(k))
+            return klass
+
+    def _build_contained(self, k, values):
+        klass = self._nested_class(k)
+        objs = []
+        for _v in values:
+            if isinstance(_v, klass):
+                objs.append(_v)
+            elif isinstance(_v, dict):
+                objs.append(klass(allow_new_fields=self.allow_new_fields, **_v))
+        return objs
+
+    @classmethod
+    def decoder(cls):
+        """The function building this class from AvaTax's JSON, see _compile_decoder.
+        It tolerates unknown fields, as objects made with allow_new_fields=True do"""
+        decoder = cls.__dict__.get('_decoder')
+        if decoder is None:
+            decoder = _compile_decoder(cls)
+            setattr(cls, '_decoder', decoder)
+        return decoder
+
+    def _decode_contained(self, k, values):
+        klass = self._nested_class(k)
+        decode = klass.decoder()
+        return [decode(_v) if isinstance(_v, dict) else _v for _v in values if isinstance(_v, (dict, klass))]
+
     def clean_me(self):
         pass
 
-    def clean(self):
-        if hasattr(self, '_testing_ignore_validate'):
+    def clean(self, fields=None, children=None):
+        """Validate fields, and the objects contained by this one. Checks every field and
+        every contained object unless given the names of the fields and the objects to check"""
+        if self._testing_ignore_validate:
             return  # passthrough for a test
-        """Validate fields"""
-        for f in self._fields:
-            clean_fn = 'clean_%s' % f
-            if hasattr(self, clean_fn):
-                getattr(self, clean_fn)()
-        for f in self._has:
-            if hasattr(self, f):
-                getattr(self, f).clean()
-        for f in self._contains:
-            for v in getattr(self, f):
-                v.clean()
+        if fields is None:
+            for clean_fn in self._cleaners:
+                clean_fn(self)
+        elif fields:
+            for f, clean_fn in zip(self._cleaner_fields, self._cleaners):
+                if f in fields:
+                    clean_fn(self)
+        if children is None:
+            for f in self._has:
+                obj = getattr(self, f, None)
+                if obj is not None:
+                    obj.clean()
+            for f in self._contains:
+                if self._lazy_contains and not _is_built(self, f):
+                    continue  # lazy objects not built yet are cleaned as they are built
+                objs = getattr(self, f)
+                if isinstance(objs, LineTable):
+                    objs.clean()
+                    continue
+                for v in objs:
+                    v.clean()
+        else:
+            for obj in children:
+                obj.clean()
         """Validate myself if I need to check fields"""
         self.clean_me()
 
@@ -87,59 +380,565 @@ class AvalaraBase(object):
         _k = 'Line' if k == 'Lines' else _k
         return _k
 
-    def _invalid_field(self, field):
+    def _invalid_field(self, field, value=None):
         msg = AvalaraException.CODE_INVALID_FIELD, '%s is not a valid field' % field
         self.logger.warning(msg)  # development environments will have a test failure when logs don't match expected outcomes
         if not self.allow_new_fields:
             raise AvalaraException(msg)  # incoming data from avalara allows new fields, so as to not break if they ship an update without incrementing API versions
+        if not self._extra:
+            self._extra = {}
+        self._extra[field] = value
+
+    @property
+    def extra_fields(self):
+        """The fields outside the schema that were kept because of allow_new_fields"""
+        return getattr(self, '_extra', None) or {}
 
     def update(self, *args, **kwargs):
-        """Updates kwargs onto attributes of self"""
+        """Updates kwargs onto attributes of self. Only the fields and objects
+        passed in are validated again, validate() or todict() check everything"""
+        self._update(kwargs)
+
+    def _update(self, kwargs, initial=False):
+        fields, has, contains = self._field_set, self._has_set, self._contains_set
+        changed = []
+        children = []  # objects passed in, rather than built here (which cleans them)
         for k, v in six.iteritems(kwargs):
-            if k in self._fields:
+            if k in fields:
                 setattr(self, k, v)
-            elif k in self._has:  # has an object
-                klass = str_to_class(self._handle_pluralize(k))
+                changed.append(k)
+            elif k in has:  # has an object
+                klass = self._nested_class(k)
                 if isinstance(v, klass):
                     setattr(self, k, v)
+                    children.append(v)
                 elif isinstance(v, dict):
                     setattr(self, k, klass(allow_new_fields=self.allow_new_fields, **v))
-            elif k in self._contains:  # contains many objects
-                klass = str_to_class(self._handle_pluralize(k))
-                for _v in v:
-                    if isinstance(_v, klass):
-                        getattr(self, k).append(_v)
-                    elif isinstance(_v, dict):
-                        getattr(self, k).append(klass(allow_new_fields=self.allow_new_fields, **_v))
+            elif k in contains:  # contains many objects
+                if self._lazy_contains and not _is_built(self, k):
+                    pending = self._pending
+                    if pending is None:
+                        pending = self._pending = {}
+                    pending[k] = list(pending.get(k, ())) + list(v)
+                elif isinstance(getattr(self, k), LineTable):
+                    getattr(self, k).extend(v)
+                elif isinstance(v, LineTable):
+                    if getattr(self, k):
+                        raise AvalaraException(AvalaraException.CODE_BAD_LINE, 'A LineTable can only replace %s that are still empty' % k)
+                    setattr(self, k, v)
+                else:
+                    getattr(self, k).extend(self._build_contained(k, v))
+                    children.extend(_v for _v in v if isinstance(_v, AvalaraBase))
             else:
-                self._invalid_field(k)
-        self.clean()
+                self._invalid_field(k, v)
+        self.clean(None if initial else changed, children)  # a new object runs every cleaner, filling in defaults such as TaxOverrideType
 
     def todict(self):
         """Returns a dict of attributes on object"""
         if hasattr(self, 'validate') and not hasattr('self', '_testing_ignore_validate'):
             self.validate()
-        data = {}
-        for f in self._fields:
-            if hasattr(self, f):
-                v = getattr(self, f)
-                if isinstance(v, datetime.date) or isinstance(v, datetime.datetime):
-                    v = v.isoformat()
-                data[f] = v
+        data = self._todict_fields()
         for f in self._has:
-            if hasattr(self, f):
-                obj = getattr(self, f)
+            obj = getattr(self, f, None)
+            if obj is not None:
                 data[f] = obj.todict()
         for f in self._contains:
-            if isiterable(getattr(self, f)):
-                data[f] = []
-                for obj in getattr(self, f):
-                    data[f].append(obj.todict())
+            objs = getattr(self, f)
+            if isiterable(objs) and not isinstance(objs, LineTable):
+                data[f] = [obj.todict() for obj in objs]
             else:
-                data[f] = obj.todict()
+                data[f] = objs.todict()
+        return data
+
+    def _todict_fields(self):
+        data = {}
+        missing = data  # a sentinel no field can hold
+        for f in self._field_order:
+            v = getattr(self, f, missing)
+            if v is not missing:
+                if isinstance(v, (datetime.date, datetime.datetime)):
+                    v = v.isoformat()
+                data[f] = v
         return data
 
 
+PRIORITY_INTERACTIVE = 'interactive'  # checkout and other calls someone is waiting on
+PRIORITY_BULK = 'bulk'  # backfills and batch jobs
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+
+def monotonic():
+    """Seconds on a clock that never goes backwards, where available"""
+    return getattr(time, 'monotonic', time.time)()
+
+
+class RetryPolicy(object):
+    """Decides whether, and after how long, a failed call to AvaTax is sent again.
+
+    max_attempts counts the first try. The wait before attempt n is drawn from
+    backoff * 2 ** (n - 2), capped at max_backoff, with jitter (full jitter when
+    jitter is 1.0, no jitter when it is 0). statuses are the retryable HTTP status
+    codes, exceptions the retryable transport exceptions (None retries every
+    exception that makes the server unreachable). deadline is the total number of
+    seconds the call may take across attempts and waits; when set, each attempt's
+    timeout is the remaining budget instead of the API timeout.
+
+    AvaTax reports invalid documents with a 500, so 500 is not retried by default"""
+
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=8.0, jitter=1.0, statuses=RETRY_STATUSES, exceptions=None, deadline=None):
+        if max_attempts < 1:
+            raise AvalaraException(AvalaraException.CODE_BAD_ARGS, 'max_attempts must be at least 1')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = tuple(statuses)
+        self.exceptions = exceptions
+        self.deadline = deadline
+
+    def is_retryable(self, status=None, exception=None):
+        if exception is not None:
+            return self.exceptions is None or isinstance(exception, self.exceptions)
+        return status in self.statuses
+
+    def delay(self, attempt):
+        """Seconds to wait before sending attempt number `attempt` (the first retry is attempt 2)"""
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 2)))
+        return delay * (1 - self.jitter * random.random())
+
+
+class CircuitBreaker(object):
+    """Stops sending calls to AvaTax for a while once it looks down, so callers fail fast.
+
+    The breaker opens after failure_threshold consecutive calls could not reach
+    AvaTax, or when at least min_calls of the last `window` calls were answered
+    and `error_rate` of them got one of `statuses`. While open every call raises
+    AvalaraCircuitOpenException. After reset_timeout seconds it goes half-open and
+    lets a single probe call through: success closes it, failure opens it again.
+    Only the probe decides, calls sent before the breaker opened that end meanwhile
+    are not counted.
+
+    AvaTax reports invalid documents with a 500, so 500 is not counted by default"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    ERROR_STATUSES = (502, 503, 504)
+
+    def __init__(self, failure_threshold=5, error_rate=0.5, window=20, min_calls=10, reset_timeout=30.0, statuses=ERROR_STATUSES):
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.statuses = tuple(statuses)
+        self.state = CircuitBreaker.CLOSED
+        self.logger = AvalaraLogging.get_logger()
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._outcomes = collections.deque(maxlen=window)  # True for an error status
+        self._opened_at = None
+        self._probe = None  # the token before_call handed the probe in flight
+        self._probe_started = None
+
+    def _change_state(self, state, reason):
+        self.logger.warning('AvaTax circuit breaker %s -> %s: %s' % (self.state, state, reason))
+        self.state = state
+        if state == CircuitBreaker.OPEN:
+            self._opened_at = monotonic()
+        elif state == CircuitBreaker.CLOSED:
+            self._consecutive_failures = 0
+            self._outcomes.clear()
+        self._probe = None
+        self._probe_started = None
+
+    def before_call(self):
+        """Raises AvalaraCircuitOpenException unless a call may be sent now. Returns the
+        token to pass to record when the call is the half-open probe, None otherwise"""
+        with self._lock:
+            now = monotonic()
+            if self.state == CircuitBreaker.OPEN:
+                retry_in = self._opened_at + self.reset_timeout - now
+                if retry_in > 0:
+                    raise AvalaraCircuitOpenException(retry_in)
+                self._change_state(CircuitBreaker.HALF_OPEN, 'sending a probe after %.1fs' % self.reset_timeout)
+            if self.state == CircuitBreaker.HALF_OPEN:
+                # a probe that never reported back must not hold the breaker half-open forever
+                if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                    raise AvalaraCircuitOpenException(self._probe_started + self.reset_timeout - now)
+                self._probe = object()
+                self._probe_started = now
+                return self._probe
+        return None
+
+    def record(self, status=None, exception=None, probe=None):
+        """Records how a call ended: the HTTP status it was answered with, or the exception
+        that kept it from AvaTax. probe is what before_call returned for the call"""
+        with self._lock:
+            failed = exception is not None or status in self.statuses
+            if self.state != CircuitBreaker.CLOSED:
+                if probe is None or probe is not self._probe:
+                    return  # sent before the breaker opened, or a probe that was given up on
+                if failed:
+                    self._change_state(CircuitBreaker.OPEN, 'probe failed with %s' % (status or repr(exception)))
+                else:
+                    self._change_state(CircuitBreaker.CLOSED, 'probe succeeded')
+                return
+            if exception is not None:
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= self.failure_threshold:
+                    self._change_state(CircuitBreaker.OPEN, '%d consecutive calls could not reach AvaTax' % self._consecutive_failures)
+                return
+            self._consecutive_failures = 0
+            self._outcomes.append(failed)
+            if failed and len(self._outcomes) >= self.min_calls:
+                rate = float(sum(self._outcomes)) / len(self._outcomes)
+                if rate >= self.error_rate:
+                    self._change_state(CircuitBreaker.OPEN, '%d%% of the last %d calls failed' % (rate * 100, len(self._outcomes)))
+
+
+class SingleFlight(object):
+    """Coalesces identical calls made at the same time: the first goes to AvaTax, the
+    others wait for it and share its response, or its exception. Only calls that
+    are safe to send twice (see RetryPolicy) are coalesced, keyed by account,
+    method, URL, parameters and body. coalesced counts the calls that never went
+    out. One SingleFlight can be shared by several API objects"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Flight
+        self._futures = {}  # key -> asyncio future, see do_async
+        self.coalesced = 0
+
+    @staticmethod
+    def key(username, http_method, url, params, body):
+        return (username, http_method, url, repr(sorted(params.items())), body)
+
+    def do(self, key, fn):
+        """Returns fn(), or what the identical call already in flight returns"""
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            flight.done.set()
+        return flight.result
+
+    def do_async(self, key, fn):
+        """do, for asyncio: returns a future for what awaiting fn() returns, or the
+        identical call already in flight returns. Keys should tell event loops apart.
+        Cancelling the caller of the call in flight only cancels that caller: one of
+        the callers waiting for it then makes the call instead. Call it on the running
+        event loop, from a coroutine or a callback"""
+        import asyncio
+        waiter = asyncio.get_running_loop().create_future()
+        self._join_async(key, fn, waiter, retry=False)
+        return waiter
+
+    def _join_async(self, key, fn, waiter, retry):
+        import asyncio
+        loop = asyncio.get_running_loop()  # the waiter's, do_async or settled runs on it
+        with self._lock:
+            flight = self._futures.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._futures[key] = loop.create_future()
+                if retry:
+                    self.coalesced -= 1  # it goes out after all
+            elif not retry:
+                self.coalesced += 1
+        if leader:
+            task = loop.create_task(fn())
+
+            def finished(task):
+                with self._lock:
+                    del self._futures[key]
+                if task.cancelled():
+                    flight.cancel()  # the callers waiting for it retry, see settled
+                    if not waiter.done():
+                        waiter.cancel()
+                    return
+                e = task.exception()
+                if e is not None:
+                    flight.set_exception(e)
+                    flight.exception()  # retrieved, there may be no one waiting for it
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                else:
+                    flight.set_result(task.result())
+                    if not waiter.done():
+                        waiter.set_result(task.result())
+            task.add_done_callback(finished)
+            waiter.add_done_callback(lambda waiter: task.cancel() if waiter.cancelled() else None)
+            return
+
+        def settled(flight):
+            if waiter.done():
+                return  # its own caller was cancelled meanwhile
+            if flight.cancelled():
+                self._join_async(key, fn, waiter, retry=True)  # the first caller here leads the next call
+            elif flight.exception() is not None:
+                waiter.set_exception(flight.exception())
+            else:
+                waiter.set_result(flight.result())
+        flight.add_done_callback(settled)
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'exception')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+_ESCAPED_CONTROL_CHARACTERS = re.compile(r'\\[rtn]')
+_ESCAPED_CONTROL_CHARACTERS_BYTES = re.compile(br'\\[rtn]')
+
+
+class JSONFragment(dict):
+    """A dict that keeps its own JSON, made once per serializer. When one is in a list
+    in the request data (e.g. an InternedAddress in Addresses) the serializers splice
+    that JSON into the body instead of encoding the dict again"""
+    __slots__ = ('_encoded',)
+
+    def __init__(self, *args, **kwargs):
+        super(JSONFragment, self).__init__(*args, **kwargs)
+        self._encoded = {}
+
+    def encoded(self, serializer):
+        key = serializer.__class__
+        try:
+            return self._encoded[key]
+        except KeyError:
+            body = self._encoded[key] = serializer._dumps(dict(self))
+            return body
+
+
+_FRAGMENT_PLACEHOLDER = u'\ufffepyavatax-fragment-%d'  # a noncharacter, never in real data
+
+
+def _take_fragments(data):
+    """Returns data with the JSONFragments in its lists swapped for placeholders, and the fragments"""
+    fragments = []
+    if not isinstance(data, dict):
+        return data, fragments
+    swapped = None
+    for k, v in six.iteritems(data):
+        if not isinstance(v, list):
+            continue
+        items = None
+        for i, item in enumerate(v):
+            if isinstance(item, JSONFragment):
+                if items is None:
+                    items = list(v)
+                items[i] = _FRAGMENT_PLACEHOLDER % len(fragments)
+                fragments.append(item)
+        if items is not None:
+            if swapped is None:
+                swapped = dict(data)
+            swapped[k] = items
+    return (data if swapped is None else swapped), fragments
+
+
+class JSONSerializer(object):
+    """Turns request data into the body sent to AvaTax: json.dumps' output with the
+    escaped carriage returns, tabs and newlines AvaTax errors out on replaced by
+    spaces. The payload is scanned once, and not at all when nothing is escaped"""
+
+    def dumps(self, data):
+        data, fragments = _take_fragments(data)
+        body = self._dumps(data)
+        for i, fragment in enumerate(fragments):
+            body = body.replace(self._placeholder(i), fragment.encoded(self), 1)
+        return body
+
+    def _placeholder(self, i):
+        try:
+            return self._placeholders[i]
+        except AttributeError:
+            self._placeholders = []
+        except IndexError:
+            pass
+        while len(self._placeholders) <= i:
+            self._placeholders.append(self._dumps(_FRAGMENT_PLACEHOLDER % len(self._placeholders)))
+        return self._placeholders[i]
+
+    def _dumps(self, data):
+        text = json.dumps(data)
+        if '\\' in text:
+            text = _ESCAPED_CONTROL_CHARACTERS.sub(' ', text)
+        return text.encode('ascii')  # json.dumps only writes ASCII
+
+    chunk_size = 65536
+
+    def encode(self, obj, validate=True):
+        """Returns dumps(obj.todict()) for a Document or other AvalaraBase object, made
+        straight from the objects without building the dicts"""
+        return b''.join(self.iterencode(obj, validate=validate))
+
+    def iterencode(self, obj, validate=True):
+        """Yields the body encode(obj) returns in chunks of about chunk_size bytes.
+        Documents are validated first, as todict does, unless validate is False"""
+        if validate and hasattr(obj, 'validate'):
+            obj.validate()
+        pieces = []
+        size = 0
+        for piece in self._iterencode_object(obj):
+            pieces.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield ''.join(pieces).encode('ascii')
+                pieces = []
+                size = 0
+        if pieces:
+            yield ''.join(pieces).encode('ascii')
+
+    def _iterencode_object(self, obj):
+        """Yields the JSON text of obj in the order todict puts its keys: fields, has, contains"""
+        if isinstance(obj, InternedAddress):
+            yield obj.todict().encoded(self).decode('ascii')
+            return
+        encode = self._encode_value
+        missing = obj  # a sentinel no field can hold
+        fields = []
+        for f in obj._field_order:
+            v = getattr(obj, f, missing)
+            if v is not missing:
+                fields.append('"%s": %s' % (f, encode(v)))
+        yield '{' + ', '.join(fields)
+        separator = ', ' if fields else ''
+        for f in obj._has:
+            child = getattr(obj, f, None)
+            if child is not None:
+                yield '%s"%s": ' % (separator, f)
+                for piece in self._iterencode_object(child):
+                    yield piece
+                separator = ', '
+        for f in obj._contains:
+            yield '%s"%s": [' % (separator, f)
+            children = getattr(obj, f)
+            if isinstance(children, LineTable):
+                for piece in self._iterencode_line_table(children):
+                    yield piece
+            else:
+                for i, child in enumerate(children):
+                    if i:
+                        yield ', '
+                    for piece in self._iterencode_object(child):
+                        yield piece
+            yield ']'
+            separator = ', '
+        yield '}'
+
+    def _iterencode_line_table(self, table):
+        encode = self._encode_value
+        keys = ['"%s": ' % f for f in Line._field_order]
+        separator = '{'
+        for values in zip(*[table.columns[f] for f in Line._field_order]):
+            yield separator + ', '.join([k + encode(v) for k, v in zip(keys, values) if v is not None]) + '}'
+            separator = ', {'
+
+    def _encode_value(self, v):
+        if isinstance(v, six.string_types):
+            text = _encode_string(v)
+        elif v is None:
+            return 'null'
+        elif v is True:
+            return 'true'
+        elif v is False:
+            return 'false'
+        elif isinstance(v, float) and v - v == 0:  # not nan or infinite
+            return float.__repr__(v)
+        elif isinstance(v, six.integer_types):
+            return int.__repr__(v)
+        elif isinstance(v, (datetime.date, datetime.datetime)):
+            text = _encode_string(v.isoformat())
+        else:
+            text = json.dumps(v)
+        if '\\' in text:
+            text = _ESCAPED_CONTROL_CHARACTERS.sub(' ', text)
+        return text
+
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+class StreamedBody(object):
+    """The body of a call whose data is a Document or other AvalaraBase object, encoded
+    while it is sent rather than up front. Each iteration (e.g. a retried attempt)
+    encodes the object again; it was validated once, when the body was made.
+    render() (or str()) encodes the whole body, for error reports and logs"""
+
+    def __init__(self, serializer, obj, validate=True):
+        if validate and hasattr(obj, 'validate'):
+            obj.validate()
+        self.serializer = serializer
+        self.obj = obj
+
+    def __iter__(self):
+        return self.serializer.iterencode(self.obj, validate=False)
+
+    def render(self):
+        """The whole body, as the bytes that are sent"""
+        return b''.join(self)
+
+    def __str__(self):
+        return self.render().decode('utf-8')
+
+    def __repr__(self):
+        return '<StreamedBody %s %s>' % (self.obj.__class__.__name__, getattr(self.obj, 'DocCode', ''))
+
+
+class OrjsonSerializer(JSONSerializer):
+    """Serializes with orjson (pip install pyavatax[orjson]), much faster on large documents.
+    The JSON is equivalent, but not byte-for-byte what JSONSerializer sends: it is
+    compact and UTF-8 encoded rather than ASCII with \\u escapes"""
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            raise AvalaraException(AvalaraException.CODE_BAD_ARGS, 'orjson is not installed')
+        self.orjson = orjson
+
+    def _dumps(self, data):
+        body = self.orjson.dumps(data)
+        if b'\\' in body:
+            body = _ESCAPED_CONTROL_CHARACTERS_BYTES.sub(b' ', body)
+        return body
+
+    def iterencode(self, obj, validate=True):
+        """orjson encodes the whole dict tree faster than the objects can be walked,
+        so this yields dumps(obj.todict()) in one chunk. It always validates"""
+        yield self.dumps(obj.todict())
+
+
+def fastest_serializer():
+    """Returns an OrjsonSerializer when orjson is installed, a JSONSerializer otherwise"""
+    try:
+        return OrjsonSerializer()
+    except AvalaraException:
+        return JSONSerializer()
+
+
 class BaseAPI(object):
     """Handles HTTP and requests library"""
 
@@ -148,52 +947,96 @@ class BaseAPI(object):
     DEVELOPMENT_HOST = None
     protocol = 'https'
     default_timeout = 10.0
+    default_pool_connections = 10  # number of per-host connection pools to cache
+    default_pool_maxsize = 10  # number of keep-alive connections saved in each host pool
+    default_pool_block = False  # when True, never open more than pool_maxsize connections to one host
     logger = None
 
-    def __init__(self, username=None, password=None, live=False, timeout=None, proxies={}, recorder=None, **kwargs):
+    def __init__(self, username=None, password=None, live=False, timeout=None, proxies={}, recorder=None, pool_connections=None, pool_maxsize=None, pool_block=None, retry_policy=None, circuit_breaker=None, rate_limiter=None, priority=PRIORITY_INTERACTIVE, serializer=None, stream_body=False, single_flight=None, **kwargs):
         self.host = self.PRODUCTION_HOST if live else self.DEVELOPMENT_HOST  # from the child API class
-        self.url = "%s://%s" % (BaseAPI.protocol, self.host)
+        self.url = "%s://%s" % (self.protocol, self.host)
         self.username = username
-        self.proxies = proxies
-        self.headers = BaseAPI.default_headers.update({'Host': self.host})
+        self.proxies = dict(proxies)
+        self.headers = dict(self.default_headers, Host=self.host)
         self.password = password
         self.timeout = timeout or BaseAPI.default_timeout
         self.logger = AvalaraLogging.get_logger()
         if recorder is None:
             recorder = get_django_recorder()
         self.recorder = recorder
+        self.pool_connections = pool_connections or BaseAPI.default_pool_connections
+        self.pool_maxsize = pool_maxsize or BaseAPI.default_pool_maxsize
+        self.pool_block = BaseAPI.default_pool_block if pool_block is None else pool_block
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.single_flight = single_flight
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.serializer = serializer or JSONSerializer()
+        self.stream_body = stream_body
+        self._adapter = None
+        self._adapter_lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-    def _get(self, stem, data):
-        return self._request('GET', stem, params=data)
-
-    def _post(self, stem, data, params={}):
-        return self._request('POST', stem, params=params, data=data)
+    @property
+    def session(self):
+        """The requests.Session the calling thread sends with. Each thread gets its
+        own Session, all of them share one keep-alive connection pool"""
+        adapter = self.adapter
+        session = getattr(self._local, 'session', None)
+        if session is None or session.adapters.get('https://') is not adapter:
+            session = self._local.session = self._new_session(adapter)
+        return session
 
-    def _request(self, http_method, stem, data={}, params={}):
-        url = '%s/%s' % (self.url, stem)
-        data = json.dumps(data)
+    @property
+    def adapter(self):
+        """The HTTPAdapter holding the connection pool, created on first use"""
+        adapter = self._adapter
+        if adapter is None:
+            with self._adapter_lock:
+                if self._adapter is None:
+                    self._adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, pool_block=self.pool_block)
+                adapter = self._adapter
+        return adapter
+
+    def _new_session(self, adapter):
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        """Closes any pooled connections. The API object may still be used afterwards, a new pool is created on the next call"""
+        with self._adapter_lock:
+            adapter, self._adapter = self._adapter, None
+        if adapter is not None:
+            adapter.close()
+
+    def _get(self, stem, data, retry=True):
+        return self._request('GET', stem, params=data, retry=retry)
+
+    def _post(self, stem, data, params={}, retry=True):
+        return self._request('POST', stem, params=params, data=data, retry=retry)
+
+    def _encode_data(self, data):
         # getting rid of control characters
         # that JSON will error out on
-        data = data.replace('\\r', ' ')
-        data = data.replace('\\t', ' ')
-        data = data.replace('\\n', ' ')
-        kwargs = {
-            'params': params,
-            'headers': self.headers,
-            'auth': (self.username, self.password),
-            'proxies': self.proxies,
-            'timeout': self.timeout
-        }
-        resp = None
-        try:
-            if http_method == 'GET':
-                resp = requests.get(url, **kwargs)
-            elif http_method == 'POST':
-                kwargs.update({'data': data})
-                resp = requests.post(url, **kwargs)
-        except (requests.exceptions.ConnectionError, requests.exceptions.SSLError, requests.exceptions.HTTPError, requests.exceptions.Timeout) as e:
-            self.logger.warning(e)
-            raise AvalaraServerNotReachableException(e)
+        if isinstance(data, AvalaraBase):
+            return StreamedBody(self.serializer, data)
+        return self.serializer.dumps(data)
+
+    def _logged(self, data):
+        """data as it is logged: an object sent with stream_body as the JSON it is sent
+        as, only encoded when the line is logged"""
+        return StreamedBody(self.serializer, data, validate=False) if isinstance(data, AvalaraBase) else data
+
+    def _check_response(self, resp):
         if resp.status_code == requests.codes.ok:
             if resp.json is None:
                 raise AvalaraServerDetailException(resp)
@@ -201,6 +1044,102 @@ class BaseAPI(object):
         else:
             raise AvalaraServerDetailException(resp)
 
+    def _deadline(self, retry):
+        """When the retry policy's time budget for a call starting now runs out"""
+        if retry and self.retry_policy and self.retry_policy.deadline:
+            return monotonic() + self.retry_policy.deadline
+        return None
+
+    def _attempt_timeout(self, deadline):
+        if deadline is None:
+            return self.timeout
+        return max(deadline - monotonic(), 0.001)
+
+    def _retry_delay(self, stem, attempt, deadline, retry, status=None, exception=None):
+        """Returns how long to wait before attempting the call again, or None if it should not be retried"""
+        policy = self.retry_policy
+        if not retry or policy is None or attempt >= policy.max_attempts:
+            return None
+        if not policy.is_retryable(status=status, exception=exception):
+            return None
+        delay = policy.delay(attempt + 1)
+        if deadline is not None and monotonic() + delay >= deadline:
+            return None
+        self.logger.warning('%s failed with %s, retrying in %.2fs (attempt %d of %d)' % (stem, status or repr(exception), delay, attempt + 1, policy.max_attempts))
+        return delay
+
+    @property
+    def current_priority(self):
+        """The rate limiter priority of calls made from this thread"""
+        return getattr(self._local, 'priority', None) or self.priority
+
+    def _before_attempt(self, deadline):
+        """Returns the circuit breaker's probe token for the attempt, see _after_attempt"""
+        probe = None
+        if self.circuit_breaker is not None:
+            probe = self.circuit_breaker.before_call()
+        if self.rate_limiter is not None:
+            timeout = None if deadline is None else deadline - monotonic()
+            self.rate_limiter.acquire(self.current_priority, timeout=timeout)
+        return probe
+
+    def _after_attempt(self, probe, status=None, exception=None):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(status=status, exception=exception, probe=probe)
+
+    def _send(self, http_method, url, data, kwargs):
+        try:
+            if http_method == 'GET':
+                return self.session.get(url, **kwargs)
+            elif http_method == 'POST':
+                return self.session.post(url, data=data, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.SSLError, requests.exceptions.HTTPError, requests.exceptions.Timeout) as e:
+            self.logger.warning(e)
+            raise AvalaraServerNotReachableException(e)
+
+    def _request(self, http_method, stem, data={}, params={}, retry=True):
+        """Sends the call, retrying per the retry policy when retry is True. Only pass
+        retry=True when sending the same call twice cannot create a second document"""
+        url = '%s/%s' % (self.url, stem)
+        data = self._encode_data(data)
+        if self._coalesce(retry, data):
+            key = SingleFlight.key(self.username, http_method, url, params, data)
+            return self.single_flight.do(key, lambda: self._request_attempts(http_method, stem, url, data, params, retry))
+        return self._request_attempts(http_method, stem, url, data, params, retry)
+
+    def _coalesce(self, retry, data):
+        """Whether the call may share the response of an identical call in flight"""
+        return self.single_flight is not None and retry and not isinstance(data, StreamedBody)
+
+    def _request_attempts(self, http_method, stem, url, data, params, retry):
+        kwargs = {
+            'params': params,
+            'headers': self.headers,
+            'auth': (self.username, self.password),
+            'proxies': self.proxies,
+        }
+        deadline = self._deadline(retry)
+        attempt = 0
+        while True:
+            attempt += 1
+            probe = self._before_attempt(deadline)
+            kwargs['timeout'] = self._attempt_timeout(deadline)
+            try:
+                resp = self._send(http_method, url, data, kwargs)
+            except AvalaraServerNotReachableException as e:
+                self._after_attempt(probe, exception=e.request_exception)
+                delay = self._retry_delay(stem, attempt, deadline, retry, exception=e.request_exception)
+                if delay is None:
+                    raise
+            else:
+                self._after_attempt(probe, status=resp.status_code)
+                if resp.status_code == requests.codes.ok:
+                    return self._check_response(resp)
+                delay = self._retry_delay(stem, attempt, deadline, retry, status=resp.status_code)
+                if delay is None:
+                    return self._check_response(resp)
+            time.sleep(delay)
+
 
 class BaseResponse(AvalaraBase):
     """Common functionality for handling Avalara server responses"""
@@ -208,10 +1147,11 @@ class BaseResponse(AvalaraBase):
     ERROR = 'Error'
     _fields = ['ResultCode']
     _contains = ['Messages']
+    _lazy_contains = True
 
     def __init__(self, response, *args, **kwargs):
         self.response = response
-        super(BaseResponse, self).__init__(*args, allow_new_fields=True, **response.json())
+        self.decoder()(response_json(response), self)
 
     @property
     def _details(self):
@@ -225,9 +1165,10 @@ class BaseResponse(AvalaraBase):
         """Returns whether or not the response was successful"""
         if not hasattr(self.response, 'json'):
             raise AvalaraException('No response found')
-        if 'ResultCode' not in self.response.json():
+        data = response_json(self.response)
+        if 'ResultCode' not in data:
             raise AvalaraException('is_success not applicable for this response')
-        cond = self.response.json().get('ResultCode', BaseResponse.ERROR) == BaseResponse.SUCCESS
+        cond = data.get('ResultCode', BaseResponse.ERROR) == BaseResponse.SUCCESS
         return True if cond else False
 
     @property
@@ -236,17 +1177,42 @@ class BaseResponse(AvalaraBase):
         either the offending field that threw an error, or the class in
         the Avalara system that threw it. The second position is a
         human-readable message from Avalara"""
-        if 'ResultCode' not in self.response.json():
+        data = response_json(self.response)
+        if 'ResultCode' not in data:
             raise AvalaraException('error not applicable for this response')
-        cond = self.response.json().get('ResultCode', BaseResponse.SUCCESS) == BaseResponse.ERROR
+        cond = data.get('ResultCode', BaseResponse.SUCCESS) == BaseResponse.ERROR
         return self._details if cond else False
 
 
+class ExceptionResponse(object):
+    """Stands in for the HTTP response when a call failed before AvaTax answered it"""
+    status_code = None
+    request = None
+
+    def __init__(self, exception):
+        self.exception = exception
+        if isinstance(exception, AvalaraException) and exception.args:
+            self.text = six.text_type(exception.args[-1])
+        else:
+            self.text = six.text_type(exception)
+
+    def json(self):
+        return {
+            'ResultCode': BaseResponse.ERROR,
+            'Messages': [{'Summary': self.text, 'Source': self.exception.__class__.__name__, 'Severity': 'Exception'}],
+        }
+
+
 class ErrorResponse(BaseResponse):
     """Common error case functionality from a 500 error"""
     _fields = ['ResultCode']
     _contains = ['Messages']
 
+    @staticmethod
+    def from_exception(exception):
+        """Wraps an exception raised before AvaTax answered (unreachable server, invalid document) in an ErrorResponse"""
+        return ErrorResponse(ExceptionResponse(exception))
+
     @property
     def is_success(self):
         """Returns whether or not the response was successful"""
@@ -315,6 +1281,27 @@ class AvalaraServerNotReachableException(AvalaraBaseException):
         return repr(self.request_exception)
 
 
+class AvalaraCircuitOpenException(AvalaraServerNotReachableException):
+    """Raised without contacting AvaTax while the circuit breaker is open"""
+
+    def __init__(self, retry_in, *args, **kwargs):
+        self.retry_in = retry_in
+        self.request_exception = None
+
+    def __str__(self):
+        return 'AvaTax circuit breaker is open, next call allowed in %.1fs' % self.retry_in
+
+
+class AvalaraRateLimitException(AvalaraBaseException):
+    """Raised when the rate limiter cannot hand out a token before the call's deadline"""
+
+    def __init__(self, retry_in, *args, **kwargs):
+        self.retry_in = retry_in
+
+    def __str__(self):
+        return 'AvaTax rate limit reached, next token in %.2fs' % self.retry_in
+
+
 class AvalaraServerException(AvalaraBaseException):
     """Used internally to handle 500 and other server error responses"""
 
@@ -323,11 +1310,14 @@ class AvalaraServerException(AvalaraBaseException):
         self.status_code = response.status_code
         self.raw_response = response.text
         self.request_data = response.request.body
+        if isinstance(self.request_data, StreamedBody):
+            self.request_data = self.request_data.render()  # what was sent, not the object it was encoded from
         self.method = response.request.method
         self.url = response.request.url
         self.has_details = False
+        self._error_response = None
         try:
-            self.has_details = True if response.json() else False
+            self.has_details = True if response_json(response) else False
         except:
             pass
 
@@ -341,10 +1331,17 @@ class AvalaraServerException(AvalaraBaseException):
     def errors_as_dict(self):
         return self.errors
 
+    @property
+    def error_response(self):
+        """The response as an ErrorResponse, built once"""
+        if self._error_response is None:
+            self._error_response = ErrorResponse(self.response)
+        return self._error_response
+
     @property
     def errors(self):
         """Will return an ErrorResponse details property, or the raw text server response"""
-        return ErrorResponse(self.response)._details if self.has_details else self.raw_response
+        return self.error_response._details if self.has_details else self.raw_response
 
     def __str__(self):
         return "%r, %r %r" % (repr(self.status_code), repr(self.method), repr(self.url))
@@ -369,6 +1366,7 @@ class Document(AvalaraBase):
     DOC_TYPE_PURCHASE_INVOICE = 'PurchaseInvoice'
     DOC_TYPE_INVENTORY_ORDER = 'InventoryTransferOrder'
     DOC_TYPE_INVENTORY_INVOICE = 'InventoryTransferInvoice'
+    ORDER_DOC_TYPES = (DOC_TYPE_SALE_ORDER, DOC_TYPE_RETURN_ORDER, DOC_TYPE_PURCHASE_ORDER, DOC_TYPE_INVENTORY_ORDER)  # never saved by AvaTax
     DOC_TYPES = (DOC_TYPE_SALE_ORDER, DOC_TYPE_SALE_INVOICE, DOC_TYPE_RETURN_ORDER, DOC_TYPE_RETURN_INVOICE, DOC_TYPE_PURCHASE_ORDER, DOC_TYPE_PURCHASE_INVOICE, DOC_TYPE_INVENTORY_ORDER, DOC_TYPE_INVENTORY_INVOICE)
     CANCEL_POST_FAILED = 'PostFailed'
     CANCEL_DOC_DELETED = 'DocDeleted'
@@ -384,7 +1382,7 @@ class Document(AvalaraBase):
         super(Document, self).__init__(*args, **kwargs)
         if logger is None:
             logger = logging.getLogger('pyavatax.api')
-        Document.logger = logger
+        self.logger = logger
 
     @staticmethod
     def from_data(data):
@@ -509,6 +1507,9 @@ class Document(AvalaraBase):
 
     def add_line(self, line=None, **kwargs):
         """Adds a Line instance to this document. Will provide a LineNo if you do not"""
+        if kwargs and isinstance(self.Lines, LineTable):
+            self.Lines.append(kwargs)  # straight into the columns, no Line needed
+            return
         if kwargs:
             line = Line(**kwargs)
         if not isinstance(line, Line):
@@ -516,7 +1517,7 @@ class Document(AvalaraBase):
         if not hasattr(line, 'LineNo'):
             count = len(self.Lines)
             setattr(line, 'LineNo', count + 1)  # start at one
-            Document.logger.debug('%s inserting LineNo %d' % (getattr(self, 'DocCode', None), line.LineNo))
+            self.logger.debug('%s inserting LineNo %d' % (getattr(self, 'DocCode', None), line.LineNo))
         self.Lines.append(line)
 
     def add_from_address(self, address=None, **kwargs):
@@ -528,8 +1529,11 @@ class Document(AvalaraBase):
         if not isinstance(address, Address):
             raise AvalaraTypeException(AvalaraException.CODE_BAD_ADDRESS, '%r is not a %r' % (address, Address))
         if not hasattr(address, 'AddressCode'):
-            setattr(address, 'AddressCode', Address.DEFAULT_FROM_ADDRESS_CODE)
-            Document.logger.debug('%s setting default from address code' % getattr(self, 'DocCode', None))
+            if isinstance(address, InternedAddress):
+                address = address.pool.intern(address, AddressCode=Address.DEFAULT_FROM_ADDRESS_CODE)
+            else:
+                setattr(address, 'AddressCode', Address.DEFAULT_FROM_ADDRESS_CODE)
+            self.logger.debug('%s setting default from address code' % getattr(self, 'DocCode', None))
         self.from_address_code = getattr(address, 'AddressCode')
         self.Addresses.append(address)
 
@@ -542,8 +1546,11 @@ class Document(AvalaraBase):
         if not isinstance(address, Address):
             raise AvalaraTypeException(AvalaraException.CODE_BAD_ADDRESS, '%r is not a %r' % (address, Address))
         if not hasattr(address, 'AddressCode'):
-            setattr(address, 'AddressCode', Address.DEFAULT_TO_ADDRESS_CODE)
-            Document.logger.debug('%s setting default to address code' % getattr(self, 'DocCode', None))
+            if isinstance(address, InternedAddress):
+                address = address.pool.intern(address, AddressCode=Address.DEFAULT_TO_ADDRESS_CODE)
+            else:
+                setattr(address, 'AddressCode', Address.DEFAULT_TO_ADDRESS_CODE)
+            self.logger.debug('%s setting default to address code' % getattr(self, 'DocCode', None))
         self.to_address_code = getattr(address, 'AddressCode')
         self.Addresses.append(address)
 
@@ -558,20 +1565,26 @@ class Document(AvalaraBase):
     def validate_codes(self):
         """Look through line items making sure that origin and destination codes are set
             set defaults if they exist, raise exception if we are missing something"""
+        if isinstance(self.Lines, LineTable):
+            filled = self.Lines.fill_codes(getattr(self, 'from_address_code', None), getattr(self, 'to_address_code', None))
+            if filled:
+                self.logger.debug('%s set %d default origin and destination codes' % (getattr(self, 'DocCode', None), filled))
+            return
         for l in self.Lines:
             if not hasattr(l, 'OriginCode'):
                 if not hasattr(self, 'from_address_code'):
                     raise AvalaraValidationException(AvalaraException.CODE_BAD_ORIGIN, 'Origin Code needed for Line Item %r' % l.LineNo)
                 l.OriginCode = self.from_address_code
-                Document.logger.debug('%s setting origin code %s' % (getattr(self, 'DocCode', None), l.OriginCode))
+                self.logger.debug('%s setting origin code %s' % (getattr(self, 'DocCode', None), l.OriginCode))
             if not hasattr(l, 'DestinationCode'):
                 if not hasattr(self, 'to_address_code'):
                     raise AvalaraValidationException(AvalaraException.CODE_BAD_DEST, 'DestinationCode needed for Line Item %r' % l.LineNo)
                 l.DestinationCode = self.to_address_code
-                Document.logger.debug('%s setting destination code %s' % (getattr(self, 'DocCode', None), l.DestinationCode))
+                self.logger.debug('%s setting destination code %s' % (getattr(self, 'DocCode', None), l.DestinationCode))
 
     def validate(self):
-        """Ensures we have addresses and line items. Then calls validate_codes"""
+        """Validates every field, line and address. Ensures we have addresses and line items. Then calls validate_codes"""
+        self.clean()
         if not hasattr(self, 'DocType'):
             raise AvalaraValidationException(AvalaraException.CODE_BAD_DOCTYPE, 'You need to set a DocType')
         if len(self.Addresses) == 0:
@@ -580,9 +1593,26 @@ class Document(AvalaraBase):
             raise AvalaraValidationException(AvalaraException.CODE_BAD_LINE, 'You need Line Items')
         self.validate_codes()
 
+    @staticmethod
+    def validate_many(docs):
+        """Validates every document, e.g. a batch built with from_trusted_data, without
+        stopping at the first invalid one. Returns a list in the same order as docs,
+        holding None for each valid document and the AvalaraException for each invalid one"""
+        errors = []
+        for doc in docs:
+            try:
+                doc.validate()
+            except AvalaraException as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
     @property
     def total(self):
         """Helper representing the line items total amount for tax. Used in GetTax call"""
+        if isinstance(self.Lines, LineTable):
+            return self.Lines.total
         return sum([getattr(line, 'Amount', 0) for line in self.Lines])
 
     def update_doc_code_from_response(self, post_tax_response):
@@ -591,7 +1621,135 @@ class Document(AvalaraBase):
         if not isinstance(post_tax_response, PostTaxResponse):
             raise AvalaraTypeException('post_tax_response must be a %r' % type(PostTaxResponse))
         setattr(self, 'DocCode', getattr(post_tax_response, 'DocCode'))
-        Document.logger.debug('AvaTax assigned %s as DocCode' % getattr(self, 'DocCode', None))
+        self.logger.debug('AvaTax assigned %s as DocCode' % getattr(self, 'DocCode', None))
+
+
+def _frozen_setattr(self, name, value):
+    missing = _frozen_setattr  # a sentinel no field can hold
+    current = getattr(self, name, missing)
+    if current is not value and current != value:  # cleaning again sets the values it already has
+        raise AvalaraException(AvalaraException.CODE_BAD_DOC, 'This %s is shared by a DocumentTemplate and can not be changed, replace it on the Document instead' % self.__class__.__name__)
+
+
+def _frozen_delattr(self, name):
+    raise AvalaraException(AvalaraException.CODE_BAD_DOC, 'This %s is shared by a DocumentTemplate and can not be changed, replace it on the Document instead' % self.__class__.__name__)
+
+
+_frozen_classes = {}
+
+
+def _frozen_copy(obj):
+    """A copy of obj that can't be changed, of a subclass of obj's class with the same
+    layout, for the objects a DocumentTemplate shares"""
+    klass = obj.__class__
+    if isinstance(obj, InternedAddress):
+        return obj  # can't be changed already
+    frozen_class = _frozen_classes.get(klass)
+    if frozen_class is None:
+        namespace = {'__slots__': (), '__setattr__': _frozen_setattr, '__delattr__': _frozen_delattr, '__doc__': 'A %s shared by a DocumentTemplate' % klass.__name__}
+        frozen_class = _frozen_classes.setdefault(klass, type(klass)('Frozen%s' % klass.__name__, (klass,), namespace))
+    frozen = frozen_class.__new__(frozen_class)
+    for name in ('_extra', '_logger') + klass._field_order + tuple(klass._has):
+        try:
+            value = object.__getattribute__(obj, name)
+        except AttributeError:
+            continue
+        if isinstance(value, AvalaraBase):
+            value = _frozen_copy(value)
+        object.__setattr__(frozen, name, value)
+    return frozen
+
+
+class DocumentTemplate(object):
+    """The parts a run of Documents have in common (company, customer, addresses,
+    DetailLevel, TaxOverride...), validated and serialized once. new() makes a
+    Document from it that shares those parts: it gets its own Lines and Addresses
+    lists and its own fields, but the same Address, DetailLevel and TaxOverride
+    objects until you replace them. Only the lines, and whatever else the new
+    Document doesn't share, are validated and serialized again.
+
+    The template works from a copy of the document it is given, and the objects it
+    shares are copies that can't be changed: setting a field on one raises an
+    AvalaraException. Replace the object on the Document instead (doc.Addresses[0] =
+    Address(...), doc.set_detail_level(...)), which only changes that Document"""
+
+    def __init__(self, doc):
+        if isinstance(doc, dict):
+            doc = Document.from_data(doc)
+        elif not isinstance(doc, Document):
+            raise AvalaraTypeException(AvalaraException.CODE_BAD_DOC, 'Please pass a document or a dictionary to create a Document')
+        if len(doc.Lines):
+            raise AvalaraException(AvalaraException.CODE_BAD_LINE, 'A template has no Lines, pass them to new()')
+        doc.clean()
+        template = doc.__class__.__new__(doc.__class__)
+        template.__dict__.update(doc.__dict__)
+        template.Addresses = [_frozen_copy(a) for a in doc.Addresses]
+        template.Lines = []
+        for f in doc._has:
+            obj = getattr(doc, f, None)
+            if obj is not None:
+                setattr(template, f, _frozen_copy(obj))
+        self.document = template
+        shared = list(template.Addresses) + [obj for obj in (getattr(template, f, None) for f in template._has) if obj is not None]
+        self._serialized = dict((id(obj), obj.todict()) for obj in shared)  # the template keeps the objects alive, so the ids stay theirs
+
+    def new(self, lines=(), **fields):
+        """A Document with the template's fields and shared objects, the given fields
+        updated onto it, and lines (Lines, dicts of Line fields or a LineTable) added"""
+        doc = TemplateDocument.__new__(TemplateDocument)
+        doc.__dict__.update(self.document.__dict__)
+        doc.Addresses = list(self.document.Addresses)
+        doc.Lines = []
+        doc._template = self
+        if fields:
+            doc.update(**fields)
+        if isinstance(lines, LineTable):
+            doc.Lines = lines
+        else:
+            for line in lines:
+                if isinstance(line, dict):
+                    doc.add_line(**line)
+                else:
+                    doc.add_line(line)
+        return doc
+
+
+class TemplateDocument(Document):
+    """A Document made by DocumentTemplate.new"""
+
+    def _unshared(self):
+        """The objects this document holds that aren't its template's"""
+        template = self._template.document
+        shared = self._template._serialized
+        objs = [a for a in self.Addresses if id(a) not in shared]
+        for f in self._has:
+            obj = getattr(self, f, None)
+            if obj is not None and obj is not getattr(template, f, None):
+                objs.append(obj)
+        return objs
+
+    def clean(self, fields=None, children=None):
+        if children is None:  # everything, but the template's objects were checked already
+            children = self._unshared()
+            if isinstance(self.Lines, LineTable):
+                self.Lines.clean()
+            else:
+                children.extend(self.Lines)
+        super(TemplateDocument, self).clean(fields, children)
+
+    def todict(self):
+        """As Document.todict, but the dicts of the shared objects are the template's
+        own, made once: don't modify them"""
+        self.validate()
+        data = self._todict_fields()
+        serialized = self._template._serialized
+        for f in self._has:
+            obj = getattr(self, f, None)
+            if obj is not None:
+                data[f] = serialized[id(obj)] if id(obj) in serialized else obj.todict()
+        data['Lines'] = self.Lines.todict() if isinstance(self.Lines, LineTable) else [line.todict() for line in self.Lines]
+        data['Addresses'] = [serialized[id(a)] if id(a) in serialized else a.todict() for a in self.Addresses]
+        return data
 
 
 class TaxOverride(AvalaraBase):
@@ -647,6 +1805,8 @@ class TaxOverride(AvalaraBase):
 class Line(AvalaraBase):
     """Represents an Avalara Line"""
     _fields = ['LineNo', 'DestinationCode', 'OriginCode', 'Qty', 'Amount', 'ItemCode', 'TaxCode', 'CustomerUsageType', 'Description', 'Discounted', 'TaxIncluded', 'Ref1', 'Ref2']
+    _compact = True
+    _sparse = ['CustomerUsageType', 'Discounted', 'TaxIncluded', 'Ref1', 'Ref2']
 
     def __init__(self, *args, **kwargs):
         if 'Qty' not in kwargs:
@@ -679,11 +1839,219 @@ class Line(AvalaraBase):
             raise AvalaraValidationException(AvalaraException.CODE_TOO_LONG, 'ItemCode cannot be longer than 50 characters')
 
 
+class LineTable(object):
+    """The Lines of a Document kept column by column, for documents with thousands
+    of lines. Qty and Amount are arrays (every Line has them, cleaning fills them
+    in), the other fields lists holding None where a line doesn't have the field. Behaves like the list of Lines it replaces:
+    len, iteration, indexing, append and extend all work, and the lines it hands
+    out are LineTableRow views that read and write the columns.
+
+    Build one with LineTable(rows), LineTable.from_rows(rows) or
+    LineTable.from_columns(Amount=..., ...), and pass it as a Document's Lines"""
+    _qty_type = 'l'
+    _amount_type = 'd'
+
+    def __init__(self, rows=None):
+        self.columns = dict((f, []) for f in Line._field_order)
+        self.columns['Qty'] = array.array(self._qty_type)
+        self.columns['Amount'] = array.array(self._amount_type)
+        if rows is not None:
+            self.extend(rows)
+
+    @staticmethod
+    def from_rows(rows):
+        """Builds a table from an iterable of dicts of Line fields (or Lines) without making a Line for each"""
+        return LineTable(rows)
+
+    @staticmethod
+    def from_columns(**columns):
+        """Builds a table from whole columns, each a sequence with a value per line
+        (None where a line doesn't have the field). Qty defaults to 1, Amount to 0 and LineNo to
+        1, 2, 3... as they would for Lines added one at a time"""
+        for k in columns:
+            if k not in Line._field_set:
+                raise AvalaraException(AvalaraException.CODE_INVALID_FIELD, '%s is not a valid field' % k)
+        lengths = set(len(c) for c in columns.values())
+        if len(lengths) > 1:
+            raise AvalaraException(AvalaraException.CODE_BAD_LINE, 'Every column needs a value for every line')
+        length = lengths.pop() if lengths else 0
+        table = LineTable()
+        for f in Line._field_order:
+            column = columns.get(f)
+            if f == 'Qty':
+                table.columns[f] = LineTable._numeric_column(column, table._qty_type, LineTable._clean_qty, 1, length)
+            elif f == 'Amount':
+                table.columns[f] = LineTable._numeric_column(column, table._amount_type, LineTable._clean_amount, 0.0, length)
+            elif column is not None:
+                table.columns[f] = list(column)
+            elif f == 'LineNo':
+                table.columns[f] = list(range(1, length + 1))
+            else:
+                table.columns[f] = [None] * length
+        table.clean()
+        return table
+
+    @staticmethod
+    def _numeric_column(column, typecode, clean_fn, default, length):
+        if column is None:
+            return array.array(typecode, [default]) * length
+        if isinstance(column, array.array) and column.typecode == typecode:
+            return array.array(typecode, column)
+        return array.array(typecode, [default if v is None else clean_fn(v) for v in column])
+
+    @staticmethod
+    def _clean_qty(qty):
+        try:
+            return Document._clean_int(qty)
+        except ValueError:
+            raise AvalaraValidationException(AvalaraException.CODE_BAD_FLOAT, 'Qty should either be a float, or string that is parsable into a float')
+
+    @staticmethod
+    def _clean_amount(amount):
+        try:
+            return float(Document._clean_float(amount))
+        except ValueError:
+            raise AvalaraValidationException(AvalaraException.CODE_BAD_FLOAT, 'Amount should either be a float, or string that is parsable into a float')
+
+    @staticmethod
+    def _clean_item_code(code):
+        if code and len(code) > 50:
+            raise AvalaraValidationException(AvalaraException.CODE_TOO_LONG, 'ItemCode cannot be longer than 50 characters')
+
+    def __len__(self):
+        return len(self.columns['Amount'])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield LineTableRow(self, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [LineTableRow(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('line index out of range')
+        return LineTableRow(self, i)
+
+    def append(self, line=None, **kwargs):
+        """Adds a Line, or a dict of Line fields, as the last row. Gives it a LineNo if it has none"""
+        if kwargs:
+            line = kwargs
+        if isinstance(line, (Line, LineTableRow)):
+            line = line.todict()
+        elif not isinstance(line, dict):
+            raise AvalaraTypeException(AvalaraException.CODE_BAD_LINE, '%r is not a %r' % (line, Line))
+        for k in line:
+            if k not in Line._field_set:
+                raise AvalaraException(AvalaraException.CODE_INVALID_FIELD, '%s is not a valid field' % k)
+        qty = self._clean_qty(line.get('Qty', 1))
+        amount = self._clean_amount(line.get('Amount'))
+        self._clean_item_code(line.get('ItemCode'))
+        columns = self.columns
+        if line.get('LineNo') is None:
+            line = dict(line, LineNo=len(self) + 1)  # start at one
+        for f in Line._field_order:
+            if f == 'Qty':
+                columns[f].append(qty)
+            elif f == 'Amount':
+                columns[f].append(amount)
+            else:
+                columns[f].append(line.get(f))
+
+    def extend(self, lines):
+        """Appends every Line or dict in lines, or every row of another LineTable"""
+        if isinstance(lines, LineTable):
+            for f, column in six.iteritems(lines.columns):
+                self.columns[f].extend(column)
+            return
+        for line in lines:
+            self.append(line)
+
+    def get(self, i, field):
+        """The field of line i, raising AttributeError when the line doesn't have it"""
+        v = self.columns[field][i]
+        if v is None:
+            raise AttributeError("Line %d has no %s" % (i, field))
+        return v
+
+    def set(self, i, field, value):
+        if field == 'Qty':
+            value = self._clean_qty(value)
+        elif field == 'Amount':
+            value = self._clean_amount(value)
+        elif field == 'ItemCode':
+            self._clean_item_code(value)
+        self.columns[field][i] = value
+
+    @property
+    def total(self):
+        """The sum of every line's Amount"""
+        return sum(self.columns['Amount'])
+
+    def clean(self):
+        """Validates the columns that can be written to directly"""
+        for code in self.columns['ItemCode']:
+            self._clean_item_code(code)
+
+    def fill_codes(self, origin_code, destination_code):
+        """Sets the OriginCode and DestinationCode of the lines missing them, raising like
+        Document.validate_codes when there is no code to fill in. Returns how many were set"""
+        filled = 0
+        for field, code, error in (('OriginCode', origin_code, AvalaraException.CODE_BAD_ORIGIN), ('DestinationCode', destination_code, AvalaraException.CODE_BAD_DEST)):
+            column = self.columns[field]
+            if None not in column:
+                continue
+            if code is None:
+                line_no = self.columns['LineNo'][column.index(None)]
+                raise AvalaraValidationException(error, '%s needed for Line Item %r' % ('Origin Code' if field == 'OriginCode' else field, line_no))
+            filled += column.count(None)
+            self.columns[field] = [code if c is None else c for c in column]
+        return filled
+
+    def todict(self):
+        """The lines as a list of dicts, the same as [line.todict() for line in lines]"""
+        fields = Line._field_order
+        return [dict((f, v) for f, v in zip(fields, values) if v is not None) for values in zip(*[self.columns[f] for f in fields])]
+
+
+class LineTableRow(object):
+    """One line of a LineTable, with the attributes of a Line"""
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, name):
+        if name not in Line._field_set:
+            raise AttributeError("'LineTableRow' object has no attribute '%s'" % name)
+        return self._table.get(self._index, name)
+
+    def __setattr__(self, name, value):
+        if name not in Line._field_set:
+            raise AttributeError("'LineTableRow' object has no attribute '%s'" % name)
+        self._table.set(self._index, name, value)
+
+    def clean(self):
+        self._table._clean_item_code(self._table.columns['ItemCode'][self._index])
+
+    def todict(self):
+        data = {}
+        for f in Line._field_order:
+            try:
+                data[f] = self._table.get(self._index, f)
+            except AttributeError:
+                pass
+        return data
+
+
 class Address(AvalaraBase):
     """Represents an Avalara Address"""
     DEFAULT_FROM_ADDRESS_CODE = "1"
     DEFAULT_TO_ADDRESS_CODE = "2"
-    _fields = ['AddressCode', 'Line1', 'Line2', 'Line3', 'PostalCode', 'Region', 'City', 'TaxRegionId', 'Country', 'AddressType', 'County', 'FipsCode', 'CarrierRoute', 'TaxRegionId', 'PostNet']
+    _fields = ['AddressCode', 'Line1', 'Line2', 'Line3', 'PostalCode', 'Region', 'City', 'TaxRegionId', 'Country', 'AddressType', 'County', 'FipsCode', 'CarrierRoute', 'PostNet']
+    _compact = True
 
     @staticmethod
     def from_data(data):
@@ -747,9 +2115,123 @@ class Address(AvalaraBase):
             return 'Unknown'
 
 
+class InternedAddress(Address):
+    """An Address from an AddressPool. It can't be changed, so every Document it is on
+    shares its one todict() result, and the JSON made from that"""
+    __slots__ = ('pool', '_key', '_fragment', '_variants')
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_fragment', None) is not None:
+            raise AvalaraException(AvalaraException.CODE_BAD_ADDRESS, 'Interned addresses can not be changed, intern the changed address instead')
+        super(InternedAddress, self).__setattr__(name, value)
+
+    def todict(self):
+        """Returns the same JSONFragment every time: don't modify it"""
+        return self._fragment
+
+    def clean(self, fields=None, children=None):
+        """Nothing to do: the pool cleaned the address when it interned it"""
+
+
+class AddressPool(object):
+    """Interns Addresses, so an address that is on many Documents (e.g. your warehouse)
+    is built, cleaned and serialized once. Addresses are pooled by their fields, with
+    letter case and runs of whitespace ignored: the first address seen is the one
+    handed out for all of its variants. Keeps the maxsize most recently used addresses.
+    Safe to share between threads. hits, misses and evictions count what it did"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._addresses = collections.OrderedDict()
+        self._keys = {}  # the fields as given, to their normalized key
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(fields):
+        return tuple(sorted((f, ' '.join(v.split()).upper() if isinstance(v, six.string_types) else v) for f, v in six.iteritems(fields) if v is not None))
+
+    def intern(self, address=None, **kwargs):
+        """Returns the pool's InternedAddress for an Address, or a dict of Address fields,
+        with kwargs updated onto it"""
+        if isinstance(address, InternedAddress):
+            key = address._key  # no need to look at its fields again
+            if kwargs:
+                key = self._variant_key(address, kwargs)
+        else:
+            if isinstance(address, Address):
+                address = address.todict()
+            fields = dict(address or {}, **kwargs)
+            try:
+                exact = frozenset(six.iteritems(fields))
+                key = self._keys.get(exact)
+            except TypeError:  # unhashable values, always normalize them
+                exact = key = None
+            if key is None:
+                key = self.key(fields)
+                if exact is not None:
+                    if len(self._keys) >= 4 * self.maxsize:
+                        self._keys.clear()
+                    self._keys[exact] = key
+        with self._lock:
+            interned = self._addresses.pop(key, None)
+            if interned is not None:
+                self._addresses[key] = interned  # now the most recently used
+                self.hits += 1
+                return interned
+            self.misses += 1
+        if isinstance(address, InternedAddress):
+            fields = dict(address._fragment, **kwargs)
+        interned = InternedAddress(**fields)
+        interned.pool = self
+        interned._key = key
+        interned._variants = {}
+        Address.clean(interned)  # once, not on every Document's validate
+        interned._fragment = JSONFragment(Address.todict(interned))  # from here on it can't be changed
+        with self._lock:
+            self._addresses.setdefault(key, interned)  # unless another thread got there first
+            while len(self._addresses) > self.maxsize:
+                self._addresses.popitem(last=False)
+                self.evictions += 1
+            return self._addresses.get(key, interned)
+
+    def _variant_key(self, address, kwargs):
+        """The key of address with kwargs updated onto it, remembered on the address: the
+        same few variants (its AddressCode on a Document) are asked for again and again"""
+        try:
+            variant = frozenset(six.iteritems(kwargs))
+            return address._variants[variant]
+        except TypeError:  # unhashable values
+            variant = None
+        except KeyError:
+            pass
+        fields = dict(address._key)
+        fields.update(self.key(kwargs))
+        key = tuple(sorted((f, v) for f, v in six.iteritems(fields) if kwargs.get(f, v) is not None))
+        if variant is not None:
+            if len(address._variants) >= 16:
+                address._variants.clear()
+            address._variants[variant] = key
+        return key
+
+    def __len__(self):
+        return len(self._addresses)
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return float(self.hits) / calls if calls else 0.0
+
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'hit_rate': self.hit_rate}
+
+
 class Messages(AvalaraBase):
     """Represents error messages dictionary response from Avalara"""
     _fields = ['Summary', 'RefersTo', 'Source', 'Details', 'Severity']
+    _compact = True
 
 
 class DetailLevel(AvalaraBase):
@@ -761,20 +2243,26 @@ class TaxAddresses(AvalaraBase):
     """Represents TaxAddress response from Avalara"""
     _fields = ['Address', 'AddressCode', 'Latitude', 'Longitude', 'City', 'Country', 'PostalCode', 'Region', 'TaxRegionId', 'JurisCode']
     _contains = ['TaxDetails']
+    _lazy_contains = True
+    _compact = True
 
 
 class TaxDetails(AvalaraBase):
     """Represents TaxDetails response from Avalara"""
     _fields = ['Country', 'Region', 'JurisType', 'JurisCode', 'Taxable', 'Rate', 'Tax', 'JurisName', 'TaxName']
+    _compact = True
 
 
 class TaxLines(AvalaraBase):
     """Represents TaxLines response from Avalara"""
     _fields = ['LineNo', 'TaxCode', 'BoundaryLevel', 'Taxability', 'Taxable', 'Rate', 'Tax', 'Discount', 'TaxCalculated', 'Exemption']
     _contains = ['TaxDetails']
+    _lazy_contains = True
+    _compact = True
 
 
 class CancelTaxResult(AvalaraBase):
     """Represents CancelTaxResult response from Avalara"""
     _fields = ['DocId', 'TransactionId', 'ResultCode']
     _contains = ['Messages']
+    _lazy_contains = True
@@ -0,0 +1,424 @@
+import collections
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+
+from pyavatax.api import GetTaxResponse, PostTaxResponse, ValidateAddressResponse
+from pyavatax.base import Address, AvalaraException, BaseResponse, Document, monotonic, response_json
+
+
+class CachedResponse(object):
+    """Stands in for the HTTP response of a call answered from a cache"""
+    status_code = 200
+    request = None
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def text(self):
+        return json.dumps(self.data)
+
+    def json(self):
+        return self.data
+
+
+class TTLCache(object):
+    """Keeps the maxsize most recently used entries, each for ttl seconds. Safe to share
+    between threads. hits, misses, evictions (entries dropped for room) and
+    expirations (entries found too old) count what it did"""
+
+    blocking = False  # only holds a lock for a moment, AsyncAPI uses it on the event loop
+
+    def __init__(self, maxsize=1024, ttl=300):
+        if maxsize < 1 or ttl <= 0:
+            raise AvalaraException(AvalaraException.CODE_BAD_ARGS, 'maxsize must be at least 1 and ttl positive')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """The value stored for key, or None when there is none or it has expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] > monotonic():
+                    self._entries[key] = entry  # now the most recently used
+                    self.hits += 1
+                    return entry[1]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (monotonic() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return float(self.hits) / calls if calls else 0.0
+
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations, 'hit_rate': self.hit_rate}
+
+
+class SQLiteTTLCache(TTLCache):
+    """A TTLCache kept in a local SQLite file, so it survives restarts and is shared by
+    every process pointing at the same path and name. Keys are strings and values
+    anything json can encode. The counters are this process' own"""
+
+    blocking = True  # file I/O, and waits on the SQLite write lock: AsyncAPI uses it on an executor thread
+
+    def __init__(self, path, maxsize=100000, ttl=86400, name='avatax', timeout=5.0):
+        super(SQLiteTTLCache, self).__init__(maxsize=maxsize, ttl=ttl)
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        self._local = threading.local()  # sqlite connections may not cross threads
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS pyavatax_cache (name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL, PRIMARY KEY (name, key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS pyavatax_cache_used ON pyavatax_cache (name, used)')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        conn = self._connection()
+        now = time.time()  # monotonic clocks are not comparable across processes
+        row = conn.execute('SELECT value, expires FROM pyavatax_cache WHERE name = ? AND key = ?', (self.name, key)).fetchone()
+        if row is not None:
+            if row[1] > now:
+                conn.execute('UPDATE pyavatax_cache SET used = ? WHERE name = ? AND key = ?', (now, self.name, key))
+                self._count('hits')
+                return json.loads(row[0])
+            conn.execute('DELETE FROM pyavatax_cache WHERE name = ? AND key = ? AND expires <= ?', (self.name, key, now))
+            self._count('expirations')
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT OR REPLACE INTO pyavatax_cache (name, key, value, expires, used) VALUES (?, ?, ?, ?, ?)', (self.name, key, json.dumps(value), now + self.ttl, now))
+            evicted = conn.execute('DELETE FROM pyavatax_cache WHERE name = ? AND key IN (SELECT key FROM pyavatax_cache WHERE name = ? ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.name, self.name, self.maxsize)).rowcount
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        with self._lock:
+            self.evictions += evicted
+
+    def clear(self):
+        self._connection().execute('DELETE FROM pyavatax_cache WHERE name = ?', (self.name,))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM pyavatax_cache WHERE name = ?', (self.name,)).fetchone()[0]
+
+
+class RateCache(TTLCache):
+    """Answers get_tax from the Rate and TaxDetails AvaTax returned for a nearby point,
+    working out Tax locally for the sale amount. Points are grouped into cells of
+    cell_size degrees of latitude and longitude (0.001 is about 110 meters), and a
+    cell holds the rates of the first point looked up in it: keep the cells small
+    where a tax boundary may cross them. Pass it to the API as rate_cache"""
+
+    def __init__(self, cell_size=0.001, maxsize=1024, ttl=3600):
+        super(RateCache, self).__init__(maxsize=maxsize, ttl=ttl)
+        if cell_size <= 0:
+            raise AvalaraException(AvalaraException.CODE_BAD_ARGS, 'cell_size must be positive')
+        self.cell_size = cell_size
+
+    def cell(self, lat, lng):
+        return (int(math.floor(float(lat) / self.cell_size)), int(math.floor(float(lng) / self.cell_size)))
+
+    def response(self, lat, lng, sale_amount):
+        """A GetTaxResponse for sale_amount at lat, lng, or None when the cell isn't cached"""
+        rates = self.get(self.cell(lat, lng))
+        if rates is None:
+            return None
+        rate, details = rates
+        amount = float(sale_amount)
+        data = {
+            'ResultCode': BaseResponse.SUCCESS,
+            'Rate': rate,
+            'Tax': round(amount * rate, 2),
+            'TaxDetails': [dict(detail, Tax=round(amount * float(detail.get('Rate') or 0), 2)) for detail in details],
+        }
+        return GetTaxResponse(CachedResponse(data))
+
+    def remember(self, lat, lng, tax):
+        """Caches the rates of a successful GetTaxResponse for the cell of lat, lng"""
+        if isinstance(tax.response, CachedResponse):
+            return  # answered from the cache
+        data = response_json(tax.response)
+        if data.get('ResultCode') != BaseResponse.SUCCESS or data.get('Rate') is None:
+            return
+        self.set(self.cell(lat, lng), (float(data['Rate']), [dict(detail) for detail in data.get('TaxDetails') or []]))
+
+
+# USPS street suffixes, unit designators and directions, folded to their abbreviations
+ADDRESS_ABBREVIATIONS = {
+    'ALLEY': 'ALY', 'AVENUE': 'AVE', 'AV': 'AVE', 'BOULEVARD': 'BLVD', 'CIRCLE': 'CIR', 'COURT': 'CT', 'COVE': 'CV',
+    'CROSSING': 'XING', 'DRIVE': 'DR', 'EXPRESSWAY': 'EXPY', 'FREEWAY': 'FWY', 'HIGHWAY': 'HWY', 'LANE': 'LN',
+    'PARKWAY': 'PKWY', 'PLACE': 'PL', 'PLAZA': 'PLZ', 'POINT': 'PT', 'ROAD': 'RD', 'ROUTE': 'RTE',
+    'SQUARE': 'SQ', 'STREET': 'ST', 'STR': 'ST', 'TERRACE': 'TER', 'TRAIL': 'TRL', 'TURNPIKE': 'TPKE',
+    'APARTMENT': 'APT', 'BUILDING': 'BLDG', 'DEPARTMENT': 'DEPT', 'FLOOR': 'FL', 'ROOM': 'RM', 'SUITE': 'STE',
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W', 'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW',
+}
+_ADDRESS_PUNCTUATION = re.compile(r'[.,]')
+_ADDRESS_KEY_FIELDS = ('Line1', 'Line2', 'Line3', 'City', 'Region', 'PostalCode', 'Country')
+
+
+def canonical_address(address):
+    """A string that is the same for addresses that only differ in letter case, spacing,
+    periods and commas, or in spelling out street suffixes, units and directions
+    ("100 Ravine Lane Northeast" and "100 ravine ln. NE"). AddressCode and the
+    other fields AvaTax doesn't validate are left out"""
+    if isinstance(address, Address):
+        address = address.todict()
+    parts = []
+    for f in _ADDRESS_KEY_FIELDS:
+        words = _ADDRESS_PUNCTUATION.sub(' ', u'%s' % (address.get(f) or '')).upper().split()
+        parts.append(' '.join(ADDRESS_ABBREVIATIONS.get(w, w) for w in words))
+    return u'|'.join(parts)
+
+
+class AddressCache(object):
+    """Answers validate_address for addresses validated before, keyed by canonical_address.
+    Keeps the results in a TTLCache (the default, one day) or a SQLiteTTLCache,
+    which survives restarts. Only successful validations are cached. Pass it to
+    the API as address_cache"""
+
+    def __init__(self, cache=None):
+        self.cache = TTLCache(maxsize=10000, ttl=86400) if cache is None else cache
+
+    @property
+    def blocking(self):
+        return getattr(self.cache, 'blocking', True)
+
+    def response(self, address):
+        """The ValidateAddressResponse for address, or None when it isn't cached"""
+        data = self.cache.get(canonical_address(address))
+        return None if data is None else ValidateAddressResponse(CachedResponse(data))
+
+    def remember(self, address, response):
+        """Caches a successful ValidateAddressResponse for address"""
+        if isinstance(response.response, CachedResponse):
+            return  # answered from the cache
+        data = response_json(response.response)
+        if data.get('ResultCode') == BaseResponse.SUCCESS:
+            self.cache.set(canonical_address(address), data)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class QuoteCache(TTLCache):
+    """Answers post_tax for quotes (uncommitted XXXXXOrder documents, which AvaTax doesn't
+    save) whose content was quoted within the last ttl seconds. Documents are
+    matched by a hash of their todict() without the volatile_fields, so a cart
+    quoted again under a new DocCode still matches. Committed calls and other
+    document types are never cached. Pass it to the API as quote_cache"""
+
+    volatile_fields = ('DocCode', 'DocId', 'ReferenceCode', 'Client')
+
+    def __init__(self, maxsize=1024, ttl=60, volatile_fields=None):
+        super(QuoteCache, self).__init__(maxsize=maxsize, ttl=ttl)
+        if volatile_fields is not None:
+            self.volatile_fields = tuple(volatile_fields)
+
+    @staticmethod
+    def cacheable(doc):
+        return not getattr(doc, 'Commit', False) and getattr(doc, 'DocType', None) in Document.ORDER_DOC_TYPES
+
+    def fingerprint(self, data):
+        """A stable hash of the request data, a todict() result, without the volatile fields"""
+        data = dict((k, v) for k, v in data.items() if k not in self.volatile_fields)
+        return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def _key(self, doc, data):
+        if not self.cacheable(doc):
+            return None
+        return self.fingerprint(data if isinstance(data, dict) else doc.todict())
+
+    def response(self, doc, data):
+        """The PostTaxResponse for a quote of doc (data is what post_tax sends), or None.
+        It carries doc's own DocCode, or none when doc has none"""
+        key = self._key(doc, data)
+        body = None if key is None else self.get(key)
+        if body is None:
+            return None
+        doc_code = getattr(doc, 'DocCode', None)
+        if doc_code is not None:
+            body = dict(body, DocCode=doc_code)
+        return PostTaxResponse(CachedResponse(body))
+
+    def remember(self, doc, data, tax):
+        """Caches a successful PostTaxResponse for a quote of doc"""
+        if isinstance(tax.response, CachedResponse):
+            return  # answered from the cache
+        key = self._key(doc, data)
+        body = response_json(tax.response)
+        if key is not None and body.get('ResultCode') == BaseResponse.SUCCESS:
+            self.set(key, dict((k, v) for k, v in body.items() if k != 'DocCode'))  # the DocCode belongs to the document quoted
+
+
+class TaxEstimate(object):
+    """What RateIndex.estimate_tax worked out for a Document. total_tax is None when a
+    line's region and tax code were never seen. confident is False when the
+    estimate may be wrong: a line wasn't covered, a ZIP code was seen in more than
+    one tax region, or an observation is older than the index's max_age (stale).
+    age is the age in seconds of the oldest observation used"""
+
+    def __init__(self, lines, ambiguous, stale, age):
+        self.lines = lines  # (LineNo, Amount, Rate, Tax, ((JurisType, JurisCode, Rate), ...)), the last three None for lines not covered
+        self.ambiguous = ambiguous
+        self.stale = stale
+        self.age = age
+
+    @property
+    def complete(self):
+        return all(line[2] is not None for line in self.lines)
+
+    @property
+    def total_tax(self):
+        return round(sum(line[3] for line in self.lines), 2) if self.complete else None
+
+    @property
+    def confident(self):
+        return self.complete and not self.ambiguous and not self.stale
+
+
+class RateIndex(object):
+    """Learns tax rates from the PostTaxResponses the API gets, to estimate the tax of
+    a Document without calling AvaTax (cart previews, sorting shipping options).
+    For every line it records the jurisdictions' rates by the TaxRegionId of the
+    line's destination and the line's TaxCode, and which TaxRegionIds each ZIP
+    code was seen in. Estimates ignore discounts and exemptions, check
+    TaxEstimate.confident before relying on one. Keeps the maxsize most recently
+    seen (region, TaxCode) rates, and the ZIP codes of the regions it keeps.
+    Safe to share between threads. Pass it to the API as rate_index"""
+
+    blocking = False
+
+    def __init__(self, max_age=7 * 86400, maxsize=10000):
+        self.max_age = max_age
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._rates = collections.OrderedDict()  # (TaxRegionId, TaxCode) -> (observed, Rate, ((JurisType, JurisCode, Rate), ...))
+        self._regions = {}  # ZIP5 -> {TaxRegionId: observed}
+        self._zips = {}  # TaxRegionId -> set of ZIP5, to prune _regions
+        self._region_rates = {}  # TaxRegionId -> how many of the _rates keys are for it
+        self.observations = 0
+
+    @staticmethod
+    def _zip(postal_code):
+        return (u'%s' % (postal_code or '')).strip()[:5] or None
+
+    def observe(self, doc, tax):
+        """Records the rates of a successful PostTaxResponse for doc"""
+        if isinstance(tax.response, CachedResponse):
+            return  # nothing new
+        data = response_json(tax.response)
+        if data.get('ResultCode') != BaseResponse.SUCCESS:
+            return
+        now = time.time()
+        regions = dict((a.get('AddressCode'), (a.get('TaxRegionId'), self._zip(a.get('PostalCode')))) for a in data.get('TaxAddresses') or [])
+        lines = dict((u'%s' % getattr(line, 'LineNo', ''), line) for line in doc.Lines)
+        with self._lock:
+            for tax_line in data.get('TaxLines') or []:
+                line = lines.get(u'%s' % tax_line.get('LineNo'))
+                if line is None or float(tax_line.get('Exemption') or 0):
+                    continue  # an exempt line's rate is the customer's, not the region's
+                region, postal_code = regions.get(getattr(line, 'DestinationCode', None) or getattr(doc, 'to_address_code', None), (None, None))
+                if region is None:
+                    continue
+                details = tuple((d.get('JurisType'), d.get('JurisCode'), float(d.get('Rate') or 0)) for d in tax_line.get('TaxDetails') or [])
+                rate = tax_line.get('Rate')
+                rate = float(rate) if rate is not None else sum(d[2] for d in details)
+                key = (u'%s' % region, getattr(line, 'TaxCode', None))
+                if self._rates.pop(key, None) is None:
+                    self._region_rates[key[0]] = self._region_rates.get(key[0], 0) + 1
+                self._rates[key] = (now, rate, details)
+                if postal_code:
+                    self._regions.setdefault(postal_code, {})[key[0]] = now
+                    self._zips.setdefault(key[0], set()).add(postal_code)
+                self.observations += 1
+            while len(self._rates) > self.maxsize:
+                (region, _), _ = self._rates.popitem(last=False)
+                self._evicted(region)
+
+    def _evicted(self, region):
+        """Forgets region's ZIP codes once none of its rates are kept. Call with the lock held"""
+        count = self._region_rates.pop(region) - 1
+        if count:
+            self._region_rates[region] = count
+            return
+        for postal_code in self._zips.pop(region, ()):
+            regions = self._regions[postal_code]
+            del regions[region]
+            if not regions:
+                del self._regions[postal_code]
+
+    def estimate_tax(self, doc):
+        """A TaxEstimate for doc, from the rates seen for its lines' destinations"""
+        now = time.time()
+        addresses = dict((getattr(a, 'AddressCode', None), a) for a in doc.Addresses)
+        lines = []
+        ambiguous = False
+        age = 0.0
+        with self._lock:
+            for line in doc.Lines:
+                amount = float(getattr(line, 'Amount', 0) or 0)
+                address = addresses.get(getattr(line, 'DestinationCode', None) or getattr(doc, 'to_address_code', None))
+                regions = self._regions.get(self._zip(getattr(address, 'PostalCode', None)), {})
+                if len(regions) > 1:
+                    ambiguous = True
+                entry = None
+                for region in sorted(regions, key=regions.get, reverse=True):  # the most recently seen first
+                    entry = self._rates.get((region, getattr(line, 'TaxCode', None)))
+                    if entry is not None:
+                        break
+                if entry is None:
+                    lines.append((getattr(line, 'LineNo', None), amount, None, None, None))
+                    continue
+                observed, rate, details = entry
+                age = max(age, now - observed)
+                lines.append((getattr(line, 'LineNo', None), amount, rate, round(amount * rate, 2), details))
+        return TaxEstimate(lines, ambiguous, age > self.max_age, age)
+
+    def __len__(self):
+        return len(self._rates)
+
+    def stats(self):
+        return {'size': len(self), 'zip_codes': len(self._regions), 'observations': self.observations}
@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+import time
+
+from pyavatax.base import AvalaraException, AvalaraRateLimitException, PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITIES, monotonic
+
+
+class TokenBucket(object):
+    """Client-side rate limiter for calls to AvaTax, shared by every thread in the process.
+
+    Tokens are added at `rate` per second up to `burst`, and every request sent
+    takes one. Bulk priority requests may not take the last `reserve` tokens
+    (a fifth of the burst by default, but always leaving them one), so interactive requests always find
+    tokens first while a bulk job is draining the bucket"""
+
+    blocking = False  # try_acquire only holds a lock for a moment, AsyncAPI calls it on the event loop
+
+    def __init__(self, rate, burst=None, reserve=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        if self.rate <= 0 or self.burst < 1:
+            raise AvalaraException(AvalaraException.CODE_BAD_ARGS, 'rate must be positive and burst at least 1')
+        if reserve is None:
+            self.reserve = max(0.0, min(self.burst / 5.0, self.burst - 1))  # a small bucket keeps no reserve
+        else:
+            self.reserve = float(reserve)
+            if self.reserve > self.burst - 1:
+                raise AvalaraException(AvalaraException.CODE_BAD_ARGS, 'reserve must leave at least one token for bulk requests')
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = monotonic()
+
+    def _refill(self, tokens, updated, now):
+        return min(self.burst, tokens + max(now - updated, 0) * self.rate)
+
+    def _spend(self, tokens, priority):
+        """Returns the tokens left and how long to wait, the wait is 0 when a token was taken"""
+        if priority not in PRIORITIES:
+            raise AvalaraException(AvalaraException.CODE_BAD_ARGS, '%r is not one of %r' % (priority, PRIORITIES))
+        floor = self.reserve if priority == PRIORITY_BULK else 0
+        if tokens - floor >= 1:
+            return tokens - 1, 0.0
+        return tokens, (floor + 1 - tokens) / self.rate
+
+    def try_acquire(self, priority=PRIORITY_INTERACTIVE):
+        """Takes a token if one is available to this priority. Returns 0 if it did,
+        otherwise the number of seconds to wait before trying again"""
+        with self._lock:
+            now = monotonic()
+            tokens = self._refill(self._tokens, self._updated, now)
+            self._tokens, wait = self._spend(tokens, priority)
+            self._updated = now
+            return wait
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """Blocks until a token is taken. Raises AvalaraRateLimitException when that would take longer than timeout seconds"""
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            wait = self.try_acquire(priority)
+            if not wait:
+                return
+            if deadline is not None and monotonic() + wait > deadline:
+                raise AvalaraRateLimitException(wait)
+            time.sleep(wait)
+
+
+class SQLiteTokenBucket(TokenBucket):
+    """A TokenBucket kept in a local SQLite file, so every process on the host
+    (e.g. all of your gunicorn workers) pointing at the same path and name shares it"""
+
+    blocking = True  # waits on the SQLite write lock, AsyncAPI calls it on an executor thread
+
+    def __init__(self, path, rate, burst=None, reserve=None, name='avatax', timeout=5.0):
+        super(SQLiteTokenBucket, self).__init__(rate, burst=burst, reserve=reserve)
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        self._local = threading.local()  # sqlite connections may not cross threads
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS pyavatax_token_bucket (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def try_acquire(self, priority=PRIORITY_INTERACTIVE):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')  # takes the write lock, other processes wait for it
+        try:
+            now = time.time()  # monotonic clocks are not comparable across processes
+            row = conn.execute('SELECT tokens, updated FROM pyavatax_token_bucket WHERE name = ?', (self.name,)).fetchone()
+            tokens = self.burst if row is None else self._refill(row[0], row[1], now)
+            tokens, wait = self._spend(tokens, priority)
+            conn.execute('INSERT OR REPLACE INTO pyavatax_token_bucket (name, tokens, updated) VALUES (?, ?, ?)', (self.name, tokens, now))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return wait
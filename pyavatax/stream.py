@@ -0,0 +1,80 @@
+"""Building Documents from a stream of flat line rows, e.g. a DB cursor or a csv.DictReader"""
+import itertools
+
+from pyavatax.base import Address, Document, InternedAddress, Line, LineTable
+
+
+def _with_code(address, code):
+    if isinstance(address, InternedAddress):
+        return address.pool.intern(address, AddressCode=code)
+    address.AddressCode = code
+    return address
+
+
+def _unused_code(used):
+    """The lowest numbered AddressCode not in used, and not one of the codes add_from_address and add_to_address default to"""
+    n = 1
+    while True:
+        code = str(n)
+        if code not in used and code not in (Address.DEFAULT_FROM_ADDRESS_CODE, Address.DEFAULT_TO_ADDRESS_CODE):
+            return code
+        n += 1
+
+
+def documents_from_rows(rows, key, document, line, from_address=None, to_address=None, trusted=False, line_table=False, address_pool=None):
+    """Groups consecutive rows with the same key(row) into a Document each, and yields
+    them one at a time, so only one document is ever held in memory. rows must be
+    sorted (or at least grouped) by key, as a cursor ordered by order id is.
+
+    document(row) returns the Document fields, it is called for the first row of each
+    group. line(row) returns the Line fields of every row. from_address(row) and
+    to_address(row) return the Address fields of the row's origin and destination (or
+    None). The first origin and destination of a document are added with
+    add_from_address and add_to_address, each further distinct address with add_address
+    under the lowest AddressCode that is unused and isn't one of their default codes, and the lines get the codes of their addresses.
+    An AddressCode in the address fields is kept, unless another address of the document
+    already has it: then the address gets an unused code as well. Repeated addresses are
+    only added once per document.
+
+    With trusted=True documents are built with from_trusted_data, with line_table=True
+    their lines are kept in a LineTable. With an AddressPool as address_pool, the
+    addresses are interned in it"""
+    build = Document.from_trusted_data if trusted else Document.from_data
+    for _, group in itertools.groupby(rows, key):
+        doc = None
+        codes = {}  # address fields -> AddressCode, for this document
+        used = set()  # the AddressCodes on the document
+        for row in group:
+            if doc is None:
+                doc = build(document(row))
+                if line_table:
+                    doc.Lines = LineTable()
+            fields = dict(line(row))
+            for address_fn, code_field, add_first in ((from_address, 'OriginCode', doc.add_from_address), (to_address, 'DestinationCode', doc.add_to_address)):
+                address = address_fn(row) if address_fn is not None else None
+                if not address:
+                    continue
+                address_key = tuple(sorted(address.items()))
+                code = codes.get(address_key)
+                if code is None:
+                    address = address_pool.intern(address) if address_pool is not None else Address(**address)
+                    first = not hasattr(doc, 'from_address_code' if code_field == 'OriginCode' else 'to_address_code')
+                    code = getattr(address, 'AddressCode', None)
+                    if code is None and first:
+                        code = Address.DEFAULT_FROM_ADDRESS_CODE if code_field == 'OriginCode' else Address.DEFAULT_TO_ADDRESS_CODE
+                    if code is None or code in used:  # none given, or another address has it
+                        code = _unused_code(used)
+                    if getattr(address, 'AddressCode', None) != code:
+                        address = _with_code(address, code)
+                    if first:
+                        add_first(address)
+                    else:
+                        doc.add_address(address)
+                    codes[address_key] = code
+                    used.add(code)
+                fields.setdefault(code_field, code)
+            if trusted and not line_table:
+                doc.add_line(Line.from_trusted_data(fields))
+            else:
+                doc.add_line(**fields)
+        yield doc
@@ -12,7 +12,11 @@ setup(
     author = 'Active Frequency',
     author_email = 'info@activefrequency.com',
     version=version,
-    install_requires = ['requests>=2.5.3,<3', 'decorator>=3.4.0', 'six>=1.9.0'],
+    install_requires = ['requests>=2.5.3,<3', 'decorator>=3.4.0', 'six>=1.9.0', 'futures>=3.0; python_version < "3"'],
+    extras_require = {
+        'async': ['aiohttp>=3.0'],
+        'orjson': ['orjson'],
+    },
     package_data = {
         '': ['*.txt', '*.rst', '*.md']
     },
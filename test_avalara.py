@@ -2,9 +2,16 @@ from pyavatax.base import Document, Line, Address, TaxOverride, AvalaraException
 from pyavatax.api import API
 import settings_local  # put the below settings into this file, it is in .gitignore
 import datetime
+import json
+import logging
 import pytest
+import threading
+import time
 import uuid
 import six
+from six.moves import socketserver
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.urllib.parse import parse_qs
 from testfixtures import LogCapture
 
 
@@ -12,6 +19,128 @@ def get_api(timeout=None):
     return API(settings_local.AVALARA_ACCOUNT_NUMBER, settings_local.AVALARA_LICENSE_KEY, settings_local.AVALARA_COMPANY_CODE, live=False, timeout=timeout)
 
 
+class StubAvaTaxHandler(BaseHTTPRequestHandler):
+    """Answers the four AvaTax calls with canned responses, so tests can run without Avalara"""
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def _reply(self, status, body):
+        body = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()  # the CRLF after the chunk
+            if not size:
+                return b''.join(chunks)
+
+    def _handle(self, method):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self._read_chunked()
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+        self.server.requests.append((method, self.path, body))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.forced:
+            status, payload = self.server.forced.pop(0)
+            return self._reply(status, payload)
+        path = self.path.split('?')[0]
+        if method == 'GET' and path.startswith('/1.0/tax/') and path.endswith('/get'):
+            sale_amount = float(parse_qs(self.path.split('?')[1])['saleamount'][0])
+            details = [{'JurisType': 'State', 'JurisCode': '53', 'Rate': 0.065, 'Tax': round(sale_amount * 0.065, 2)}]
+            return self._reply(200, {'ResultCode': 'Success', 'Rate': 0.065, 'Tax': round(sale_amount * 0.065, 2), 'TaxDetails': details})
+        if method == 'POST' and path == '/1.0/tax/get':
+            doc = json.loads(body.decode('utf-8'))
+            if doc.get('CustomerCode') == 'fail@email.com':
+                return self._reply(500, {'ResultCode': 'Error', 'Messages': [{'Summary': 'CustomerCode is not allowed', 'RefersTo': 'CustomerCode', 'Severity': 'Error'}]})
+            lines = [{'LineNo': l['LineNo'], 'Rate': 0.065, 'Tax': round(float(l['Amount']) * 0.065, 2), 'TaxDetails': [{'JurisType': 'State', 'JurisCode': '53', 'Rate': 0.065}]} for l in doc['Lines']]
+            addresses = [{'AddressCode': a['AddressCode'], 'PostalCode': a.get('PostalCode'), 'TaxRegionId': 2109700} for a in doc['Addresses']]
+            total_tax = round(sum(l['Tax'] for l in lines), 2)
+            return self._reply(200, {'ResultCode': 'Success', 'DocCode': doc.get('DocCode') or uuid.uuid4().hex, 'TotalTax': total_tax, 'TotalAmount': sum(float(l['Amount']) for l in doc['Lines']), 'TaxLines': lines, 'TaxAddresses': addresses})
+        if method == 'POST' and path == '/1.0/tax/cancel':
+            return self._reply(200, {'CancelTaxResult': {'ResultCode': 'Success', 'DocId': '1'}})
+        if method == 'GET' and path == '/1.0/address/validate':
+            address = dict((k, v[0]) for k, v in parse_qs(self.path.split('?')[1]).items())
+            address['Region'] = 'WA'
+            return self._reply(200, {'ResultCode': 'Success', 'Address': address})
+        return self._reply(500, {'ResultCode': 'Error', 'Messages': [{'Summary': 'Unknown stub path', 'Source': 'Stub', 'Severity': 'Error'}]})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class StubAvaTaxServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubAvaTaxHandler)
+        self.connections = 0
+        self.requests = []
+        self.forced = []  # (status, body) pairs to answer with, in order, before the canned responses
+        self.delay = 0
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+
+@pytest.fixture
+def stub_server():
+    server = StubAvaTaxServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_stub_api(server, **kwargs):
+    klass = type('StubAPI', (API,), {'protocol': 'http', 'DEVELOPMENT_HOST': server.host})
+    return klass(settings_local.AVALARA_ACCOUNT_NUMBER, settings_local.AVALARA_LICENSE_KEY, settings_local.AVALARA_COMPANY_CODE, live=False, **kwargs)
+
+
+class ListRecorder(object):
+    """Recorder keeping the documents it was told about"""
+
+    def __init__(self):
+        self.successes = []
+        self.failures = []
+
+    def success(self, doc):
+        self.successes.append(doc)
+
+    def failure(self, doc, response):
+        self.failures.append((doc, response))
+
+
+def get_stub_doc(**kwargs):
+    kwargs.setdefault('CustomerCode', 'email@email.com')
+    doc = Document.new_sales_order(DocDate=datetime.date.today(), **kwargs)
+    doc.add_from_address(Line1="100 Ravine Lane NE", Line2="#220", PostalCode="98110")
+    doc.add_to_address(Line1="435 Ericksen Avenue Northeast", Line2="#250", PostalCode="98110")
+    doc.add_line(Amount=10.00)
+    return doc
+
+
 @pytest.mark.example
 def test_avalara_and_http():
     api = get_api()
@@ -547,3 +676,1085 @@ def test_bad_json():
         assert False
     else:
         assert True
+
+
+@pytest.mark.stub
+@pytest.mark.pool
+def test_connection_pool_reused(stub_server):
+    with get_stub_api(stub_server, pool_maxsize=2) as api:
+        for i in range(5):
+            tax = api.post_tax(get_stub_doc())
+            assert tax.is_success is True
+        validate = api.validate_address(Address(Line1="435 Ericksen Avenue Northeast", PostalCode="98110"))
+        assert validate.Address.Region == 'WA'
+        assert api.adapter.poolmanager.connection_pool_kw['maxsize'] == 2
+    assert len(stub_server.requests) == 6
+    assert stub_server.connections == 1  # one keep-alive connection served every call
+    assert api._adapter is None  # closed on exiting the context manager
+
+
+def get_stub_async_api(server, **kwargs):
+    from pyavatax.aio import AsyncAPI
+    klass = type('StubAsyncAPI', (AsyncAPI,), {'protocol': 'http', 'DEVELOPMENT_HOST': server.host})
+    return klass(settings_local.AVALARA_ACCOUNT_NUMBER, settings_local.AVALARA_LICENSE_KEY, settings_local.AVALARA_COMPANY_CODE, live=False, **kwargs)
+
+
+@pytest.mark.stub
+@pytest.mark.aio
+def test_async_api(stub_server):
+    import asyncio
+    from pyavatax.api import GetTaxResponse, PostTaxResponse
+    from pyavatax.base import ErrorResponse
+
+    async def run():
+        async with get_stub_async_api(stub_server) as api:
+            taxes = await asyncio.gather(*[api.get_tax(47.627935, -122.51702, None, sale_amount=10.00 + i) for i in range(50)])
+            doc = get_stub_doc()
+            posted = await api.post_tax(doc)
+            cancel = await api.cancel_tax(doc)
+            validate = await api.validate_address({'Line1': '435 Ericksen Avenue Northeast', 'PostalCode': '98110'})
+            stub_server.forced.append((500, {'ResultCode': 'Error', 'Messages': [{'Summary': 'DocDate is required', 'RefersTo': 'DocDate', 'Severity': 'Error'}]}))
+            failed = await api.post_tax(get_stub_doc())
+            return taxes, doc, posted, cancel, validate, failed
+
+    taxes, doc, posted, cancel, validate, failed = asyncio.run(run())
+    assert len(taxes) == 50
+    assert all(isinstance(tax, GetTaxResponse) and tax.is_success for tax in taxes)
+    assert taxes[0].Tax == 0.65
+    assert isinstance(posted, PostTaxResponse) and posted.is_success
+    assert doc.DocCode == posted.DocCode  # DocCode back-filled like the sync client
+    assert cancel.is_success is True
+    assert validate.Address.Region == 'WA'
+    assert isinstance(failed, ErrorResponse)
+    assert failed.error == [{'DocDate': 'DocDate is required'}]
+    with pytest.raises(AvalaraException):
+        asyncio.run(get_stub_async_api(stub_server).get_tax(47.627935, -122.51702, None, None))
+
+
+@pytest.mark.stub
+@pytest.mark.aio
+def test_async_api_blocking_calls(stub_server, tmpdir):
+    import asyncio
+    from pyavatax.cache import AddressCache, SQLiteTTLCache
+    from pyavatax.ratelimit import SQLiteTokenBucket
+
+    class ThreadRecorder(ListRecorder):
+        threads = []
+
+        def success(self, doc):
+            self.threads.append(threading.get_ident())
+            super(ThreadRecorder, self).success(doc)
+
+        def failure(self, doc, response):
+            self.threads.append(threading.get_ident())
+            super(ThreadRecorder, self).failure(doc, response)
+
+    class ThreadBucket(SQLiteTokenBucket):
+        threads = []
+
+        def try_acquire(self, priority):
+            self.threads.append(threading.get_ident())
+            return super(ThreadBucket, self).try_acquire(priority)
+
+    class ThreadCache(SQLiteTTLCache):
+        threads = []
+
+        def get(self, key):
+            self.threads.append(threading.get_ident())
+            return super(ThreadCache, self).get(key)
+
+        def set(self, key, value):
+            self.threads.append(threading.get_ident())
+            super(ThreadCache, self).set(key, value)
+
+    recorder = ThreadRecorder()
+    bucket = ThreadBucket(str(tmpdir.join('bucket.db')), rate=100)
+    address_cache = AddressCache(ThreadCache(str(tmpdir.join('addresses.db')), maxsize=10, ttl=60))
+
+    async def run():
+        async with get_stub_async_api(stub_server, recorder=recorder, rate_limiter=bucket, address_cache=address_cache) as api:
+            doc = get_stub_doc()
+            await api.post_tax(doc)
+            await api.cancel_tax(doc)
+            await api.get_tax(47.627935, -122.51702, get_stub_doc(), sale_amount=10.00)
+            stub_server.forced.append((500, {'ResultCode': 'Error', 'Messages': [{'Summary': 'DocDate is required', 'RefersTo': 'DocDate', 'Severity': 'Error'}]}))
+            await api.post_tax(get_stub_doc())
+            await api.validate_address({'Line1': '435 Ericksen Avenue Northeast', 'PostalCode': '98110'})
+            await api.validate_address({'Line1': '435 Ericksen Avenue Northeast', 'PostalCode': '98110'})
+            return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert len(recorder.successes) == 3 and len(recorder.failures) == 1
+    assert len(recorder.threads) == 4 and loop_thread not in recorder.threads  # the ORM writes of a Django recorder stay off the loop
+    assert len(bucket.threads) == 5 and loop_thread not in bucket.threads  # and so does the SQLite lock
+    assert len(ThreadCache.threads) == 3 and loop_thread not in ThreadCache.threads  # miss, remember, hit
+
+
+@pytest.mark.stub
+@pytest.mark.post_tax_many
+def test_post_tax_many(stub_server):
+    from pyavatax.api import PostTaxResponse
+    from pyavatax.base import ErrorResponse
+    recorder = ListRecorder()
+    api = get_stub_api(stub_server, recorder=recorder)
+    stub_server.delay = 0.01
+    docs = [get_stub_doc() for i in range(20)]
+    docs[5] = get_stub_doc(CustomerCode='fail@email.com')  # AvaTax rejects this one
+    docs[9] = {'DocType': 'NotADocType'}  # this one never leaves the client
+    docs[12] = get_stub_doc(DocCode='keep-me')
+    results = api.post_tax_many(docs, max_workers=4)
+    assert len(results) == 20
+    assert isinstance(results[5], ErrorResponse)
+    assert results[5].error == [{'CustomerCode': 'CustomerCode is not allowed'}]
+    assert isinstance(results[9], ErrorResponse)
+    assert results[9].error == [{'AvalaraValidationException': 'NotADocType is not a valid DocType'}]
+    for i, (doc, result) in enumerate(zip(docs, results)):
+        if i in (5, 9):
+            continue
+        assert isinstance(result, PostTaxResponse)
+        assert result.DocCode == doc.DocCode  # in order, and DocCodes back-filled
+    assert docs[12].DocCode == 'keep-me'
+    assert len(recorder.successes) == 18
+    assert [doc for doc, response in recorder.failures] == [docs[5]]
+
+
+@pytest.mark.stub
+@pytest.mark.post_tax_many
+def test_post_tax_many_unexpected_errors(stub_server):
+    from pyavatax.api import PostTaxResponse
+    from pyavatax.base import ErrorResponse
+    pulled = []
+
+    class FussyRecorder(ListRecorder):
+        ahead = []
+
+        def success(self, doc):
+            self.ahead.append(len(pulled) - len(self.successes) - len(self.failures))
+            if doc.DocCode == 'fussy':
+                raise ValueError('the recorder is down')
+            super(FussyRecorder, self).success(doc)
+
+    def docs():
+        for i in range(12):
+            pulled.append(i)
+            yield get_stub_doc(DocCode='fussy') if i == 3 else get_stub_doc()
+
+    recorder = FussyRecorder()
+    api = get_stub_api(stub_server, recorder=recorder)
+    stub_server.delay = 0.01
+    results = api.post_tax_many(docs(), max_workers=2)
+    assert len(results) == 12
+    assert isinstance(results[3], ErrorResponse)
+    assert results[3].error == [{'ValueError': 'the recorder is down'}]  # only fails its own document
+    assert all(isinstance(result, PostTaxResponse) for i, result in enumerate(results) if i != 3)
+    assert len(recorder.successes) == 11 and len(recorder.failures) == 1
+    assert max(FussyRecorder.ahead) <= 2 * 2 + 1  # the window, and the one waiting for a place in it
+
+
+@pytest.mark.stub
+@pytest.mark.aio
+@pytest.mark.post_tax_many
+def test_async_post_tax_many(stub_server):
+    import asyncio
+    from pyavatax.api import PostTaxResponse
+    from pyavatax.base import ErrorResponse, PRIORITY_BULK
+    recorder = ListRecorder()
+    stub_server.delay = 0.01
+    docs = [get_stub_doc() for i in range(10)]
+    docs[3] = get_stub_doc(CustomerCode='fail@email.com')
+    docs[6] = {'DocType': 'NotADocType'}
+    priorities = []
+
+    async def run():
+        async with get_stub_async_api(stub_server, recorder=recorder) as api:
+            post_tax = api.post_tax
+
+            async def spy(doc, commit=False):
+                priorities.append(api.current_priority)
+                return await post_tax(doc, commit=commit)
+            api.post_tax = spy
+            results = await api.post_tax_many(docs, max_workers=3)
+            return results, api.current_priority
+
+    results, priority = asyncio.run(run())
+    assert isinstance(results[3], ErrorResponse)
+    assert results[3].error == [{'CustomerCode': 'CustomerCode is not allowed'}]
+    assert results[6].error == [{'AvalaraValidationException': 'NotADocType is not a valid DocType'}]
+    assert all(isinstance(r, PostTaxResponse) and r.DocCode == d.DocCode for i, (d, r) in enumerate(zip(docs, results)) if i not in (3, 6))
+    assert len(recorder.successes) == 8
+    assert [doc for doc, response in recorder.failures] == [docs[3]]
+    assert set(priorities) == {PRIORITY_BULK} and priority != PRIORITY_BULK  # the batch's priority stays in its tasks
+
+
+@pytest.mark.stub
+@pytest.mark.retry
+def test_retry_policy(stub_server):
+    from pyavatax.base import ErrorResponse, RetryPolicy
+    unavailable = (503, {'ResultCode': 'Error', 'Messages': [{'Summary': 'Service Unavailable', 'Source': 'Stub', 'Severity': 'Error'}]})
+    api = get_stub_api(stub_server, retry_policy=RetryPolicy(max_attempts=3, backoff=0.01))
+    stub_server.forced.extend([unavailable, unavailable])
+    tax = api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    assert tax.is_success is True
+    assert len(stub_server.requests) == 3
+    # a committed post without a DocCode could be saved twice, so it is never retried
+    del stub_server.requests[:]
+    stub_server.forced.append(unavailable)
+    tax = api.post_tax(get_stub_doc(), commit=True)
+    assert isinstance(tax, ErrorResponse)
+    assert len(stub_server.requests) == 1
+    # with a DocCode it can be
+    del stub_server.requests[:]
+    stub_server.forced.append(unavailable)
+    tax = api.post_tax(get_stub_doc(DocCode=uuid.uuid4().hex), commit=True)
+    assert tax.is_success is True
+    assert len(stub_server.requests) == 2
+    # uncommitted orders are quotes, they are retried
+    del stub_server.requests[:]
+    stub_server.forced.extend([unavailable, unavailable, unavailable])
+    tax = api.post_tax(get_stub_doc())
+    assert isinstance(tax, ErrorResponse)  # gave up after max_attempts
+    assert len(stub_server.requests) == 3
+    # AvaTax answers invalid documents with a 500, those are not retried by default
+    del stub_server.requests[:]
+    stub_server.forced.append((500, {'ResultCode': 'Error', 'Messages': [{'Summary': 'DocDate is required', 'RefersTo': 'DocDate', 'Severity': 'Error'}]}))
+    tax = api.post_tax(get_stub_doc())
+    assert isinstance(tax, ErrorResponse)
+    assert len(stub_server.requests) == 1
+
+
+@pytest.mark.stub
+@pytest.mark.retry
+def test_retry_deadline(stub_server):
+    from pyavatax.base import RetryPolicy
+    api = get_stub_api(stub_server, retry_policy=RetryPolicy(max_attempts=5, backoff=0.01, deadline=0.3))
+    stub_server.delay = 1
+    start = time.time()
+    with pytest.raises(AvalaraServerNotReachableException):
+        api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    assert time.time() - start < 0.9  # the deadline, not the 10 second timeout, bounds the call
+    assert len(stub_server.requests) == 1
+
+
+@pytest.mark.stub
+@pytest.mark.circuit_breaker
+def test_circuit_breaker(stub_server):
+    from pyavatax.base import AvalaraCircuitOpenException, CircuitBreaker, ErrorResponse
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    unreachable = type('UnreachableAPI', (API,), {'protocol': 'http', 'DEVELOPMENT_HOST': '127.0.0.1:1'})('1', '', 'CODE', circuit_breaker=breaker)
+    with LogCapture('pyavatax.api') as l:
+        for i in range(2):
+            with pytest.raises(AvalaraServerNotReachableException) as e:
+                unreachable.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+            assert not isinstance(e.value, AvalaraCircuitOpenException)
+        with pytest.raises(AvalaraCircuitOpenException):
+            unreachable.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+        assert breaker.state == CircuitBreaker.OPEN
+        time.sleep(0.25)
+        api = get_stub_api(stub_server, circuit_breaker=breaker)  # the breaker can be shared
+        assert api.get_tax(47.627935, -122.51702, None, sale_amount=10.00).is_success is True
+        assert breaker.state == CircuitBreaker.CLOSED
+    messages = [r.getMessage() for r in l.records if r.getMessage().startswith('AvaTax circuit breaker')]
+    assert messages == [
+        'AvaTax circuit breaker closed -> open: 2 consecutive calls could not reach AvaTax',
+        'AvaTax circuit breaker open -> half-open: sending a probe after 0.2s',
+        'AvaTax circuit breaker half-open -> closed: probe succeeded',
+    ]
+
+    breaker = CircuitBreaker(error_rate=0.5, window=4, min_calls=4, reset_timeout=0.2)
+    api = get_stub_api(stub_server, circuit_breaker=breaker)
+    unavailable = (503, {'ResultCode': 'Error', 'Messages': [{'Summary': 'Service Unavailable', 'Source': 'Stub', 'Severity': 'Error'}]})
+    del stub_server.requests[:]
+    api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    stub_server.forced.extend([unavailable, unavailable])
+    assert isinstance(api.get_tax(47.627935, -122.51702, None, sale_amount=10.00), ErrorResponse)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert isinstance(api.get_tax(47.627935, -122.51702, None, sale_amount=10.00), ErrorResponse)
+    assert breaker.state == CircuitBreaker.OPEN  # half of the last 4 calls failed
+    with pytest.raises(AvalaraCircuitOpenException):
+        api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    assert len(stub_server.requests) == 4
+    time.sleep(0.25)
+    stub_server.forced.append(unavailable)
+    api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)  # the probe fails
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(AvalaraCircuitOpenException):
+        api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+
+
+def test_circuit_breaker_probe():
+    from pyavatax.base import AvalaraCircuitOpenException, CircuitBreaker
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    assert breaker.before_call() is None  # an ordinary call
+    breaker.record(exception=ValueError('unreachable'))
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.15)
+    probe = breaker.before_call()
+    assert probe is not None and breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record(status=503)  # a call sent before the breaker opened ends meanwhile
+    breaker.record(status=200)
+    assert breaker.state == CircuitBreaker.HALF_OPEN  # only the probe decides
+    with pytest.raises(AvalaraCircuitOpenException):
+        breaker.before_call()
+    time.sleep(0.15)
+    retry = breaker.before_call()  # the probe never reported back, a new one goes out
+    breaker.record(status=200, probe=probe)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record(status=503, probe=retry)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+@pytest.mark.stub
+@pytest.mark.threads
+def test_shared_api_across_threads(stub_server):
+    from pyavatax.base import BaseAPI
+    api = get_stub_api(stub_server, pool_maxsize=32)
+    other = get_api()
+    errors = []
+    results = {}
+
+    def worker(n):
+        try:
+            for i in range(10):
+                doc_code = 'thread-%d-%d' % (n, i)
+                doc = get_stub_doc(DocCode=doc_code)
+                tax = api.post_tax(doc)
+                assert tax.is_success is True
+                assert tax.DocCode == doc_code
+                tax = api.get_tax(47.627935, -122.51702, None, sale_amount=n + 1.0)
+                assert tax.Tax == round((n + 1.0) * 0.065, 2)
+            results[n] = api.session
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(32)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(stub_server.requests) == 32 * 20
+    assert len(set(id(session) for session in results.values())) == 32  # a Session per thread
+    assert stub_server.connections <= 32  # sharing one pool
+    assert all(session.adapters['http://'] is api.adapter for session in results.values())
+    assert BaseAPI.default_headers == {'Content-Type': 'text/json; charset=utf-8'}  # class config untouched
+    assert api.headers['Host'] == stub_server.host
+    assert other.headers['Host'] == API.DEVELOPMENT_HOST
+    assert 'logger' not in Document.__dict__
+    api.close()
+
+
+@pytest.mark.rate_limit
+def test_token_bucket():
+    from pyavatax.base import AvalaraRateLimitException
+    from pyavatax.ratelimit import PRIORITY_BULK, PRIORITY_INTERACTIVE, TokenBucket
+    bucket = TokenBucket(rate=10, burst=5, reserve=3)
+    assert bucket.try_acquire(PRIORITY_BULK) == 0
+    assert bucket.try_acquire(PRIORITY_BULK) == 0
+    assert bucket.try_acquire(PRIORITY_BULK) > 0  # the last 3 tokens are kept for interactive calls
+    for i in range(3):
+        assert bucket.try_acquire(PRIORITY_INTERACTIVE) == 0
+    wait = bucket.try_acquire(PRIORITY_INTERACTIVE)
+    assert 0 < wait <= 0.1
+    with pytest.raises(AvalaraRateLimitException):
+        bucket.acquire(PRIORITY_BULK, timeout=0.05)
+    start = time.time()
+    bucket.acquire(PRIORITY_INTERACTIVE)
+    assert time.time() - start < 0.2
+    assert TokenBucket(1).reserve == 0  # too small to keep tokens back by default
+    assert TokenBucket(1, burst=3).reserve == 0.6
+    with pytest.raises(AvalaraException):
+        TokenBucket(1, burst=1, reserve=0.5)
+
+
+@pytest.mark.rate_limit
+def test_sqlite_token_bucket(tmpdir):
+    from pyavatax.ratelimit import SQLiteTokenBucket
+    path = str(tmpdir.join('bucket.sqlite'))
+    one = SQLiteTokenBucket(path, rate=1, burst=3, reserve=0)
+    other = SQLiteTokenBucket(path, rate=1, burst=3, reserve=0)  # as if in another worker process
+    assert one.try_acquire() == 0
+    assert other.try_acquire() == 0
+    assert one.try_acquire() == 0
+    assert other.try_acquire() > 0
+    assert SQLiteTokenBucket(path, rate=1, burst=3, reserve=0, name='other-account').try_acquire() == 0
+
+
+@pytest.mark.stub
+@pytest.mark.rate_limit
+def test_rate_limited_api(stub_server):
+    from pyavatax.ratelimit import TokenBucket
+    bucket = TokenBucket(rate=50, burst=1, reserve=0)
+    api = get_stub_api(stub_server, rate_limiter=bucket)
+    start = time.time()
+    for i in range(6):
+        api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    assert time.time() - start >= 0.09  # 5 calls had to wait for a token
+    results = api.post_tax_many([get_stub_doc() for i in range(5)], max_workers=5)
+    assert all(tax.is_success for tax in results)
+
+
+@pytest.mark.json
+@pytest.mark.serializer
+def test_serializer_matches_legacy_encoding():
+    from pyavatax.base import JSONSerializer
+
+    def legacy(data):
+        data = json.dumps(data)
+        data = data.replace('\\r', ' ')
+        data = data.replace('\\t', ' ')
+        data = data.replace('\\n', ' ')
+        return data
+
+    data = {
+        'Addresses': [{'Line1': u'516 N Ogden Ave\r\nMailroom', 'City': u'S\xe3o Paulo', 'AddressCode': 2}],
+        'Lines': [{'LineNo': 1, 'Description': 'tab\there', 'Amount': 161.5, 'Qty': 1, 'Discounted': True, 'Ref1': None}],
+        'Line\nKey': 'a literal backslash \\n stays as it was',
+        'DocDate': '2024-01-31',
+    }
+    assert JSONSerializer().dumps(data) == legacy(data).encode('ascii')
+    assert JSONSerializer().dumps({'DocCode': 'plain'}) == b'{"DocCode": "plain"}'
+
+
+@pytest.mark.json
+@pytest.mark.serializer
+def test_orjson_serializer():
+    pytest.importorskip('orjson')
+    from pyavatax.base import JSONSerializer, OrjsonSerializer
+    data = {'Lines': [{'LineNo': 1, 'Description': u'caf\xe9\r\nbar\tbaz', 'Amount': 10.5}], 'Commit': False}
+    body = OrjsonSerializer().dumps(data)
+    assert isinstance(body, bytes)
+    assert json.loads(body.decode('utf-8')) == json.loads(JSONSerializer().dumps(data).decode('ascii'))
+
+
+@pytest.mark.stub
+@pytest.mark.serializer
+def test_serializer_on_the_wire(stub_server):
+    from pyavatax.base import JSONSerializer, fastest_serializer
+    doc = get_stub_doc(DocCode='wire')
+    doc.Lines[0].update(Description='two\nlines')
+    api = get_stub_api(stub_server)
+    assert api.post_tax(doc).is_success is True
+    method, path, body = stub_server.requests[-1]
+    assert body == JSONSerializer().dumps(doc.todict())
+    assert b'two lines' in body
+    api = get_stub_api(stub_server, serializer=fastest_serializer())
+    assert api.post_tax(doc).is_success is True
+    assert json.loads(stub_server.requests[-1][2].decode('utf-8')) == json.loads(body.decode('ascii'))
+
+
+@pytest.mark.json
+def test_response_parsed_once():
+    from pyavatax.api import PostTaxResponse, error_as_response
+    from pyavatax.base import AvalaraServerDetailException
+    from bench_avalara import FakeResponse, Silent, error_body, post_tax_body
+    resp = FakeResponse(post_tax_body(3))
+    tax = PostTaxResponse(resp)
+    assert tax.is_success is True
+    assert tax.error is False
+    assert len(tax.TaxLines) == 3
+    assert resp.parses == 1
+    resp = FakeResponse(error_body(2), status_code=500)
+    e = AvalaraServerDetailException(resp)
+    str(e)
+    assert e.errors == [{'Lines[0]': 'Line 0 is invalid'}, {'Lines[1]': 'Line 1 is invalid'}]
+    error = error_as_response(Silent, (), e)
+    assert error.error == e.errors
+    assert error is e.error_response
+    assert resp.parses == 1
+
+
+def test_lazy_response_contains():
+    from pyavatax.api import PostTaxResponse
+    from pyavatax.base import TaxLines, TaxDetails
+    from bench_avalara import FakeResponse, post_tax_body
+    tax = PostTaxResponse(FakeResponse(post_tax_body(3)))
+    assert tax.total_tax is not None
+    assert 'TaxLines' not in tax.__dict__  # nothing built until it is read
+    assert len(tax.TaxLines) == 3
+    assert isinstance(tax.TaxLines[0], TaxLines)
+    assert tax.TaxLines is tax.TaxLines  # built once
+    assert 'TaxDetails' in tax.TaxLines[0]._pending
+    assert isinstance(tax.TaxLines[0].TaxDetails[0], TaxDetails)
+    assert tax.TaxLines[0]._pending is None  # nothing left to build, no empty dict kept
+    assert TaxLines.decoder()({'LineNo': '1'}).TaxDetails == []
+    assert hasattr(TaxLines, '__getattr__') and not hasattr(TaxDetails, '__getattr__')  # only lazy classes pay for it
+    assert tax.TaxAddresses[0].PostalCode == '98110'
+    assert not hasattr(tax, 'NotAField')
+
+
+def test_response_decoder():
+    from pyavatax.api import CancelTaxResponse, PostTaxResponse, ValidateAddressResponse
+    from pyavatax.base import ErrorResponse, TaxDetails, response_json
+    from bench_avalara import FakeResponse, post_tax_body
+    assert PostTaxResponse.decoder() is PostTaxResponse.decoder()  # compiled once per class
+    data = json.loads(post_tax_body(2))
+    data['NewTopLevelField'] = 1
+    data['TaxLines'][0]['NewLineField'] = 'x'
+    data['TaxLines'][0]['TaxDetails'] = [dict(data['TaxDetails'][0], NewDetailField=True)]
+    resp = FakeResponse(json.dumps(data))
+    tax = PostTaxResponse(resp)
+    assert tax.DocCode == 'bench'
+    assert tax.extra_fields == {'NewTopLevelField': 1}
+    assert tax.TaxLines[0].extra_fields == {'NewLineField': 'x'}
+    assert tax.TaxLines[0].TaxDetails[0].extra_fields == {'NewDetailField': True}
+    tax.TaxLines[1].update(TaxDetails=[{'JurisType': 'County'}])  # before they are built
+    assert len(response_json(resp)['TaxLines'][1]['TaxDetails']) == 2  # the parsed body isn't changed
+    assert len(tax.TaxLines[1].TaxDetails) == 3
+    assert isinstance(tax.TaxLines[1].TaxDetails[1], TaxDetails)
+    assert tax.TaxLines[1].TaxDetails[1].JurisName == 'BAINBRIDGE ISLAND'
+    assert tax.TaxLines[1].extra_fields == {}
+    assert tax.TaxDetails[0].Rate == '0.065'
+    cancel = CancelTaxResponse(FakeResponse(json.dumps({'CancelTaxResult': {'ResultCode': 'Success', 'DocId': '1', 'Messages': []}})))
+    assert cancel.is_success is True
+    address = ValidateAddressResponse(FakeResponse(json.dumps({'ResultCode': 'Success', 'Address': {'Line1': '435 Ericksen Ave NE', 'Region': 'WA', 'Latitude': '47.6'}})))
+    assert isinstance(address.Address, Address)
+    assert address.Address.Line1 == '435 Ericksen Ave NE'
+    assert address.Address.extra_fields == {'Latitude': '47.6'}
+    error = ErrorResponse(FakeResponse(json.dumps({'ResultCode': 'Error', 'Messages': [{'Summary': 'Bad', 'RefersTo': 'DocCode', 'Severity': 'Error'}]}), status_code=500))
+    assert error.error == [{'DocCode': 'Bad'}]
+
+
+def test_compiled_schema():
+    from pyavatax.base import Address, Line, TaxLines
+    from pyavatax.api import PostTaxResponse
+    assert Address._field_order.count('TaxRegionId') == 1
+    assert Line._field_set == frozenset(Line._fields)
+    assert [fn.__name__ for fn in Line._cleaners] == ['clean_Qty', 'clean_Amount', 'clean_ItemCode']
+    assert PostTaxResponse._contains_set == frozenset(['TaxLines', 'TaxDetails', 'TaxAddresses'])
+    line = Line(Amount='10.5', Qty='2')
+    assert line.Amount == 10.5 and line.Qty == 2
+    tax = TaxLines(allow_new_fields=True, TaxDetails=[{'Rate': '0.1'}], Unknown=1)
+    assert tax.TaxDetails[0].Rate == '0.1'
+    assert 'TaxDetails' in TaxLines._nested
+
+
+def test_update_only_cleans_changes(monkeypatch):
+    doc = get_stub_doc()
+    cleaned = []
+    monkeypatch.setattr(Line, 'clean_me', lambda line: cleaned.append(line))
+    doc.update(DocDate='2024-02-01', Lines=[{'Amount': '5'}])
+    assert doc.DocDate == datetime.date(2024, 2, 1)
+    assert doc.Lines[-1].Amount == 5.0
+    assert cleaned == [doc.Lines[-1]]  # the lines already on the document weren't checked again
+    doc.Lines[0].Amount = 'not a number'
+    doc.update(CustomerCode='other@email.com')
+    with pytest.raises(AvalaraValidationException):
+        doc.todict()  # which validates every line
+
+
+def test_compact_models():
+    from pyavatax.base import Messages, TaxDetails, TaxLines, TaxAddresses, AvalaraLogging
+    for klass in (Line, Address, Messages, TaxDetails, TaxLines, TaxAddresses):
+        assert not hasattr(klass(allow_new_fields=True), '__dict__')
+    line = Line(Amount='10')
+    assert line.Amount == 10.0 and line.Qty == 1
+    assert not hasattr(line, 'ItemCode')
+    assert line.logger is AvalaraLogging.get_logger()
+    custom = logging.getLogger('pyavatax.test')
+    line.logger = custom
+    assert line.logger is custom and Line().logger is AvalaraLogging.get_logger()
+    with pytest.raises(AttributeError):
+        line.NotAField = 1
+    assert line.allow_new_fields is False and Line(allow_new_fields=True).allow_new_fields is True
+    with pytest.raises(AvalaraException):
+        Line(NotAField=1)
+    detail = TaxDetails(allow_new_fields=True, Rate='0.1', NewServerField='x')  # the escape hatch for fields AvaTax adds
+    assert detail.extra_fields == {'NewServerField': 'x'}
+    assert 'NewServerField' not in detail.todict()
+    with pytest.raises(AvalaraException):
+        detail.allow_new_fields = False  # it kept a field already
+    assert line.extra_fields == {}
+    assert Document().logger is not None  # Documents still take their own logger
+    assert 'Ref1' not in Line.__slots__ and not hasattr(line, '_sparse_values')  # rarely set fields take no room until they are
+    line.update(Ref1='order 7', TaxIncluded=True)
+    assert line.Ref1 == 'order 7' and not hasattr(line, 'Ref2')
+    assert list(line.todict()) == ['Qty', 'Amount', 'TaxIncluded', 'Ref1']  # in schema order all the same
+    assert Line.from_trusted_data(line.todict()).todict() == line.todict()
+    del line.Ref1, line.TaxIncluded
+    assert not hasattr(line, 'Ref1') and not hasattr(line, '_sparse_values')
+
+
+def test_line_table():
+    import array
+    from pyavatax.base import LineTable
+    rows = [{'Amount': '10.5', 'ItemCode': 'SKU%d' % i, 'Qty': '2'} for i in range(5)] + [{'Description': 'no amount'}]
+    listed = get_stub_doc()
+    tabled = get_stub_doc()
+    tabled.Lines = LineTable.from_rows(tabled.Lines)
+    for row in rows:
+        listed.add_line(**row)
+        tabled.add_line(**row)
+    assert len(tabled.Lines) == len(listed.Lines) == 7
+    assert tabled.total == listed.total == 10 + 5 * 10.5
+    assert tabled.todict() == listed.todict()
+    assert tabled.Lines[-1].LineNo == 7 and tabled.Lines[-1].OriginCode == Address.DEFAULT_FROM_ADDRESS_CODE
+    assert tabled.Lines[-1].Amount == 0 and not hasattr(tabled.Lines[-1], 'ItemCode')
+    tabled.Lines[0].Amount = '3'
+    assert tabled.Lines[0].Amount == 3.0 and tabled.total == 3 + 5 * 10.5
+    with pytest.raises(AvalaraValidationException):
+        tabled.Lines[0].Qty = 'many'
+    with pytest.raises(AvalaraValidationException):
+        tabled.add_line(ItemCode='x' * 51)
+    columns = LineTable.from_columns(Amount=array.array('d', [1, 2, 3]), ItemCode=['a', 'b', None])
+    assert [line.todict() for line in columns] == columns.todict() == [
+        {'LineNo': 1, 'Qty': 1, 'Amount': 1.0, 'ItemCode': 'a'}, {'LineNo': 2, 'Qty': 1, 'Amount': 2.0, 'ItemCode': 'b'}, {'LineNo': 3, 'Qty': 1, 'Amount': 3.0}]
+    orphan = Document.new_sales_order(Lines=columns)
+    orphan.add_address(Line1='100 Ravine Lane NE', PostalCode='98110')
+    with pytest.raises(AvalaraValidationException):
+        orphan.validate_codes()
+
+
+def test_from_trusted_data():
+    from bench_avalara import document_data
+    data = document_data(3)
+    checked = Document.from_data(data)
+    trusted = Document.from_trusted_data(dict(data, DocDate=checked.DocDate, Discount=0.0, Lines=[line.todict() for line in checked.Lines]))
+    assert isinstance(trusted.Lines[0], Line) and isinstance(trusted.Addresses[0], Address)
+    assert trusted.todict() == checked.todict()
+    assert Line.from_trusted_data({'Amount': 5.0}).Qty == 1
+    assert Line.from_trusted_data({'Amount': 'not checked'}).Amount == 'not checked'
+    with pytest.raises(AvalaraException):
+        Line.from_trusted_data({'NotAField': 1})
+    bad = Document.from_trusted_data(dict(data, DocType='NotADocType'))
+    errors = Document.validate_many([trusted, bad, Document.from_trusted_data(dict(data, Lines=[]))])
+    assert errors[0] is None
+    assert isinstance(errors[1], AvalaraValidationException)
+    assert isinstance(errors[2], AvalaraValidationException)
+
+
+def test_documents_from_rows():
+    from pyavatax.base import LineTable
+    from pyavatax.stream import documents_from_rows
+    warehouse = {'Line1': '100 Ravine Lane NE', 'PostalCode': '98110'}
+    home = {'Line1': '435 Ericksen Avenue Northeast', 'PostalCode': '98110'}
+    office = {'Line1': '1 Winslow Way', 'PostalCode': '98110'}
+    rows = [
+        {'order': 1, 'amount': 10, 'ship_to': home},
+        {'order': 1, 'amount': 5, 'ship_to': home},
+        {'order': 2, 'amount': 7, 'ship_to': home},
+        {'order': 2, 'amount': 8, 'ship_to': office},
+        {'order': 2, 'amount': 9, 'ship_to': home},
+    ]
+    read = []
+
+    def cursor():
+        for row in rows:
+            read.append(row)
+            yield row
+
+    docs = documents_from_rows(
+        cursor(), key=lambda row: row['order'],
+        document=lambda row: {'DocType': Document.DOC_TYPE_SALE_ORDER, 'DocCode': 'order-%d' % row['order'], 'CustomerCode': 'email@email.com'},
+        line=lambda row: {'Amount': row['amount']},
+        from_address=lambda row: warehouse, to_address=lambda row: row['ship_to'])
+    first = next(docs)
+    assert len(read) == 3  # just far enough to see the first order ended
+    assert first.DocCode == 'order-1' and first.total == 15
+    assert [a.AddressCode for a in first.Addresses] == ['1', '2']
+    second = next(docs)
+    assert [a.AddressCode for a in second.Addresses] == ['1', '2', '3']
+    assert [(l.OriginCode, l.DestinationCode) for l in second.Lines] == [('1', '2'), ('1', '3'), ('1', '2')]
+    assert second.Addresses[2].Line1 == office['Line1']
+    second.validate()
+    assert list(docs) == []
+    tabled = list(documents_from_rows(
+        rows, key=lambda row: row['order'], document=lambda row: {'DocType': Document.DOC_TYPE_SALE_ORDER},
+        line=lambda row: {'Amount': row['amount']}, from_address=lambda row: warehouse, to_address=lambda row: row['ship_to'], trusted=True, line_table=True))
+    assert isinstance(tabled[1].Lines, LineTable)
+    assert tabled[1].todict()['Lines'] == second.todict()['Lines']
+    # the first row has no destination, the later ones bring a new origin and a new destination
+    store = {'Line1': '1 Madison Ave', 'PostalCode': '98110'}
+    rows = [
+        {'order': 3, 'amount': 1, 'ship_from': warehouse, 'ship_to': None},
+        {'order': 3, 'amount': 2, 'ship_from': store, 'ship_to': office},
+        {'order': 3, 'amount': 3, 'ship_from': store, 'ship_to': home},
+    ]
+    doc, = documents_from_rows(
+        rows, key=lambda row: row['order'], document=lambda row: {'DocType': Document.DOC_TYPE_SALE_ORDER, 'CustomerCode': 'email@email.com'},
+        line=lambda row: {'Amount': row['amount']}, from_address=lambda row: row['ship_from'], to_address=lambda row: row['ship_to'])
+    codes = [a.AddressCode for a in doc.Addresses]
+    assert len(set(codes)) == len(codes) == 4
+    assert [(a.AddressCode, a.Line1) for a in doc.Addresses] == [('1', warehouse['Line1']), ('3', store['Line1']), ('2', office['Line1']), ('4', home['Line1'])]
+    assert [(l.OriginCode, getattr(l, 'DestinationCode', None)) for l in doc.Lines] == [('1', None), ('3', '2'), ('3', '4')]
+    # explicit AddressCodes are kept unless another address of the document has them already
+    rows = [
+        {'order': 4, 'amount': 1, 'ship_from': warehouse, 'ship_to': None},
+        {'order': 4, 'amount': 2, 'ship_from': warehouse, 'ship_to': dict(home, AddressCode='1')},
+        {'order': 4, 'amount': 3, 'ship_from': dict(store, AddressCode='3'), 'ship_to': dict(office, AddressCode='2')},
+        {'order': 4, 'amount': 4, 'ship_from': dict(store, AddressCode='3'), 'ship_to': dict(home, AddressCode='2')},
+    ]
+    doc, = documents_from_rows(
+        rows, key=lambda row: row['order'], document=lambda row: {'DocType': Document.DOC_TYPE_SALE_ORDER, 'CustomerCode': 'email@email.com'},
+        line=lambda row: {'Amount': row['amount']}, from_address=lambda row: row['ship_from'], to_address=lambda row: row['ship_to'])
+    assert [(a.AddressCode, a.Line1) for a in doc.Addresses] == [('1', warehouse['Line1']), ('3', home['Line1']), ('4', store['Line1']), ('2', office['Line1']), ('5', home['Line1'])]
+    assert doc.from_address_code == '1' and doc.to_address_code == '3'  # the destination's '1' was the origin's already
+    assert [(l.OriginCode, getattr(l, 'DestinationCode', None)) for l in doc.Lines] == [('1', None), ('1', '3'), ('4', '2'), ('4', '5')]
+    doc.validate()
+
+
+def test_document_template(monkeypatch):
+    from pyavatax.base import DocumentTemplate, DetailLevel
+    base = get_stub_doc()
+    base.Lines = []
+    base.set_detail_level(DetailLevel(Line=True))
+    template = DocumentTemplate(base)
+    first = template.new([{'Amount': 10, 'ItemCode': 'SKU1'}])
+    second = template.new([Line(Amount=5)], DocCode='quote-2')
+    expected = get_stub_doc()
+    expected.Lines = []
+    expected.set_detail_level(DetailLevel(Line=True))
+    expected.add_line(Amount=10, ItemCode='SKU1')
+    assert first.todict() == expected.todict()
+    assert list(first.todict()) == list(expected.todict())  # in the same order too
+    assert isinstance(first, Document)
+    assert first.Addresses[0] is second.Addresses[0]  # shared, not copied
+    assert isinstance(first.Addresses[0], Address) and first.Addresses[0] is not base.Addresses[0]  # a read only copy of the template's
+    assert first.todict()['Addresses'][0] is second.todict()['Addresses'][0]  # and serialized once
+    with pytest.raises(AvalaraException):
+        second.Addresses[0].Line1 = '1 Winslow Way'  # would change every variant
+    with pytest.raises(AvalaraException):
+        second.DetailLevel.update(Line=False)
+    base.Addresses[0].Line1 = '1 Winslow Way'  # the template's copy doesn't change
+    second.Addresses[0] = Address(Line1='1 Winslow Way', PostalCode='98110', AddressCode=second.Addresses[0].AddressCode)
+    assert second.todict()['Addresses'][0]['Line1'] == '1 Winslow Way'
+    assert first.todict()['Addresses'][0]['Line1'] == template.document.Addresses[0].Line1 == expected.Addresses[0].Line1
+    assert second.DocCode == 'quote-2' and not hasattr(first, 'DocCode') and not hasattr(base, 'DocCode')
+    first.add_address(Line1='1 Winslow Way', PostalCode='98110', AddressCode='3')
+    assert len(first.Addresses) == 3 and len(second.Addresses) == len(base.Addresses) == 2
+    cleaned = []
+    monkeypatch.setattr(Address, 'clean_me', lambda address: cleaned.append(address))
+    first.validate()
+    assert cleaned == [first.Addresses[2]]  # only the address the template doesn't have
+    with pytest.raises(AvalaraValidationException):
+        template.new([{'Amount': 'ten'}])
+    with pytest.raises(AvalaraException):
+        DocumentTemplate(get_stub_doc())  # templates have no lines
+
+
+def test_address_pool(monkeypatch):
+    from pyavatax.base import AddressPool, InternedAddress, JSONSerializer, OrjsonSerializer
+    from pyavatax.stream import documents_from_rows
+    pool = AddressPool(maxsize=2)
+    warehouse = pool.intern({'Line1': '100 Ravine Lane NE', 'Line2': '#220', 'PostalCode': '98110'})
+    assert isinstance(warehouse, InternedAddress)
+    assert pool.intern(Address(Line1=' 100 ravine  lane ne', Line2='#220', PostalCode='98110')) is warehouse
+    assert pool.intern(warehouse) is warehouse
+    with pytest.raises(AvalaraException):
+        warehouse.Line1 = 'elsewhere'
+    doc = get_stub_doc()
+    plain = doc.todict()
+    doc.Addresses = []
+    del doc.from_address_code, doc.to_address_code
+    doc.add_from_address(warehouse)  # gets the default code as a new interned address
+    doc.add_to_address(pool.intern(Line1='435 Ericksen Avenue Northeast', Line2='#250', PostalCode='98110'))
+    assert doc.Addresses[0].AddressCode == '1' and not hasattr(warehouse, 'AddressCode')
+    data = doc.todict()
+    assert data == plain
+    assert doc.todict()['Addresses'][0] is data['Addresses'][0]
+    serializer = JSONSerializer()
+    assert serializer.dumps(data) == serializer._dumps(plain)
+    try:
+        serializer = OrjsonSerializer()
+    except AvalaraException:  # orjson is not installed
+        pass
+    else:
+        assert serializer.dumps(data) == serializer._dumps(plain)
+    cleaned = []
+    monkeypatch.setattr(Address, 'clean_me', lambda address: cleaned.append(address))
+    doc.validate()
+    assert cleaned == []  # cleaned when they were interned
+    assert pool.stats() == {'size': 2, 'hits': 2, 'misses': 4, 'evictions': 2, 'hit_rate': 2 / 6.0}
+    rows = [{'order': 1, 'amount': 1}, {'order': 2, 'amount': 2}]
+    pool = AddressPool()
+    docs = list(documents_from_rows(
+        rows, key=lambda row: row['order'], document=lambda row: {'DocType': Document.DOC_TYPE_SALE_ORDER}, line=lambda row: {'Amount': row['amount']},
+        from_address=lambda row: {'Line1': '100 Ravine Lane NE', 'Line2': '#220', 'PostalCode': '98110'}, to_address=lambda row: {'Line1': '1 Winslow Way', 'PostalCode': '98110'}, address_pool=pool))
+    assert docs[0].Addresses[0] is docs[1].Addresses[0]
+    assert docs[0].Addresses[1] is docs[1].Addresses[1]
+
+
+@pytest.mark.json
+@pytest.mark.serializer
+def test_document_encoder():
+    from pyavatax.base import AddressPool, DocumentTemplate, JSONSerializer, LineTable
+    serializer = JSONSerializer()
+    doc = get_stub_doc(DocCode='enc', PaymentDate=datetime.datetime(2024, 1, 31, 12, 30))
+    doc.add_line(Amount=5, Qty=3, Description=u'two\r\nlines and caf\xe9', ItemCode='SKU-1', TaxCode='P0000000')
+    doc.add_override(TaxOverrideType=TaxOverride.OVERRIDE_AMOUNT, TaxAmount=0, Reason='Tax Free Holiday')
+    assert serializer.encode(doc) == serializer.dumps(doc.todict())
+    serializer.chunk_size = 64
+    chunks = list(serializer.iterencode(doc))
+    assert len(chunks) > 1
+    assert b''.join(chunks) == serializer.dumps(doc.todict())
+    assert json.loads(b''.join(chunks).decode('ascii')) == json.loads(serializer.dumps(doc.todict()).decode('ascii'))
+    # columnar lines and interned addresses
+    pool = AddressPool()
+    big = Document.new_sales_order(DocCode='big', DocDate=datetime.date(2024, 1, 31), CustomerCode='email@email.com')
+    big.add_from_address(pool.intern(Line1='100 Ravine Lane NE', PostalCode='98110'))
+    big.add_to_address(pool.intern(Line1='435 Ericksen Avenue Northeast', PostalCode='98110'))
+    big.update(Lines=LineTable.from_rows([{'Amount': i, 'ItemCode': 'SKU-%d' % i} for i in range(50)]))
+    assert serializer.encode(big) == serializer.dumps(big.todict())
+    base = Document.new_sales_order(DocCode='base', DocDate=datetime.date(2024, 1, 31), CustomerCode='email@email.com')
+    base.add_from_address(pool.intern(Line1='100 Ravine Lane NE', PostalCode='98110'))
+    base.add_to_address(Line1='435 Ericksen Avenue Northeast', PostalCode='98110')
+    template = DocumentTemplate(base)
+    quote = template.new([{'Amount': 1.5}])
+    assert serializer.encode(quote) == serializer.dumps(quote.todict())
+    # an invalid document raises just as todict does
+    with pytest.raises(AvalaraValidationException):
+        serializer.encode(Document.new_sales_order(DocCode='empty', DocDate=datetime.date.today(), CustomerCode='email@email.com'))
+
+
+@pytest.mark.stub
+@pytest.mark.serializer
+def test_streamed_body_on_the_wire(stub_server, caplog):
+    from pyavatax.base import AvalaraServerException, JSONSerializer, RetryPolicy
+    doc = get_stub_doc(DocCode='streamed')
+    api = get_stub_api(stub_server, stream_body=True, retry_policy=RetryPolicy(max_attempts=2, backoff=0))
+    stub_server.forced.append((503, b'busy'))
+    assert api.post_tax(doc).is_success is True
+    assert len(stub_server.requests) == 2  # the retried attempt encoded the document again
+    for method, path, body in stub_server.requests:
+        assert body == JSONSerializer().dumps(doc.todict())
+
+    sent = JSONSerializer().dumps(doc.todict())
+    with caplog.at_level(logging.INFO, logger='pyavatax.api'):
+        api.post_tax(doc)
+    assert sent.decode('utf-8') in caplog.text and 'Document object' not in caplog.text  # logged as the JSON sent
+    stub_server.forced.append((500, {'ResultCode': 'Error', 'Messages': [{'Summary': 'DocDate is required', 'RefersTo': 'DocDate', 'Severity': 'Error'}]}))
+    with pytest.raises(AvalaraServerException) as excinfo:
+        api._post('1.0/tax/get', doc, retry=False)
+    assert excinfo.value.request_data == sent  # the body, not the StreamedBody
+    assert sent.decode('utf-8') in excinfo.value.full_request_as_string
+
+
+@pytest.mark.stub
+@pytest.mark.cache
+def test_rate_cache(stub_server):
+    from pyavatax.cache import RateCache
+    cache = RateCache(cell_size=0.01, maxsize=2, ttl=60)
+    api = get_stub_api(stub_server, rate_cache=cache)
+    tax = api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    assert tax.Tax == 0.65
+    assert len(stub_server.requests) == 1
+    tax = api.get_tax(47.6281, -122.5172, None, sale_amount=200.00)  # same cell, another amount
+    assert len(stub_server.requests) == 1
+    assert tax.is_success is True
+    assert tax.Rate == 0.065
+    assert tax.Tax == 13.0
+    assert tax.TaxDetails[0].Tax == 13.0
+    assert tax.TaxDetails[0].JurisCode == '53'
+    api.get_tax(47.7, -122.51702, None, sale_amount=10.00)  # another cell
+    assert len(stub_server.requests) == 2
+    api.get_tax(40.7, -74.0, None, sale_amount=10.00)  # evicts the first cell
+    api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)
+    assert len(stub_server.requests) == 4
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 4, 'evictions': 2, 'expirations': 0, 'hit_rate': 0.2}
+    cache.clear()
+    cache.ttl = 0.01
+    api.get_tax(40.7, -74.0, None, sale_amount=10.00)
+    time.sleep(0.02)
+    api.get_tax(40.7, -74.0, None, sale_amount=10.00)
+    assert cache.expirations == 1
+    assert len(stub_server.requests) == 6
+
+
+@pytest.mark.stub
+@pytest.mark.cache
+def test_address_cache(stub_server, tmpdir):
+    from pyavatax.cache import AddressCache, SQLiteTTLCache, TTLCache, canonical_address
+    assert canonical_address({'Line1': '100 Ravine Lane  Northeast', 'Line2': 'Suite 220', 'PostalCode': '98110'}) == canonical_address(Address(Line1='100 ravine ln. NE', Line2='STE 220', PostalCode='98110', AddressCode='1'))
+    assert canonical_address({'Line1': '100 Ravine Lane', 'PostalCode': '98110'}) != canonical_address({'Line1': '101 Ravine Lane', 'PostalCode': '98110'})
+    cache = AddressCache(TTLCache(maxsize=1, ttl=60))
+    api = get_stub_api(stub_server, address_cache=cache)
+    first = api.validate_address({'Line1': '100 Ravine Lane NE', 'PostalCode': '98110'})
+    again = api.validate_address(Address(Line1='100 RAVINE LN NE', PostalCode='98110'))
+    assert len(stub_server.requests) == 1
+    assert again.is_success is True
+    assert again.Address.Region == first.Address.Region == 'WA'
+    assert again.Address.Line1 == '100 Ravine Lane NE'  # what AvaTax said, not what was asked
+    api.validate_address({'Line1': '435 Ericksen Ave NE', 'PostalCode': '98110'})  # evicts the first
+    api.validate_address({'Line1': '100 Ravine Lane NE', 'PostalCode': '98110'})
+    assert len(stub_server.requests) == 3
+    assert cache.stats()['evictions'] == 2
+    path = str(tmpdir.join('addresses.sqlite'))
+    api = get_stub_api(stub_server, address_cache=AddressCache(SQLiteTTLCache(path, maxsize=2, ttl=60)))
+    api.validate_address({'Line1': '100 Ravine Lane NE', 'PostalCode': '98110'})
+    restarted = AddressCache(SQLiteTTLCache(path, maxsize=2, ttl=60))
+    api = get_stub_api(stub_server, address_cache=restarted)
+    assert api.validate_address({'Line1': '100 Ravine Lane Northeast', 'PostalCode': '98110'}).Address.Region == 'WA'
+    assert len(stub_server.requests) == 4
+    assert restarted.stats()['hits'] == 1
+    api.validate_address({'Line1': '1 Main St', 'PostalCode': '98110'})
+    api.validate_address({'Line1': '2 Main St', 'PostalCode': '98110'})
+    assert len(restarted.cache) == 2
+    assert restarted.stats()['evictions'] == 1
+    restarted.cache.ttl = 0.01
+    api.validate_address({'Line1': '3 Main St', 'PostalCode': '98110'})
+    time.sleep(0.02)
+    api.validate_address({'Line1': '3 Main St', 'PostalCode': '98110'})
+    assert restarted.stats()['expirations'] == 1
+    assert len(stub_server.requests) == 8
+
+
+@pytest.mark.stub
+@pytest.mark.cache
+def test_quote_cache(stub_server):
+    from concurrent.futures import ThreadPoolExecutor
+    from pyavatax.api import PostTaxResponse
+    from pyavatax.cache import QuoteCache
+    cache = QuoteCache(ttl=60)
+    api = get_stub_api(stub_server, quote_cache=cache)
+    first = api.post_tax(get_stub_doc(DocCode='cart-1'))
+    again = api.post_tax(get_stub_doc(DocCode='cart-2'))  # the DocCode doesn't matter
+    assert len(stub_server.requests) == 1
+    assert isinstance(again, PostTaxResponse)
+    assert again.total_tax == first.total_tax
+    assert again.TaxLines[0].Tax == first.TaxLines[0].Tax
+    assert first.DocCode == 'cart-1' and again.DocCode == 'cart-2'  # never another cart's DocCode
+    doc = get_stub_doc()
+    tax = api.post_tax(doc)
+    assert not hasattr(doc, 'DocCode') and not hasattr(tax, 'DocCode')
+    changed = get_stub_doc(DocCode='cart-3')
+    changed.add_line(Amount=5.00)
+    api.post_tax(changed)
+    assert len(stub_server.requests) == 2
+    api.post_tax(get_stub_doc(DocCode='cart-4'), commit=True)  # committed calls are never cached
+    api.post_tax(get_stub_doc(DocCode='cart-4'), commit=True)
+    invoice = get_stub_doc(DocCode='cart-5')
+    invoice.update(DocType=Document.DOC_TYPE_SALE_INVOICE)
+    api.post_tax(invoice)  # saved by AvaTax, so not a quote
+    assert len(stub_server.requests) == 5
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        taxes = list(executor.map(lambda i: api.post_tax(get_stub_doc(DocCode='cart-%d' % i)), range(40)))
+    assert all(tax.total_tax == first.total_tax for tax in taxes)
+    assert len(stub_server.requests) == 5
+    assert cache.hits == 42
+
+
+@pytest.mark.stub
+@pytest.mark.single_flight
+def test_single_flight(stub_server):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from pyavatax.base import ErrorResponse, SingleFlight
+    stub_server.delay = 0.2  # long enough for every thread to find the first call in flight
+    flight = SingleFlight()
+    api = get_stub_api(stub_server, single_flight=flight)
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        taxes = list(executor.map(lambda i: api.get_tax(47.627935, -122.51702, None, sale_amount=10.00), range(10)))
+    assert all(tax.Tax == 0.65 for tax in taxes)
+    assert len(stub_server.requests) == 1
+    assert flight.coalesced == 9
+    with ThreadPoolExecutor(max_workers=4) as executor:  # different payloads are not coalesced
+        list(executor.map(lambda i: api.get_tax(47.627935, -122.51702, None, sale_amount=10.00 + i), range(4)))
+    assert len(stub_server.requests) == 5
+    stub_server.forced.append((500, {'ResultCode': 'Error', 'Messages': [{'Summary': 'Bad address', 'RefersTo': 'Address', 'Severity': 'Error'}]}))
+    with ThreadPoolExecutor(max_workers=3) as executor:  # so is the failure
+        failed = list(executor.map(lambda i: api.validate_address({'Line1': '1 Main St', 'PostalCode': '98110'}), range(3)))
+    assert all(isinstance(f, ErrorResponse) and f.error == [{'Address': 'Bad address'}] for f in failed)
+    assert len(stub_server.requests) == 6
+    with ThreadPoolExecutor(max_workers=3) as executor:  # committed posts without a DocCode may not be sent twice, or shared
+        list(executor.map(lambda i: api.post_tax(get_stub_doc(), commit=True), range(3)))
+    assert len(stub_server.requests) == 9
+    assert flight.coalesced == 11
+
+    async def run():
+        async with get_stub_async_api(stub_server, single_flight=flight) as api:
+            return await asyncio.gather(*[api.get_tax(47.627935, -122.51702, None, sale_amount=20.00) for i in range(10)])
+
+    taxes = asyncio.run(run())
+    assert all(tax.Tax == 1.3 for tax in taxes)
+    assert len(stub_server.requests) == 10
+    assert flight.coalesced == 20
+
+
+@pytest.mark.stub
+@pytest.mark.single_flight
+@pytest.mark.aio
+def test_single_flight_leader_cancelled(stub_server):
+    import asyncio
+    from pyavatax.base import SingleFlight
+    stub_server.delay = 0.3
+    flight = SingleFlight()
+
+    async def run():
+        async with get_stub_async_api(stub_server, single_flight=flight) as api:
+            leader = asyncio.ensure_future(api.get_tax(47.627935, -122.51702, None, sale_amount=10.00))
+            await asyncio.sleep(0.05)
+            followers = [asyncio.ensure_future(api.get_tax(47.627935, -122.51702, None, sale_amount=10.00)) for i in range(3)]
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            taxes = await asyncio.gather(*followers)
+            with pytest.raises(asyncio.CancelledError):
+                await leader
+            return taxes
+
+    taxes = asyncio.run(run())
+    assert all(tax.Tax == 0.65 for tax in taxes)  # one follower took over, the others shared its call
+    assert len(stub_server.requests) == 2
+    assert flight.coalesced == 2
+    assert flight._futures == {}
+
+    async def direct():
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+        return await asyncio.gather(*[flight.do_async('key', fn) for i in range(5)]), calls
+
+    results, calls = asyncio.run(direct())
+    assert results == [1] * 5 and len(calls) == 1
+    with pytest.raises(RuntimeError):
+        flight.do_async('key', lambda: None)  # only on a running event loop, never a default loop of its own
+    assert flight._futures == {}
+
+
+@pytest.mark.stub
+@pytest.mark.cache
+def test_rate_index(stub_server):
+    from pyavatax.cache import RateIndex
+    index = RateIndex(max_age=3600)
+    api = get_stub_api(stub_server, rate_index=index)
+    api.post_tax(get_stub_doc(DocCode='learn'))
+    assert index.stats() == {'size': 1, 'zip_codes': 1, 'observations': 1}
+    cart = get_stub_doc(DocCode='cart')
+    cart.add_line(Amount=90.00)
+    estimate = index.estimate_tax(cart)
+    assert estimate.confident is True
+    assert estimate.total_tax == 6.5
+    assert estimate.lines[1][:4] == (2, 90.0, 0.065, 5.85)
+    assert estimate.lines[1][4] == (('State', '53', 0.065),)
+    assert len(stub_server.requests) == 1  # estimates never call AvaTax
+    clothing = get_stub_doc(DocCode='shirt')
+    clothing.Lines[0].update(TaxCode='PC040100')  # not seen for this region yet
+    assert index.estimate_tax(clothing).total_tax is None
+    assert index.estimate_tax(clothing).confident is False
+    elsewhere = Document.new_sales_order(DocCode='nyc', DocDate=datetime.date.today(), CustomerCode='email@email.com')
+    elsewhere.add_from_address(Line1='100 Ravine Lane NE', PostalCode='98110')
+    elsewhere.add_to_address(Line1='350 5th Ave', PostalCode='10118')
+    elsewhere.add_line(Amount=10.00)
+    assert index.estimate_tax(elsewhere).complete is False
+    index.max_age = 0
+    assert index.estimate_tax(cart).stale is True
+    assert index.estimate_tax(cart).confident is False
+    index.max_age = 3600
+    body = {'ResultCode': 'Success', 'DocCode': 'other-side', 'TotalTax': 0.9,
+            'TaxLines': [{'LineNo': '1', 'Rate': 0.09, 'Tax': 0.9, 'TaxDetails': [{'JurisType': 'State', 'JurisCode': '53', 'Rate': 0.09}]}],
+            'TaxAddresses': [{'AddressCode': '2', 'PostalCode': '98110-1234', 'TaxRegionId': 2109999}]}
+    stub_server.forced.append((200, body))
+    api.post_tax(get_stub_doc(DocCode='other-side'))  # the same ZIP code, in another tax region
+    estimate = index.estimate_tax(cart)
+    assert estimate.ambiguous is True
+    assert estimate.confident is False
+    assert estimate.total_tax == 9.0  # from the region seen last
+    small = RateIndex(maxsize=1)
+    api = get_stub_api(stub_server, rate_index=small)
+    api.post_tax(get_stub_doc(DocCode='first'))
+    stub_server.forced.append((200, dict(body, TaxAddresses=[{'AddressCode': '2', 'PostalCode': '10118', 'TaxRegionId': 3600001}])))
+    api.post_tax(get_stub_doc(DocCode='second'))
+    assert small.stats() == {'size': 1, 'zip_codes': 1, 'observations': 2}  # 98110 went with its region's rate
+    assert small.estimate_tax(cart).complete is False